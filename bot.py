@@ -6,7 +6,15 @@ from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, ConversationHandler
 import sys
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
 import base64
+import io
+import codecs
+import csv
+import zipfile
+import tempfile
 import aiohttp
 import qrcode
 import operator
@@ -14,9 +22,10 @@ import logging
 import shutil
 import time
 import asyncio
-import aiosqlite
 import aiofiles
 import pytz
+from db_migrations import apply_migrations
+from storage_records import delete_storage_records
 
 # Определяем путь к директории бота
 BOT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -25,6 +34,11 @@ TEMP_DIR = os.path.join(BOT_DIR, 'temp')
 LOG_DIR = os.path.join(BOT_DIR, 'logs')
 TEMP_LINKS_DIR = os.path.join(BOT_DIR, 'temp_links')
 TEMP_LINKS_DB = os.path.join(BOT_DIR, 'temp_links.db')
+TEMP_STORAGE_DIR = os.path.join(BOT_DIR, 'temp_storage')
+# Файл-маркер, по изменению которого веб-сервер сбрасывает кэш сроков действия хранилищ
+STORAGE_CACHE_MARKER = os.path.join(TEMP_STORAGE_DIR, '.cache_generation')
+# Блобы дедупликации веб-сервера: <первые 2 символа хэша>/<sha256> (см. web_server.py)
+BLOB_STORAGE_DIR = os.getenv('BLOB_STORAGE_DIR', os.path.join(BOT_DIR, 'blob_storage'))
 
 # Настройка логирования
 logging.basicConfig(
@@ -37,6 +51,70 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class BotDatabase:
+    """Асинхронный доступ к БД бота через выделенный поток.
+
+    Все запросы выполняются в одном потоке с постоянным соединением sqlite3,
+    поэтому ни подключение, ни запросы, ни fsync при фиксации не блокируют
+    цикл событий, обрабатывающий обновления всех пользователей.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bot-db')
+        self._conn = None
+
+    def _connection(self):
+        # Соединение создается лениво и используется только потоком БД
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        return self._conn
+
+    def _run_transaction(self, func, args):
+        conn = self._connection()
+        try:
+            result = func(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    async def run(self, func, *args):
+        """Выполняет func(conn, *args) в потоке БД одной транзакцией"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run_transaction, func, args)
+
+    def _close_connection(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def close(self):
+        """Закрывает соединение и останавливает поток БД"""
+        self._executor.submit(self._close_connection).result()
+        self._executor.shutdown(wait=True)
+
+bot_db = BotDatabase(DB_PATH)
+
+async def db_fetchone(query, params=()):
+    """Выполняет SELECT и возвращает первую строку результата"""
+    return await bot_db.run(lambda conn: conn.execute(query, params).fetchone())
+
+async def db_fetchall(query, params=()):
+    """Выполняет SELECT и возвращает все строки результата"""
+    return await bot_db.run(lambda conn: conn.execute(query, params).fetchall())
+
+async def db_execute(query, params=()):
+    """Выполняет изменяющий запрос с фиксацией транзакции, возвращает rowcount"""
+    return await bot_db.run(lambda conn: conn.execute(query, params).rowcount)
+
+async def db_transaction(func, *args):
+    """Выполняет func(conn, *args) в потоке БД как одну транзакцию"""
+    return await bot_db.run(func, *args)
+
 # Загрузка переменных окружения
 load_dotenv()
 TOKEN = os.getenv('BOT_TOKEN')
@@ -56,20 +134,182 @@ if not USER_PLUS_CODE:
 # Получаем домен для временных ссылок
 TEMP_LINK_DOMAIN = os.getenv('TEMP_LINK_DOMAIN', 'https://your-domain.com')
 
+# Кэш профилей пользователей для проверок доступа
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))
+
+class UserProfileCache:
+    """Ограниченный LRU-кэш профилей: user_id -> роль, блокировка, верификация, lines_to_keep.
+
+    Отдельно кэшируется глобальный статус бота (status и lines_to_keep из bot_status).
+    Записи удаляются явно при изменении в боте и живут не дольше TTL, чтобы
+    изменения из веб-сервера тоже подхватывались. Используется только из цикла
+    событий, поэтому блокировки не нужны. Загрузка, начатая до инвалидации,
+    не сохраняет устаревший результат (проверяется счетчик поколений).
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._profiles = OrderedDict()
+        self._bot_status = None
+        self._generation = 0
+
+    def _fresh(self, cached_at):
+        return time.monotonic() - cached_at <= self.ttl
+
+    def get_profile(self, user_id):
+        """Возвращает профиль пользователя или None, если записи нет или она устарела"""
+        entry = self._profiles.get(user_id)
+        if entry is None:
+            return None
+        profile, cached_at = entry
+        if not self._fresh(cached_at):
+            del self._profiles[user_id]
+            return None
+        self._profiles.move_to_end(user_id)
+        return profile
+
+    def set_profile(self, user_id, profile, generation):
+        if generation != self._generation:
+            return
+        self._profiles[user_id] = (profile, time.monotonic())
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    def get_bot_status(self):
+        if self._bot_status is None or not self._fresh(self._bot_status[1]):
+            return None
+        return self._bot_status[0]
+
+    def set_bot_status(self, status, generation):
+        if generation == self._generation:
+            self._bot_status = (status, time.monotonic())
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def invalidate(self, user_id):
+        self._generation += 1
+        self._profiles.pop(user_id, None)
+
+    def invalidate_bot_status(self):
+        self._generation += 1
+        self._bot_status = None
+
+user_profile_cache = UserProfileCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+async def get_user_profile(user_id):
+    """Профиль пользователя из кэша или одним обращением к БД"""
+    profile = user_profile_cache.get_profile(user_id)
+    if profile is not None:
+        return profile
+
+    def _load_profile(conn):
+        user = conn.execute('SELECT role, is_banned, is_verified FROM users WHERE user_id = ?',
+                            (user_id,)).fetchone()
+        settings = conn.execute('SELECT lines_to_keep FROM user_settings WHERE user_id = ?',
+                                (user_id,)).fetchone()
+        return {
+            'role': user[0] if user else None,
+            'is_banned': bool(user and user[1]),
+            'is_verified': bool(user and user[2]),
+            # None — персональная настройка не задана, используется глобальная
+            'lines_to_keep': settings[0] if settings else None,
+        }
+
+    generation = user_profile_cache.generation
+    profile = await db_transaction(_load_profile)
+    user_profile_cache.set_profile(user_id, profile, generation)
+    return profile
+
+async def get_bot_status():
+    """Глобальный статус бота из кэша: {'enabled': bool, 'lines_to_keep': int}"""
+    status = user_profile_cache.get_bot_status()
+    if status is not None:
+        return status
+
+    generation = user_profile_cache.generation
+    result = await db_fetchone('SELECT status, lines_to_keep FROM bot_status WHERE id = 1')
+    status = {
+        'enabled': result[0] == 'enabled' if result else True,
+        'lines_to_keep': result[1] if result else 10,
+    }
+    user_profile_cache.set_bot_status(status, generation)
+    return status
+
+# Интервал (в секундах) записи накопленных счетчиков использования в БД
+COUNTER_FLUSH_INTERVAL = int(os.getenv('COUNTER_FLUSH_INTERVAL', 5))
+
+class UsageCounters:
+    """Отложенная запись счетчиков usage_count, merged_count и qr_count.
+
+    Приращения копятся в памяти по пользователю и счетчику и записываются
+    одной транзакцией раз в COUNTER_FLUSH_INTERVAL секунд и при остановке.
+    Чтение статистики и запись идут под одной блокировкой, поэтому
+    сумма значения из БД и неотправленных приращений всегда точна.
+    """
+
+    COLUMNS = ('usage_count', 'merged_count', 'qr_count')
+
+    def __init__(self):
+        self._pending = {}  # user_id -> {column: delta}
+        self._lock = asyncio.Lock()
+
+    def add(self, user_id, column, delta=1):
+        user_deltas = self._pending.setdefault(user_id, {})
+        user_deltas[column] = user_deltas.get(column, 0) + delta
+
+    def pending(self, user_id):
+        """Неотправленные приращения пользователя: {column: delta}"""
+        return self._pending.get(user_id, {})
+
+    @property
+    def lock(self):
+        """Блокировка для чтения счетчиков из БД с учетом неотправленных приращений"""
+        return self._lock
+
+    async def flush(self):
+        """Записывает накопленные приращения одной транзакцией"""
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+
+            def _apply(conn):
+                for column in self.COLUMNS:
+                    rows = [(deltas[column], user_id) for user_id, deltas in batch.items() if deltas.get(column)]
+                    if rows:
+                        conn.executemany(f'UPDATE users SET {column} = {column} + ? WHERE user_id = ?', rows)
+
+            try:
+                await db_transaction(_apply)
+            except Exception as e:
+                # Возвращаем приращения, чтобы записать их при следующей попытке
+                for user_id, deltas in batch.items():
+                    for column, delta in deltas.items():
+                        self.add(user_id, column, delta)
+                logger.error(f"Ошибка при записи счетчиков использования: {str(e)}")
+
+usage_counters = UsageCounters()
+
+async def flush_usage_counters(context=None):
+    """Периодическая запись накопленных счетчиков использования"""
+    await usage_counters.flush()
+
 async def set_user_lines_to_keep(user_id, lines):
-    """Асинхронная установка количества строк для пользователя"""
+    """Установка количества строк для пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute(
-                'INSERT OR REPLACE INTO user_settings (user_id, lines_to_keep) VALUES (?, ?)',
-                (user_id, lines)
-            )
-            await conn.commit()
-            logger.info(f"Установлено количество строк {lines} для пользователя {user_id}")
+        await db_execute(
+            'INSERT OR REPLACE INTO user_settings (user_id, lines_to_keep) VALUES (?, ?)',
+            (user_id, lines)
+        )
+        user_profile_cache.invalidate(user_id)
+        logger.info(f"Установлено количество строк {lines} для пользователя {user_id}")
     except Exception as e:
         logger.error(f"Ошибка при установке количества строк для пользователя {user_id}: {e}")
-        # Fallback к синхронной версии
-        set_user_lines_to_keep_sync(user_id, lines)
 
 # Константы для ограничений
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
@@ -77,9 +317,11 @@ MAX_LINKS = 1000  # Максимальное количество ссылок 
 ALLOWED_EXTENSIONS = ('.txt', '.csv', '.md', '')  # Добавлено пустое расширение
 DEFAULT_LINES_TO_KEEP = 10  # Количество строк по умолчанию
 MAX_TEMP_LINK_HOURS = 720  # Максимальное время хранения файла в часах (30 дней)
+# Загружаемые и отправляемые файлы держатся в памяти; больше этого размера — во временном файле
+OUTPUT_SPOOL_MAX_SIZE = int(os.getenv('OUTPUT_SPOOL_MAX_SIZE', 8 * 1024 * 1024))
 
 # Состояния разговора
-CAPTCHA, MENU, SETTINGS, TECH_COMMANDS, OTHER_COMMANDS, USER_MANAGEMENT, MERGE_FILES, SET_LINES, PROCESS_FILE, QR_TYPE, QR_DATA, TEMP_LINK, TEMP_LINK_DURATION, TEMP_LINK_EXTEND, STORAGE_MANAGEMENT = range(15)
+CAPTCHA, MENU, SETTINGS, TECH_COMMANDS, OTHER_COMMANDS, USER_MANAGEMENT, MERGE_FILES, SET_LINES, PROCESS_FILE, QR_TYPE, QR_DATA, TEMP_LINK, TEMP_LINK_DURATION, TEMP_LINK_EXTEND, STORAGE_MANAGEMENT, QR_BATCH = range(16)
 
 # Добавим константы для ролей
 class UserRole:
@@ -138,110 +380,24 @@ async def log_error(user_id, error_message):
         print(f"[{timestamp}] User {user_id}: {error_message}")
 
 async def setup_database():
-    """Настройка базы данных"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute('''CREATE TABLE IF NOT EXISTS users
-                 (user_id INTEGER PRIMARY KEY,
-                  username TEXT,
-                  is_verified BOOLEAN DEFAULT FALSE,
-                  role TEXT DEFAULT 'user',
-                  usage_count INTEGER DEFAULT 0,
-                  merged_count INTEGER DEFAULT 0,
-                  qr_count INTEGER DEFAULT 0,
-                  last_action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  is_banned BOOLEAN DEFAULT FALSE)''')
-        
-        # Проверка наличия поля is_banned и его добавление, если отсутствует
-        cursor = await conn.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in await cursor.fetchall()]
-        if 'is_banned' not in columns:
-            await conn.execute("ALTER TABLE users ADD COLUMN is_banned BOOLEAN DEFAULT FALSE")
-        
-        # Создание таблицы bot_status
-        await conn.execute('''CREATE TABLE IF NOT EXISTS bot_status
-                 (id INTEGER PRIMARY KEY,
-                  status TEXT DEFAULT 'enabled',
-                  lines_to_keep INTEGER DEFAULT 10)''')
-        
-        # Проверяем наличие записи с id=1
-        cursor = await conn.execute('SELECT COUNT(*) FROM bot_status WHERE id = 1')
-        count = await cursor.fetchone()
-        if count[0] == 0:
-            await conn.execute('INSERT INTO bot_status (id, status, lines_to_keep) VALUES (1, "enabled", 10)')
-        
-        # Создание таблицы user_settings
-        await conn.execute('''CREATE TABLE IF NOT EXISTS user_settings
-                 (user_id INTEGER PRIMARY KEY,
-                  language TEXT DEFAULT 'ru',
-                  lines_to_keep INTEGER DEFAULT 10,
-                  theme TEXT DEFAULT 'dark',
-                  FOREIGN KEY (user_id) REFERENCES users(user_id))''')
-        
-        # Проверяем наличие колонок в user_settings
-        cursor = await conn.execute("PRAGMA table_info(user_settings)")
-        columns = [column[1] for column in await cursor.fetchall()]
-        if 'lines_to_keep' not in columns:
-            await conn.execute("ALTER TABLE user_settings ADD COLUMN lines_to_keep INTEGER DEFAULT 10")
-        if 'theme' not in columns:
-            await conn.execute("ALTER TABLE user_settings ADD COLUMN theme TEXT DEFAULT 'dark'")
-        
-        # Создание таблицы temp_links
-        await conn.execute('''CREATE TABLE IF NOT EXISTS temp_links
-                 (link_id TEXT PRIMARY KEY,
-                  user_id INTEGER,
-                  expires_at TIMESTAMP,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  extension_count INTEGER DEFAULT 0,
-                  FOREIGN KEY (user_id) REFERENCES users(user_id))''')
-        
-        # Проверка наличия поля extension_count и его добавление, если отсутствует
-        cursor = await conn.execute("PRAGMA table_info(temp_links)")
-        columns = [column[1] for column in await cursor.fetchall()]
-        if 'extension_count' not in columns:
-            await conn.execute("ALTER TABLE temp_links ADD COLUMN extension_count INTEGER DEFAULT 0")
-        
-        # Создание таблицы temp_link_files
-        await conn.execute('''CREATE TABLE IF NOT EXISTS temp_link_files
-                 (file_id TEXT PRIMARY KEY,
-                  link_id TEXT,
-                  file_path TEXT,
-                  original_name TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (link_id) REFERENCES temp_links(link_id))''')
-        
-        await conn.commit()
-    
-    logger.info("База данных успешно инициализирована")
-
-def is_user_verified(user_id):
-    """Проверка верификации пользователя (синхронная версия)"""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute('SELECT is_verified FROM users WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        return result[0] if result else False
-    finally:
-        conn.close()
+    """Настройка базы данных: применяет недостающие миграции схемы (см. db_migrations)"""
+    schema_version = await asyncio.to_thread(apply_migrations, DB_PATH)
+    logger.info(f"База данных успешно инициализирована (версия схемы {schema_version})")
+
+async def is_user_verified(user_id):
+    """Проверка верификации пользователя"""
+    return (await get_user_profile(user_id))['is_verified']
 
-def is_admin(user_id):
+async def is_admin(user_id):
     """Проверка, является ли пользователь администратором"""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        return result and result[0] == UserRole.ADMIN
-    finally:
-        conn.close()
+    return (await get_user_profile(user_id))['role'] == UserRole.ADMIN
 
 async def verify_user(user_id, username, role=UserRole.USER):
     """Верификация пользователя в базе данных"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    def _verify(conn, role):
         # Проверяем существующие данные пользователя
-        cursor = await conn.execute('SELECT role, usage_count, merged_count, qr_count FROM users WHERE user_id = ?', (user_id,))
-        result = await cursor.fetchone()
+        result = conn.execute('SELECT role, usage_count, merged_count, qr_count FROM users WHERE user_id = ?',
+                              (user_id,)).fetchone()
         
         if result:
             existing_role, usage_count, merged_count, qr_count = result
@@ -251,24 +407,86 @@ async def verify_user(user_id, username, role=UserRole.USER):
         else:
             usage_count, merged_count, qr_count = 0, 0, 0
         
-        await conn.execute('''
+        conn.execute('''
             INSERT OR REPLACE INTO users 
             (user_id, username, is_verified, role, usage_count, merged_count, qr_count)
             VALUES (?, ?, TRUE, ?, ?, ?, ?)
         ''', (user_id, username, role, usage_count, merged_count, qr_count))
-        
-        await conn.commit()
 
-def is_bot_enabled():
+    await db_transaction(_verify, role)
+    user_profile_cache.invalidate(user_id)
+
+async def is_bot_enabled():
     """Проверка, включен ли бот"""
-    conn = sqlite3.connect(DB_PATH)
+    return (await get_bot_status())['enabled']
+
+def notify_storage_changed():
+    """Сообщает веб-серверу, что записи temp_links изменились, чтобы он сбросил кэш"""
     try:
-        c = conn.cursor()
-        c.execute('SELECT status FROM bot_status WHERE id = 1')
-        result = c.fetchone()
-        return result[0] == 'enabled' if result else True
-    finally:
-        conn.close()
+        os.makedirs(TEMP_STORAGE_DIR, exist_ok=True)
+        with open(STORAGE_CACHE_MARKER, 'a'):
+            pass
+        os.utime(STORAGE_CACHE_MARKER, None)
+    except OSError as e:
+        logger.error(f"Не удалось обновить маркер кэша хранилищ: {e}")
+
+async def delete_storages(link_ids):
+    """Удаляет хранилища: записи в БД, директории, файлы и блобы без ссылок.
+
+    После удаления веб-сервер получает уведомление через файл-маркер и
+    сбрасывает кэш сроков и расписание удаления.
+    """
+    link_ids = list(link_ids)
+    if not link_ids:
+        return
+    files, orphaned = await db_transaction(delete_storage_records, link_ids)
+
+    def _remove_from_disk():
+        for link_id in link_ids:
+            storage_path = os.path.join(TEMP_STORAGE_DIR, link_id)
+            if os.path.exists(storage_path):
+                shutil.rmtree(storage_path, ignore_errors=True)
+        for file_path in files:
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            except OSError as e:
+                logger.error(f"Ошибка при удалении файла {file_path}: {str(e)}")
+        for sha256 in orphaned:
+            try:
+                os.remove(os.path.join(BLOB_STORAGE_DIR, sha256[:2], sha256))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Не удалось удалить блоб {sha256}: {str(e)}")
+
+    await asyncio.to_thread(_remove_from_disk)
+    notify_storage_changed()
+
+class SpooledBuffer(tempfile.SpooledTemporaryFile):
+    """SpooledTemporaryFile с именем отправляемого файла.
+
+    InputFile берет имя документа из атрибута name, а у SpooledTemporaryFile
+    он равен None, пока данные в памяти, и отправка такого объекта падает.
+    """
+
+    def __init__(self, filename=None, **kwargs):
+        super().__init__(**kwargs)
+        self.filename = filename
+
+    @property
+    def name(self):
+        return self.filename if self.filename is not None else super().name
+
+def new_spooled_buffer(filename=None):
+    """Буфер для загруженного или отправляемого файла.
+
+    Пока содержимое меньше OUTPUT_SPOOL_MAX_SIZE, это BytesIO в памяти; при
+    превышении данные переносятся в безымянный временный файл в TEMP_DIR,
+    поэтому одновременные запросы не конфликтуют по именам файлов.
+    Буфер с filename можно передавать в send_document как есть.
+    """
+    return SpooledBuffer(filename, max_size=OUTPUT_SPOOL_MAX_SIZE, dir=TEMP_DIR)
 
 def generate_captcha():
     """Генерация простой математической капчи"""
@@ -302,7 +520,7 @@ def get_qr_type_keyboard():
         ['📧 Электронная почта', '📍 Местоположение'],
         ['📞 Телефон', '✉️ СМС'],
         ['📱 WhatsApp', '📶 Wi-Fi'],
-        ['👤 Визитка'],
+        ['👤 Визитка', '📦 Пакет из файла'],
         ['Назад']
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -343,13 +561,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return MENU
     
     # Проверяем, верифицирован ли пользователь
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT is_verified FROM users WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    
-    if result and result[0]:
+    if await is_user_verified(user_id):
         return await show_menu(update, context)
     
     # Если пользователь не верифицирован, отправляем капчу
@@ -411,7 +623,7 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_access(update, context):
         return MENU
         
-    if not is_bot_enabled() and not is_admin(update.effective_user.id):
+    if not await is_bot_enabled() and not await is_admin(update.effective_user.id):
         await update.message.reply_text("Бот находится на техническом обслуживании. Пожалуйста, подождите.")
         return MENU
     
@@ -434,7 +646,7 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MENU
     
     if text == '📤 Обработать файл':
-        lines_to_keep = get_user_lines_to_keep(update.effective_user.id)
+        lines_to_keep = await get_user_lines_to_keep(update.effective_user.id)
         await update.message.reply_text(
             f'Отправьте мне файл со ссылками (txt, csv или md), '
             f'и я верну вам последние {lines_to_keep} ссылок в формате HTML.\n'
@@ -464,16 +676,13 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif text == '🔗 Создать временное хранилище':
         try:
             # Проверяем наличие активного хранилища
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute('''
+            active_storage = await db_fetchone('''
                 SELECT link_id, expires_at 
                 FROM temp_links 
-                WHERE user_id = ? AND expires_at > datetime('now')
+                WHERE user_id = ? AND expires_at > ?
                 ORDER BY created_at DESC
                 LIMIT 1
-            ''', (update.effective_user.id,))
-            active_storage = c.fetchone()
+            ''', (update.effective_user.id, int(time.time())))
             
             if active_storage:
                 link_id, expires_at = active_storage
@@ -517,15 +726,12 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=get_menu_keyboard(update.effective_user.id)
             )
             return MENU
-        finally:
-            if 'conn' in locals():
-                conn.close()
     elif text == 'ℹ️ Помощь':
         await update.message.reply_text(
             "📚 *Помощь по использованию бота*\n\n"
             "📤 *Обработать файл* - загрузите файл со ссылками, и бот вернет последние N ссылок\n"
             "🔄 *Объединить подписки* - объединяет несколько подписок в одну\n"
-            "📱 *Создать QR-код* - создает QR-код для различных типов данных\n"
+            "📱 *Создать QR-код* - создает QR-код для различных типов данных или ZIP-архив кодов из CSV-файла\n"
             "🔗 *Создать временное хранилище* - создает хранилище для файлов с возможностью выбора срока хранения от 1 часа до 30 дней, с возможностью продления\n"
             "📊 *Статистика* - показывает вашу статистику использования\n"
             "⚙️ *Настройки* - настройки бота\n\n"
@@ -534,16 +740,14 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return MENU
     elif text == '📊 Статистика':
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT usage_count, merged_count, qr_count FROM users WHERE user_id = ?', 
-                 (update.effective_user.id,))
-        stats = c.fetchone()
-        usage_count = stats[0] if stats else 0
-        merged_count = stats[1] if stats else 0
-        qr_count = stats[2] if stats else 0
-        lines_to_keep = get_user_lines_to_keep(update.effective_user.id)
-        conn.close()
+        async with usage_counters.lock:
+            stats = await db_fetchone('SELECT usage_count, merged_count, qr_count FROM users WHERE user_id = ?',
+                                      (update.effective_user.id,))
+            pending = usage_counters.pending(update.effective_user.id)
+        usage_count = (stats[0] if stats else 0) + pending.get('usage_count', 0)
+        merged_count = (stats[1] if stats else 0) + pending.get('merged_count', 0)
+        qr_count = (stats[2] if stats else 0) + pending.get('qr_count', 0)
+        lines_to_keep = await get_user_lines_to_keep(update.effective_user.id)
         
         await update.message.reply_text(
             f"📊 Ваша статистика:\n\n"
@@ -558,7 +762,7 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MENU
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_bot_enabled() and not is_admin(update.effective_user.id):
+    if not await is_bot_enabled() and not await is_admin(update.effective_user.id):
         await update.message.reply_text("Бот находится на техническом обслуживании. Пожалуйста, подождите.")
         return MENU
     
@@ -568,7 +772,7 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard.append([KeyboardButton(text="Настройка количества строк")])
     
     # Дополнительные команды только для администраторов
-    if is_admin(update.effective_user.id):
+    if await is_admin(update.effective_user.id):
         keyboard.extend([
             [KeyboardButton(text="Технические команды")],
             [KeyboardButton(text="Другое")]
@@ -588,26 +792,28 @@ async def process_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MENU
     elif text == "Настройка количества строк":
         # Напрямую запрашиваем новое количество строк для пользователя
-        current_lines = get_user_lines_to_keep(update.effective_user.id)
+        current_lines = await get_user_lines_to_keep(update.effective_user.id)
         await update.message.reply_text(
             f"Текущее количество строк: {current_lines}\n"
             f"Введите новое количество (от 1 до {MAX_LINKS}):"
         )
         context.user_data['setting_type'] = 'personal'
         return SET_LINES
-    elif text == "Технические команды" and is_admin(update.effective_user.id):
+    elif text == "Технические команды" and await is_admin(update.effective_user.id):
         markup = ReplyKeyboardMarkup(
             keyboard=[
                 [KeyboardButton(text="Включить бота")],
                 [KeyboardButton(text="Выключить бота")],
                 [KeyboardButton(text="Перезапустить бота")],
+                [KeyboardButton(text="Статистика кэша QR-кодов")],
+                [KeyboardButton(text="Статистика хранилищ")],
                 [KeyboardButton(text="Назад")]
             ],
             resize_keyboard=True
         )
         await update.message.reply_text("Технические команды:", reply_markup=markup)
         return TECH_COMMANDS
-    elif text == "Другое" and is_admin(update.effective_user.id):
+    elif text == "Другое" and await is_admin(update.effective_user.id):
         markup = ReplyKeyboardMarkup(
             keyboard=[
                 [KeyboardButton(text="Написать всем пользователям")],
@@ -630,7 +836,7 @@ async def process_set_lines(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await settings_command(update, context)
         return SETTINGS
     elif text == "Настройка количества строк":
-        current_lines = get_user_lines_to_keep(update.effective_user.id)
+        current_lines = await get_user_lines_to_keep(update.effective_user.id)
         await update.message.reply_text(
             f"Текущее количество строк: {current_lines}\n"
             f"Введите новое количество (от 1 до {MAX_LINKS}):"
@@ -669,21 +875,38 @@ async def process_tech_commands(update: Update, context: ContextTypes.DEFAULT_TY
         await settings_command(update, context)
         return SETTINGS
     elif text == "Включить бота":
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("UPDATE bot_status SET status='enabled' WHERE id=1")
-        conn.commit()
-        conn.close()
+        await db_execute("UPDATE bot_status SET status='enabled' WHERE id=1")
+        user_profile_cache.invalidate_bot_status()
         await update.message.reply_text("Бот включен.")
     elif text == "Выключить бота":
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("UPDATE bot_status SET status='disabled' WHERE id=1")
-        conn.commit()
-        conn.close()
+        await db_execute("UPDATE bot_status SET status='disabled' WHERE id=1")
+        user_profile_cache.invalidate_bot_status()
         await update.message.reply_text("Бот выключен. Теперь он на техническом обслуживании.")
+    elif text == "Статистика кэша QR-кодов":
+        stats = qr_renderer.stats()
+        total = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / total * 100 if total else 0
+        await update.message.reply_text(
+            f"📊 Кэш QR-кодов:\n\n"
+            f"Попаданий: {stats['hits']}\n"
+            f"Промахов: {stats['misses']}\n"
+            f"Доля попаданий: {hit_rate:.1f}%\n"
+            f"Записей в кэше: {stats['size']} из {qr_renderer.cache_size}"
+        )
+    elif text == "Статистика хранилищ":
+        storage_count, logical_bytes, physical_bytes = await get_storage_usage_totals()
+        saved_bytes = logical_bytes - physical_bytes
+        saved_percent = saved_bytes / logical_bytes * 100 if logical_bytes else 0
+        await update.message.reply_text(
+            f"📦 Хранилища:\n\n"
+            f"Хранилищ с файлами: {storage_count}\n"
+            f"Занято логически: {logical_bytes / (1024 * 1024):.2f} МБ\n"
+            f"Занято на диске: {physical_bytes / (1024 * 1024):.2f} МБ\n"
+            f"Сэкономлено дедупликацией: {saved_bytes / (1024 * 1024):.2f} МБ ({saved_percent:.1f}%)"
+        )
     elif text == "Перезапустить бота":
         await update.message.reply_text("Перезапуск бота...")
+        await usage_counters.flush()
         # Отправляем сигнал SIGTERM для корректного завершения работы
         import os
         import signal
@@ -692,6 +915,22 @@ async def process_tech_commands(update: Update, context: ContextTypes.DEFAULT_TY
     
     return TECH_COMMANDS
 
+async def get_storage_usage_totals():
+    """Итоги учета места хранилищ по таблицам веб-сервера.
+
+    Возвращает (число хранилищ, логический объем, физический объем с учетом
+    дедупликации): одинаковые файлы на диске хранятся одним блобом.
+    """
+    def _totals(conn):
+        storage_count, logical_bytes = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(used_bytes), 0) FROM storage_usage WHERE used_bytes > 0'
+        ).fetchone()
+        shared_bytes = conn.execute(
+            'SELECT COALESCE(SUM(size * (refcount - 1)), 0) FROM storage_blobs WHERE refcount > 1'
+        ).fetchone()[0]
+        return storage_count, logical_bytes, logical_bytes - shared_bytes
+    return await db_transaction(_totals)
+
 async def process_other_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_admin_rights(update.effective_user.id):
         await update.message.reply_text("У вас нет прав для выполнения этой команды.")
@@ -712,11 +951,7 @@ async def process_other_commands(update: Update, context: ContextTypes.DEFAULT_T
         return await show_storage_list(update, context)
     else:
         # Отправляем сообщение всем пользователям
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT user_id FROM users WHERE is_verified = TRUE')
-        users = c.fetchall()
-        conn.close()
+        users = await db_fetchall('SELECT user_id FROM users WHERE is_verified = TRUE')
         
         success_count = 0
         for user_id in users:
@@ -787,7 +1022,7 @@ async def show_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def process_user_management(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка управления пользователями"""
     # Для администраторов пропускаем проверку спама
-    if is_admin(update.effective_user.id):
+    if await is_admin(update.effective_user.id):
         return await _process_user_management(update, context)
     
     if not await check_user_access(update, context):
@@ -848,9 +1083,8 @@ async def _process_user_management(update: Update, context: ContextTypes.DEFAULT
             }[text]
             
             try:
-                async with aiosqlite.connect(DB_PATH) as conn:
-                    await conn.execute('UPDATE users SET role = ? WHERE user_id = ?', (role, user_id))
-                    await conn.commit()
+                await db_execute('UPDATE users SET role = ? WHERE user_id = ?', (role, user_id))
+                user_profile_cache.invalidate(user_id)
                 await update.message.reply_text("Роль пользователя обновлена.")
                 return await show_users_list(update, context)
             except Exception as e:
@@ -862,7 +1096,7 @@ async def _process_user_management(update: Update, context: ContextTypes.DEFAULT
         context.user_data['selected_user_id'] = user_id
         
         # Проверяем статус блокировки пользователя
-        is_banned = is_user_banned(user_id)
+        is_banned = await is_user_banned(user_id)
         
         keyboard = [
             [KeyboardButton(text="Убрать из базы")],
@@ -1020,15 +1254,166 @@ async def process_merge_command(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def increment_merge_count(user_id):
     """Увеличение счетчика объединений"""
-    async with await safe_db_connect() as conn:
-        if not conn:
-            return
-        
+    usage_counters.add(user_id, 'merged_count')
+
+# Рендеринг QR-кодов в пуле процессов
+QR_WORKERS = int(os.getenv('QR_WORKERS', 2))
+QR_MAX_PENDING = int(os.getenv('QR_MAX_PENDING', 32))  # Сколько заданий одновременно передается в пул
+QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', 256))  # Сколько готовых PNG держать в памяти
+QR_BATCH_MAX_ROWS = int(os.getenv('QR_BATCH_MAX_ROWS', 500))  # Сколько QR-кодов можно создать одним файлом
+QR_BATCH_MAX_FILE_SIZE = 1024 * 1024  # Максимальный размер файла для пакетной генерации
+QR_BATCH_PROGRESS_INTERVAL = 3  # Как часто (в секундах) обновлять сообщение о прогрессе
+QR_BATCH_MAX_ERRORS_SHOWN = 10  # Сколько ошибочных строк перечислять в отчете
+
+def render_qr_png(payload, error_correction, box_size, fill_color, back_color):
+    """Рендеринг QR-кода в PNG (выполняется в процессе пула)"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=error_correction,
+        box_size=box_size,
+        border=4,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color=fill_color, back_color=back_color)
+    buffer = io.BytesIO()
+    img.save(buffer)
+    return buffer.getvalue()
+
+class QRRenderer:
+    """Рендеринг QR-кодов в пуле процессов с LRU-кэшем готовых PNG.
+
+    Кодирование и отрисовка выполняются вне цикла событий; одновременно в пул
+    передается не больше max_pending заданий, остальные ждут своей очереди.
+    Кэш ключуется по (payload, error_correction, box_size, fill_color, back_color);
+    одинаковые запросы, пришедшие во время рендеринга, ждут общий результат.
+    """
+
+    def __init__(self, workers, max_pending, cache_size):
+        self.workers = max(1, workers)
+        self.cache_size = max(1, cache_size)
+        self._executor = None
+        self._slots = asyncio.Semaphore(max(1, max_pending))
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get_executor(self):
+        # Пул создается при первом обращении, процессы — по мере заданий
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def render(self, payload, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10,
+                     fill_color='black', back_color='white', cache=True):
+        """Возвращает PNG QR-кода из кэша или рендерит его в пуле процессов.
+
+        С cache=False результат не сохраняется в кэш: пакетная генерация
+        не должна вытеснять часто запрашиваемые коды.
+        """
+        key = (payload, error_correction, box_size, fill_color, back_color)
+        png = self._cache.get(key)
+        if png is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return png
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._inflight[key] = future
         try:
-            await conn.execute('UPDATE users SET merged_count = merged_count + 1 WHERE user_id = ?', (user_id,))
-            await conn.commit()
-        except sqlite3.Error as e:
-            print(f"Ошибка при обновлении счетчика объединений: {e}")
+            async with self._slots:
+                try:
+                    png = await loop.run_in_executor(self._get_executor(), render_qr_png, *key)
+                except BrokenProcessPool:
+                    # Процесс пула аварийно завершился — следующий запрос создаст новый пул
+                    self._executor = None
+                    raise
+            if cache:
+                self._cache[key] = png
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            future.set_result(png)
+            return png
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Ошибку получает вызывающий, ожидающих может не быть
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self):
+        """Счетчики кэша: попадания, промахи и число записей"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+qr_renderer = QRRenderer(QR_WORKERS, QR_MAX_PENDING, QR_CACHE_SIZE)
+
+# Как разбивается введенный в чате текст: максимальное число разбиений
+# (-1 — по всем пробелам); типы без записи принимают текст целиком
+QR_DATA_SPLITS = {
+    'EMAIL': -1,
+    'GEO': -1,
+    'SMS': -1,
+    'WHATSAPP': -1,
+    'WIFI': 1,
+    'VCARD': 4,
+}
+
+def split_qr_data(qr_type, data):
+    """Разбивает введенный в чате текст на поля QR-кода"""
+    if qr_type in QR_DATA_SPLITS:
+        return data.split(maxsplit=QR_DATA_SPLITS[qr_type])
+    return [data]
+
+def build_qr_content(qr_type, fields):
+    """Формирует содержимое QR-кода по типу и списку полей.
+
+    Поля идут в том же порядке, что и в подсказках одиночного режима.
+    При неверном количестве полей или неизвестном типе — ValueError.
+    """
+    if not fields or not fields[0]:
+        raise ValueError("нет данных")
+    if qr_type == 'URL':
+        data = ' '.join(fields)
+        return data if data.startswith(('http://', 'https://')) else f'https://{data}'
+    elif qr_type == 'TEXT':
+        return ' '.join(fields)
+    elif qr_type == 'EMAIL':
+        email, *subject = fields
+        return f'mailto:{email}?subject={"+".join(" ".join(subject).split())}'
+    elif qr_type == 'GEO':
+        lat, lon = fields
+        return f'geo:{lat},{lon}'
+    elif qr_type == 'TEL':
+        return f'tel:{" ".join(fields).replace(" ", "")}'
+    elif qr_type == 'SMS':
+        phone, *message = fields
+        return f'smsto:{phone}:{" ".join(message)}'
+    elif qr_type == 'WHATSAPP':
+        phone, *message = fields
+        return f'whatsapp://send?phone={phone.replace("+", "")}&text={"+".join(" ".join(message).split())}'
+    elif qr_type == 'WIFI':
+        ssid, password = fields
+        return f'WIFI:S:{ssid};T:WPA;P:{password};;'
+    elif qr_type == 'VCARD':
+        name, phone, email, company, title = fields
+        return f'BEGIN:VCARD\nVERSION:3.0\nN:{name}\nTEL:{phone}\nEMAIL:{email}\nORG:{company}\nTITLE:{title}\nEND:VCARD'
+    raise ValueError(f"неизвестный тип QR-кода {qr_type}")
 
 async def process_qr_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
@@ -1049,6 +1434,11 @@ async def process_qr_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
         '👤 Визитка': ('Отправьте данные в формате: ФИО Телефон Email Компания Должность', 'VCARD')
     }
     
+    if text == '📦 Пакет из файла':
+        keyboard = ReplyKeyboardMarkup([['Назад']], resize_keyboard=True)
+        await update.message.reply_text(QR_BATCH_HELP, reply_markup=keyboard)
+        return QR_BATCH
+    
     if text in qr_types:
         context.user_data['qr_type'] = qr_types[text][1]
         keyboard = ReplyKeyboardMarkup([['Назад']], resize_keyboard=True)
@@ -1059,7 +1449,6 @@ async def process_qr_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return QR_TYPE
 
 async def process_qr_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    temp_filename = None
     try:
         if update.message.text == "Назад":
             await update.message.reply_text(
@@ -1073,63 +1462,20 @@ async def process_qr_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
             data = update.message.text.strip()
             
             # Формируем содержимое QR-кода в зависимости от типа
-            if qr_type == 'URL':
-                qr_content = data if data.startswith(('http://', 'https://')) else f'https://{data}'
-            elif qr_type == 'TEXT':
-                qr_content = data
-            elif qr_type == 'EMAIL':
-                email, *subject = data.split()
-                qr_content = f'mailto:{email}?subject={"+".join(subject)}'
-            elif qr_type == 'GEO':
-                lat, lon = data.split()
-                qr_content = f'geo:{lat},{lon}'
-            elif qr_type == 'TEL':
-                qr_content = f'tel:{data.replace(" ", "")}'
-            elif qr_type == 'SMS':
-                phone, *message = data.split()
-                qr_content = f'smsto:{phone}:{" ".join(message)}'
-            elif qr_type == 'WHATSAPP':
-                phone, *message = data.split()
-                qr_content = f'whatsapp://send?phone={phone.replace("+", "")}&text={"+".join(message)}'
-            elif qr_type == 'WIFI':
-                ssid, password = data.split(maxsplit=1)
-                qr_content = f'WIFI:S:{ssid};T:WPA;P:{password};;'
-            elif qr_type == 'VCARD':
-                name, phone, email, company, title = data.split(maxsplit=4)
-                qr_content = f'BEGIN:VCARD\nVERSION:3.0\nN:{name}\nTEL:{phone}\nEMAIL:{email}\nORG:{company}\nTITLE:{title}\nEND:VCARD'
-            
-            # Создаем QR-код
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(qr_content)
-            qr.make(fit=True)
+            qr_content = build_qr_content(qr_type, split_qr_data(qr_type, data))
             
-            # Создаем изображение
-            img = qr.make_image(fill_color="black", back_color="white")
+            # Создаем QR-код в пуле процессов (или берем готовый из кэша)
+            png = await qr_renderer.render(qr_content)
             
-            # Создаем временный файл для QR-кода
-            temp_filename = os.path.join(TEMP_DIR, f'qr_{update.effective_user.id}.png')
-            try:
-                # Сохраняем изображение в файл
-                img.save(temp_filename)
-
-                # Отправляем изображение
-                with open(temp_filename, 'rb') as f:
-                    await update.message.reply_photo(
-                        photo=f,
-                        caption="Ваш QR-код готов!",
-                        reply_markup=get_menu_keyboard(update.effective_user.id)
-                    )
-
-                # Увеличиваем счетчик созданных QR-кодов
-                await increment_qr_count(update.effective_user.id)
-            finally:
-                if temp_filename and os.path.exists(temp_filename):
-                    os.remove(temp_filename)
+            # Отправляем изображение из памяти
+            await update.message.reply_photo(
+                photo=png,
+                caption="Ваш QR-код готов!",
+                reply_markup=get_menu_keyboard(update.effective_user.id)
+            )
+
+            # Увеличиваем счетчик созданных QR-кодов
+            await increment_qr_count(update.effective_user.id)
             # Очищаем данные пользователя
             context.user_data.clear()
             return MENU
@@ -1137,8 +1483,6 @@ async def process_qr_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             error_message = f"Ошибка при создании QR-кода: {str(e)}"
             await log_error(update.effective_user.id, error_message)
-            if temp_filename and os.path.exists(temp_filename):
-                os.remove(temp_filename)
             await update.message.reply_text(
                 "Произошла ошибка. Пожалуйста, проверьте формат данных и попробуйте снова.",
                 reply_markup=get_qr_type_keyboard()
@@ -1148,39 +1492,245 @@ async def process_qr_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         error_message = f"Ошибка при создании QR-кода: {str(e)}"
         await log_error(update.effective_user.id, error_message)
-        if temp_filename and os.path.exists(temp_filename):
-            os.remove(temp_filename)
         await update.message.reply_text(
             "Произошла ошибка. Пожалуйста, проверьте формат данных и попробуйте снова.",
             reply_markup=get_qr_type_keyboard()
         )
         return QR_TYPE
 
-async def increment_qr_count(user_id):
+async def increment_qr_count(user_id, count=1):
     """Увеличение счетчика созданных QR-кодов"""
-    conn = await safe_db_connect()
-    if not conn:
-        return
+    usage_counters.add(user_id, 'qr_count', count)
+
+QR_BATCH_HELP = f"""Отправьте CSV или TXT файл: одна строка — один QR-код.
+
+Первая колонка — тип, остальные — данные в том же порядке, что и в одиночном режиме:
+URL;ссылка
+TEXT;текст
+EMAIL;адрес;тема
+GEO;широта;долгота
+TEL;телефон
+SMS;телефон;текст
+WHATSAPP;телефон;сообщение
+WIFI;SSID;пароль
+VCARD;ФИО;телефон;email;компания;должность
+
+Разделитель — запятая, точка с запятой или табуляция. Значения с разделителем внутри заключайте в кавычки.
+Не больше {QR_BATCH_MAX_ROWS} строк за раз. Готовые коды придут одним ZIP-архивом."""
+
+QR_BATCH_TYPES = ('URL', 'TEXT', 'EMAIL', 'GEO', 'TEL', 'SMS', 'WHATSAPP', 'WIFI', 'VCARD')
+
+# Пользователи, для которых сейчас выполняется пакетная генерация
+qr_batch_users = set()
+
+def parse_qr_batch(text):
+    """Разбор файла пакетной генерации.
+
+    Возвращает список (номер строки, тип, поля) и список ошибок разбора.
+    Пустые строки и строка заголовка (type/тип в первой колонке) пропускаются.
+    """
+    # Тип в первой колонке не содержит разделителей, поэтому разделитель —
+    # первый из ';', табуляции или ',' в первой непустой строке
+    delimiter = ','
+    first_line = next((line for line in text.splitlines() if line.strip()), '')
+    positions = {d: first_line.find(d) for d in (';', '\t', ',') if d in first_line}
+    if positions:
+        delimiter = min(positions, key=positions.get)
+
+    rows = []
+    errors = []
+    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
     try:
-        await conn.execute('UPDATE users SET qr_count = qr_count + 1 WHERE user_id = ?', (user_id,))
-        await conn.commit()
-    except sqlite3.Error as e:
-        print(f"Ошибка при обновлении счетчика QR-кодов: {e}")
+        for row in reader:
+            fields = [field.strip() for field in row]
+            while fields and not fields[-1]:
+                fields.pop()
+            if not fields:
+                continue
+            qr_type = fields[0].upper()
+            if qr_type in ('TYPE', 'ТИП'):
+                continue
+            rows.append((reader.line_num, qr_type, fields[1:]))
+    except csv.Error as e:
+        errors.append(f"Строка {reader.line_num}: {str(e)}")
+    return rows, errors
 
-async def safe_db_connect():
-    """Безопасное подключение к базе данных"""
+async def render_qr_batch_item(index, qr_type, content):
+    """Рендеринг одного QR-кода пакета; ошибка возвращается вместо PNG"""
     try:
-        return await aiosqlite.connect(DB_PATH)
-    except sqlite3.Error as e:
-        print(f"Ошибка подключения к базе данных: {e}")
-        return None
+        return index, qr_type, await qr_renderer.render(content, cache=False), None
+    except Exception as e:
+        return index, qr_type, None, e
+
+async def run_qr_batch(message, user_id, jobs, errors):
+    """Рендеринг пакета QR-кодов в ZIP-архив и отправка его пользователю.
+
+    В пул одновременно передается не больше двух заданий на процесс, чтобы
+    одиночные запросы других пользователей не ждали весь пакет. PNG пишутся
+    в архив по мере готовности, архив собирается в буфере в памяти.
+    """
+    total = len(jobs)
+    window = qr_renderer.workers * 2
+    rendered = 0
+    try:
+        progress = await message.reply_text(f"⏳ Создание QR-кодов: 0 из {total}")
+        last_progress = time.monotonic()
+
+        with new_spooled_buffer('qr_codes.zip') as buffer:
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                queue = iter(jobs)
+                running = set()
+                while True:
+                    for index, qr_type, content in queue:
+                        running.add(asyncio.ensure_future(render_qr_batch_item(index, qr_type, content)))
+                        if len(running) >= window:
+                            break
+                    if not running:
+                        break
+
+                    done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        index, qr_type, png, error = task.result()
+                        if error is not None:
+                            errors.append(f"Строка {index}: {str(error)}")
+                            continue
+                        archive.writestr(f'{index:04d}_{qr_type.lower()}.png', png)
+                        rendered += 1
+
+                    if time.monotonic() - last_progress >= QR_BATCH_PROGRESS_INTERVAL:
+                        last_progress = time.monotonic()
+                        try:
+                            await progress.edit_text(f"⏳ Создание QR-кодов: {rendered} из {total}")
+                        except Exception as e:
+                            logger.error(f"Ошибка при обновлении прогресса пакетной генерации: {str(e)}")
+
+            report = f"✅ Создано QR-кодов: {rendered} из {total}"
+            if errors:
+                report += f"\n\n⚠️ Пропущено строк: {len(errors)}\n" + "\n".join(errors[:QR_BATCH_MAX_ERRORS_SHOWN])
+                if len(errors) > QR_BATCH_MAX_ERRORS_SHOWN:
+                    report += "\n..."
+
+            try:
+                await progress.edit_text(f"✅ Создание QR-кодов завершено: {rendered} из {total}")
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении прогресса пакетной генерации: {str(e)}")
+            if rendered:
+                buffer.seek(0)
+                await message.reply_document(
+                    document=buffer,
+                    filename='qr_codes.zip',
+                    caption=report[:1024],  # Ограничение Telegram на длину подписи
+                    reply_markup=get_menu_keyboard(user_id)
+                )
+                await increment_qr_count(user_id, rendered)
+            else:
+                await message.reply_text(report, reply_markup=get_menu_keyboard(user_id))
+
+    except Exception as e:
+        error_message = f"Ошибка при пакетной генерации QR-кодов: {str(e)}"
+        await log_error(user_id, error_message)
+        await message.reply_text(
+            "Произошла ошибка при создании архива. Пожалуйста, попробуйте снова.",
+            reply_markup=get_menu_keyboard(user_id)
+        )
+    finally:
+        qr_batch_users.discard(user_id)
+
+async def process_qr_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Прием файла для пакетной генерации QR-кодов"""
+    user_id = update.effective_user.id
+    try:
+        if update.message.text == "Назад":
+            await update.message.reply_text(
+                "Выберите тип QR-кода:",
+                reply_markup=get_qr_type_keyboard()
+            )
+            return QR_TYPE
+
+        document = update.message.document
+        if not document:
+            await update.message.reply_text("Пожалуйста, отправьте CSV или TXT файл.")
+            return QR_BATCH
+
+        if not (document.file_name or '').lower().endswith(('.csv', '.txt')):
+            await update.message.reply_text("Поддерживаются только файлы .csv и .txt")
+            return QR_BATCH
+
+        if document.file_size and document.file_size > QR_BATCH_MAX_FILE_SIZE:
+            await update.message.reply_text(
+                f"Файл слишком большой. Максимальный размер: {QR_BATCH_MAX_FILE_SIZE // 1024} КБ"
+            )
+            return QR_BATCH
+
+        if user_id in qr_batch_users:
+            await update.message.reply_text("Дождитесь завершения предыдущей пакетной генерации.")
+            return QR_BATCH
+
+        file = await context.bot.get_file(document.file_id)
+        content = bytes(await file.download_as_bytearray())
+        for encoding in ('utf-8-sig', 'windows-1251'):
+            try:
+                text = content.decode(encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            await update.message.reply_text("Не удалось определить кодировку файла. Используйте UTF-8.")
+            return QR_BATCH
+
+        rows, errors = parse_qr_batch(text)
+        if not rows:
+            await update.message.reply_text("В файле нет строк для создания QR-кодов.")
+            return QR_BATCH
+
+        if len(rows) > QR_BATCH_MAX_ROWS:
+            await update.message.reply_text(
+                f"Слишком много строк: {len(rows)}. Максимум за один раз: {QR_BATCH_MAX_ROWS}"
+            )
+            return QR_BATCH
+
+        # Содержимое формируется сразу: строки с неверным форматом попадают в отчет
+        jobs = []
+        for index, qr_type, fields in rows:
+            if qr_type not in QR_BATCH_TYPES:
+                errors.append(f"Строка {index}: неизвестный тип {qr_type}")
+                continue
+            try:
+                jobs.append((index, qr_type, build_qr_content(qr_type, fields)))
+            except ValueError:
+                errors.append(f"Строка {index}: неверные данные для типа {qr_type}")
+
+        if not jobs:
+            report = "\n".join(errors[:QR_BATCH_MAX_ERRORS_SHOWN])
+            await update.message.reply_text(f"Ни одна строка не подошла для создания QR-кода:\n{report}")
+            return QR_BATCH
+
+        # Рендеринг идет в фоне, чтобы не задерживать обработку других обновлений
+        qr_batch_users.add(user_id)
+        context.application.create_task(
+            run_qr_batch(update.message, user_id, jobs, errors),
+            update=update
+        )
+        await update.message.reply_text(
+            f"Файл принят: {len(jobs)} QR-кодов. Архив придет отдельным сообщением.",
+            reply_markup=get_menu_keyboard(user_id)
+        )
+        context.user_data.clear()
+        return MENU
+
+    except Exception as e:
+        qr_batch_users.discard(user_id)
+        error_message = f"Ошибка при пакетной генерации QR-кодов: {str(e)}"
+        await log_error(user_id, error_message)
+        await update.message.reply_text(
+            "Произошла ошибка. Пожалуйста, проверьте файл и попробуйте снова.",
+            reply_markup=get_qr_type_keyboard()
+        )
+        return QR_TYPE
 
 async def get_user_role(user_id):
     """Получение роли пользователя"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-        result = await cursor.fetchone()
-    return result[0] if result else UserRole.USER
+    return (await get_user_profile(user_id))['role'] or UserRole.USER
 
 async def check_admin_rights(user_id):
     """Проверка прав администратора"""
@@ -1222,42 +1772,39 @@ async def generate_temp_link_id():
     while True:
         link_id = ''.join(random.choice(chars) for _ in range(4))
         # Проверяем, не существует ли уже такой ID
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute('SELECT COUNT(*) FROM temp_links WHERE link_id = ?', (link_id,))
-            count = await cursor.fetchone()
-            if count[0] == 0:
-                return link_id
+        count = await db_fetchone('SELECT COUNT(*) FROM temp_links WHERE link_id = ?', (link_id,))
+        if count[0] == 0:
+            return link_id
 
 async def save_temp_link(file_path, original_name, duration_hours, user_id):
     """Сохранение информации о временной ссылке"""
     try:
         link_id = await generate_temp_link_id()
         
-        # Создаем дату без микросекунд
-        expires_dt = datetime.now() + timedelta(hours=duration_hours)
-        expires_at = expires_dt.strftime('%Y-%m-%d %H:%M:%S')  # Форматирование без микросекунд
+        created_at = int(time.time())
+        expires_at = created_at + duration_hours * 3600
         
-        async with aiosqlite.connect(DB_PATH) as conn:
-            try:
-                # Создаем запись о временной ссылке
-                await conn.execute('''
-                    INSERT INTO temp_links (link_id, expires_at, user_id, extension_count)
-                    VALUES (?, ?, ?, 0)
-                ''', (link_id, expires_at, user_id))
-                
-                # Добавляем информацию о файле
-                await conn.execute('''
-                    INSERT INTO temp_link_files (link_id, file_path, original_name)
-                    VALUES (?, ?, ?)
-                ''', (link_id, file_path, original_name))
-                
-                await conn.commit()
-                return link_id
-                
-            except sqlite3.Error as e:
-                error_message = f"Ошибка базы данных при сохранении временной ссылки: {str(e)}"
-                await log_error(None, error_message)
-                raise
+        def _insert_link(conn):
+            # Создаем запись о временной ссылке
+            conn.execute('''
+                INSERT INTO temp_links (link_id, expires_at, user_id, created_at, extension_count)
+                VALUES (?, ?, ?, ?, 0)
+            ''', (link_id, expires_at, user_id, created_at))
+            
+            # Добавляем информацию о файле
+            conn.execute('''
+                INSERT INTO temp_link_files (link_id, file_path, original_name)
+                VALUES (?, ?, ?)
+            ''', (link_id, file_path, original_name))
+
+        try:
+            await db_transaction(_insert_link)
+            return link_id
+            
+        except sqlite3.Error as e:
+            error_message = f"Ошибка базы данных при сохранении временной ссылки: {str(e)}"
+            await log_error(None, error_message)
+            raise
                 
     except Exception as e:
         error_message = f"Критическая ошибка при сохранении временной ссылки: {str(e)}"
@@ -1267,119 +1814,100 @@ async def save_temp_link(file_path, original_name, duration_hours, user_id):
 async def get_temp_link_info(link_id):
     """Получение информации о временной ссылке"""
     try:
-        # Получаем текущее московское время
-        import pytz
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        now = datetime.now(moscow_tz)
-        current_time = now.strftime('%Y-%m-%d %H:%M:%S')
+        # Получаем информацию о ссылке, если срок ее действия не истек
+        result = await db_fetchone('SELECT expires_at FROM temp_links WHERE link_id = ? AND expires_at > ?',
+                                   (link_id, int(time.time())))
         
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # Получаем информацию о ссылке
-            cursor = await conn.execute('SELECT expires_at FROM temp_links WHERE link_id = ?', (link_id,))
-            result = await cursor.fetchone()
-            
-            if not result:
-                return None
-                
-            expires_at = result[0]
+        if not result:
+            return None
             
-            # Очищаем дату от микросекунд, если они есть
-            clean_expires_at = expires_at
-            if '.' in expires_at:
-                clean_expires_at = expires_at.split('.')[0]
-                
-            # Проверяем, не истек ли срок действия
-            if clean_expires_at <= current_time:
-                logger.info(f"Ссылка {link_id} истекла ({clean_expires_at} <= {current_time})")
-                return None
-            
-            # Получаем список файлов
-            cursor = await conn.execute('''
-                SELECT file_path, original_name
-                FROM temp_link_files
-                WHERE link_id = ?
-            ''', (link_id,))
-            
-            files = await cursor.fetchall()
-            
-            return {
-                'expires_at': clean_expires_at,
-                'files': files
-            }
+        expires_at = result[0]
+        
+        # Получаем список файлов
+        files = await db_fetchall('''
+            SELECT file_path, original_name
+            FROM temp_link_files
+            WHERE link_id = ?
+        ''', (link_id,))
+        
+        return {
+            'expires_at': expires_at,
+            'files': files
+        }
     except Exception as e:
         logger.error(f"Ошибка при получении информации о ссылке {link_id}: {e}")
         return None
 
+EXPIRY_CLEANUP_JOB = 'cleanup_expired_links'
+EXPIRY_CLEANUP_MAX_INTERVAL = 3600  # Не реже раза в час: сроки могут меняться и в веб-сервере
+EXPIRY_DELETE_BATCH_SIZE = 200  # Сколько истекших ссылок удалять в одной транзакции
+
+def schedule_expiry_cleanup(job_queue, expires_at=None):
+    """Планирует очистку истекших ссылок на ближайший срок действия.
+
+    Уже запланированный запуск переносится, только если новый срок раньше него.
+    Без expires_at очистка планируется через EXPIRY_CLEANUP_MAX_INTERVAL.
+    """
+    if job_queue is None:
+        return
+    delay = EXPIRY_CLEANUP_MAX_INTERVAL
+    if expires_at is not None:
+        delay = min(delay, max(expires_at - time.time(), 0))
+    run_at = time.time() + delay
+
+    for job in job_queue.get_jobs_by_name(EXPIRY_CLEANUP_JOB):
+        if job.next_t is not None and job.next_t.timestamp() <= run_at:
+            return
+        job.schedule_removal()
+    job_queue.run_once(cleanup_expired_links, when=delay, name=EXPIRY_CLEANUP_JOB)
+
 async def cleanup_expired_links(context=None):
-    """Очистка истекших временных ссылок"""
+    """Очистка истекших временных ссылок.
+
+    Истекшие записи выбираются диапазонным запросом по индексу
+    idx_temp_links_expires_at и удаляются пакетами в одной транзакции.
+    Следующий запуск планируется ровно на ближайший оставшийся срок.
+    """
+    next_expires_at = None
     try:
         # Проверяем и создаем директорию для временных ссылок
         if not os.path.exists(TEMP_LINKS_DIR):
             os.makedirs(TEMP_LINKS_DIR)
             logger.info(f"Создана директория для временных ссылок: {TEMP_LINKS_DIR}")
         
-        # Получаем текущее московское время
-        import pytz
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        now = datetime.now(moscow_tz)
-        current_time = now.strftime('%Y-%m-%d %H:%M:%S')
-        
-        logger.info(f"Очистка истекших ссылок, текущее время (Москва): {current_time}")
+        current_time = int(time.time())
+        logger.info(f"Очистка истекших ссылок, текущее время (Москва): {format_datetime(current_time)}")
             
-        async with aiosqlite.connect(DB_PATH) as conn:
-            try:
-                # Получаем список всех ссылок для проверки
-                cursor = await conn.execute('SELECT link_id, expires_at FROM temp_links')
-                all_links = await cursor.fetchall()
-                
-                expired_links = []
-                for link in all_links:
-                    link_id, expires_at = link
-                    
-                    # Очищаем дату от микросекунд, если они есть
-                    clean_expires_at = expires_at
-                    if '.' in expires_at:
-                        clean_expires_at = expires_at.split('.')[0]
-                    
-                    # Проверяем, истек ли срок действия
-                    if clean_expires_at <= current_time:
-                        expired_links.append((link_id,))
-                        logger.info(f"Найдена истекшая ссылка {link_id}, срок действия до: {clean_expires_at}")
-                
-                logger.info(f"Найдено {len(expired_links)} истекших ссылок")
-                
-                # Удаляем файлы и записи из базы данных
-                for link_id in expired_links:
-                    # Получаем список файлов для удаления
-                    cursor = await conn.execute('SELECT file_path FROM temp_link_files WHERE link_id = ?', (link_id[0],))
-                    files = await cursor.fetchall()
-                    
-                    # Удаляем файлы
-                    for file_path in files:
-                        try:
-                            if os.path.exists(file_path[0]):
-                                os.remove(file_path[0])
-                                logger.info(f"Удален файл: {file_path[0]}")
-                        except Exception as e:
-                            error_message = f"Ошибка при удалении файла {file_path[0]}: {str(e)}"
-                            logger.error(error_message)
-                    
-                    # Удаляем записи из базы данных
-                    await conn.execute('DELETE FROM temp_link_files WHERE link_id = ?', (link_id[0],))
-                    await conn.execute('DELETE FROM temp_links WHERE link_id = ?', (link_id[0],))
-                    logger.info(f"Удалены записи о хранилище {link_id[0]} из базы данных")
-                
-                await conn.commit()
-                
-            except sqlite3.Error as e:
-                await conn.rollback()
-                error_message = f"Ошибка базы данных при очистке истекших ссылок: {str(e)}"
-                logger.error(error_message)
+        try:
+            # Истекшие ссылки берем по индексу
+            rows = await db_fetchall('SELECT link_id FROM temp_links WHERE expires_at <= ? ORDER BY expires_at',
+                                     (current_time,))
+            expired_links = [row[0] for row in rows]
+            
+            logger.info(f"Найдено {len(expired_links)} истекших ссылок")
+            
+            for start in range(0, len(expired_links), EXPIRY_DELETE_BATCH_SIZE):
+                batch = expired_links[start:start + EXPIRY_DELETE_BATCH_SIZE]
+                # Записи, файлы и блобы удаляются так же, как при удалении хранилища пользователем
+                await delete_storages(batch)
+                logger.info(f"Удалено {len(batch)} истекших хранилищ")
+
+            next_expires_at = (await db_fetchone('SELECT MIN(expires_at) FROM temp_links'))[0]
+            
+        except sqlite3.Error as e:
+            error_message = f"Ошибка базы данных при очистке истекших ссылок: {str(e)}"
+            logger.error(error_message)
             
     except Exception as e:
         error_message = f"Критическая ошибка при очистке истекших ссылок: {str(e)}"
         logger.error(error_message)
 
+    if context is not None:
+        try:
+            schedule_expiry_cleanup(context.job_queue, next_expires_at)
+        except Exception as e:
+            logger.error(f"Ошибка при планировании очистки истекших ссылок: {str(e)}")
+
 async def process_temp_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка создания временной ссылки"""
     try:
@@ -1477,16 +2005,16 @@ async def process_temp_link_duration(update: Update, context: ContextTypes.DEFAU
         
         # Создаем временное хранилище
         link_id = await generate_temp_link_id()
-        expires_at = datetime.now() + timedelta(hours=duration_hours)
+        created_at = int(time.time())
+        expires_at = created_at + duration_hours * 3600
         
         # Создаем запись о временном хранилище
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''
-                INSERT INTO temp_links (link_id, expires_at, user_id, created_at, extension_count)
-                VALUES (?, ?, ?, datetime('now'), 0)
-            ''', (link_id, expires_at, update.effective_user.id))
-            
-            await conn.commit()
+        await db_execute('''
+            INSERT INTO temp_links (link_id, expires_at, user_id, created_at, extension_count)
+            VALUES (?, ?, ?, ?, 0)
+        ''', (link_id, expires_at, update.effective_user.id, created_at))
+        notify_storage_changed()
+        schedule_expiry_cleanup(context.job_queue, expires_at)
         
         # Формируем URL для доступа к хранилищу
         storage_url = f"{TEMP_LINK_DOMAIN}/{link_id}"
@@ -1544,18 +2072,14 @@ async def extend_storage_duration(update: Update, context: ContextTypes.DEFAULT_
             markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
             
             # Получаем информацию о хранилище
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute('SELECT expires_at, extension_count FROM temp_links WHERE link_id = ? AND user_id = ?', 
-                     (link_id, update.effective_user.id))
-            result = c.fetchone()
+            result = await db_fetchone('SELECT expires_at, extension_count FROM temp_links WHERE link_id = ? AND user_id = ?',
+                                       (link_id, update.effective_user.id))
             
             if not result:
                 await update.message.reply_text(
                     "Хранилище не найдено или уже удалено.", 
                     reply_markup=get_menu_keyboard(update.effective_user.id)
                 )
-                conn.close()
                 return MENU
                 
             expires_at, extension_count = result
@@ -1568,19 +2092,14 @@ async def extend_storage_duration(update: Update, context: ContextTypes.DEFAULT_
                     f"Достигнут лимит продлений хранилища (максимум {max_extensions}). Создайте новое хранилище.", 
                     reply_markup=get_menu_keyboard(update.effective_user.id)
                 )
-                conn.close()
                 return MENU
                 
-            # Разбираем дату
-            current_expires_at = datetime.strptime(format_datetime(expires_at), '%Y-%m-%d %H:%M:%S')
-            
             # Проверяем, не истек ли срок хранилища
-            if current_expires_at <= datetime.now():
+            if expires_at <= time.time():
                 await update.message.reply_text(
                     "Срок действия хранилища уже истек. Создайте новое хранилище.", 
                     reply_markup=get_menu_keyboard(update.effective_user.id)
                 )
-                conn.close()
                 return MENU
 
             duration_map = {
@@ -1595,12 +2114,12 @@ async def extend_storage_duration(update: Update, context: ContextTypes.DEFAULT_
             }
             # Рассчитываем новый срок действия
             duration_hours = duration_map[update.message.text]
-            new_expires_at = current_expires_at + timedelta(hours=duration_hours)
+            new_expires_at = expires_at + duration_hours * 3600
             
             # Обновляем срок действия и счетчик продлений в базе данных
-            c.execute('UPDATE temp_links SET expires_at = ?, extension_count = extension_count + 1 WHERE link_id = ?', 
-                     (new_expires_at, link_id))
-            conn.commit()
+            await db_execute('UPDATE temp_links SET expires_at = ?, extension_count = extension_count + 1 WHERE link_id = ?',
+                             (new_expires_at, link_id))
+            notify_storage_changed()
             
             # Форматируем текст о сроке продления
             duration_text = ""
@@ -1669,18 +2188,14 @@ async def extend_storage_duration(update: Update, context: ContextTypes.DEFAULT_
             return MENU
             
         # Получаем текущий срок действия
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT expires_at, extension_count FROM temp_links WHERE link_id = ? AND user_id = ?', 
-                 (link_id, update.effective_user.id))
-        result = c.fetchone()
+        result = await db_fetchone('SELECT expires_at, extension_count FROM temp_links WHERE link_id = ? AND user_id = ?',
+                                   (link_id, update.effective_user.id))
         
         if not result:
             await update.message.reply_text(
                 "Хранилище не найдено или уже удалено.", 
                 reply_markup=get_menu_keyboard(update.effective_user.id)
             )
-            conn.close()
             return MENU
             
         expires_at, extension_count = result
@@ -1693,29 +2208,24 @@ async def extend_storage_duration(update: Update, context: ContextTypes.DEFAULT_
                 f"Достигнут лимит продлений хранилища (максимум {max_extensions}). Создайте новое хранилище.", 
                 reply_markup=get_menu_keyboard(update.effective_user.id)
             )
-            conn.close()
             return MENU
             
-        # Разбираем дату
-        current_expires_at = datetime.strptime(format_datetime(expires_at), '%Y-%m-%d %H:%M:%S')
-        
         # Проверяем, не истек ли срок хранилища
-        if current_expires_at <= datetime.now():
+        if expires_at <= time.time():
             await update.message.reply_text(
                 "Срок действия хранилища уже истек. Создайте новое хранилище.", 
                 reply_markup=get_menu_keyboard(update.effective_user.id)
             )
-            conn.close()
             return MENU
             
         # Рассчитываем новый срок действия
         duration_hours = duration_map[update.message.text]
-        new_expires_at = current_expires_at + timedelta(hours=duration_hours)
+        new_expires_at = expires_at + duration_hours * 3600
         
         # Обновляем срок действия и счетчик продлений в базе данных
-        c.execute('UPDATE temp_links SET expires_at = ?, extension_count = extension_count + 1 WHERE link_id = ?', 
-                 (new_expires_at, link_id))
-        conn.commit()
+        await db_execute('UPDATE temp_links SET expires_at = ?, extension_count = extension_count + 1 WHERE link_id = ?',
+                         (new_expires_at, link_id))
+        notify_storage_changed()
         
         # Форматируем текст о сроке продления
         duration_text = ""
@@ -1753,8 +2263,6 @@ async def extend_storage_duration(update: Update, context: ContextTypes.DEFAULT_
         return TEMP_LINK
         
     except Exception as e:
-        if 'conn' in locals():
-            conn.rollback()
         error_message = f"Ошибка при продлении срока хранилища: {str(e)}"
         logger.error(error_message)
         
@@ -1763,10 +2271,6 @@ async def extend_storage_duration(update: Update, context: ContextTypes.DEFAULT_
             reply_markup=get_menu_keyboard(update.effective_user.id)
         )
         return MENU
-        
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 async def delete_user_storage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Удаление временного хранилища пользователя"""
@@ -1816,28 +2320,20 @@ async def delete_user_storage(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         # Проверяем существование хранилища
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''
+        storage = await db_fetchone('''
             SELECT link_id FROM temp_links 
             WHERE link_id = ? AND user_id = ?
         ''', (link_id, update.effective_user.id))
         
-        if not c.fetchone():
+        if not storage:
             await update.message.reply_text(
                 "Хранилище не найдено или уже удалено.", 
                 reply_markup=get_menu_keyboard(update.effective_user.id)
             )
             return MENU
         
-        # Удаляем файлы хранилища
-        storage_path = os.path.join(BOT_DIR, 'temp_storage', link_id)
-        if os.path.exists(storage_path):
-            shutil.rmtree(storage_path)
-        
-        # Удаляем запись из базы данных
-        c.execute('DELETE FROM temp_links WHERE link_id = ?', (link_id,))
-        conn.commit()
+        # Удаляем хранилище вместе с учетом места, индексом файлов и ссылками на блобы
+        await delete_storages([link_id])
         
         await update.message.reply_text(
             "✅ Хранилище успешно удалено!", 
@@ -1847,8 +2343,6 @@ async def delete_user_storage(update: Update, context: ContextTypes.DEFAULT_TYPE
         return MENU
         
     except Exception as e:
-        if 'conn' in locals():
-            conn.rollback()
         error_message = f"Ошибка при удалении хранилища: {str(e)}"
         logger.error(error_message)
         
@@ -1857,77 +2351,121 @@ async def delete_user_storage(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_markup=get_menu_keyboard(update.effective_user.id)
         )
         return MENU
-        
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
-def get_user_lines_to_keep(user_id):
+async def get_user_lines_to_keep(user_id):
     """Получение количества строк для пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute('SELECT lines_to_keep FROM user_settings WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        if not result:
-            c.execute('SELECT lines_to_keep FROM bot_status WHERE id = 1')
-            result = c.fetchone()
-        return result[0] if result else 10
-    finally:
-        conn.close()
+    lines_to_keep = (await get_user_profile(user_id))['lines_to_keep']
+    if lines_to_keep is None:
+        lines_to_keep = (await get_bot_status())['lines_to_keep']
+    return lines_to_keep
 
-def get_lines_to_keep():
+async def get_lines_to_keep():
     """Получение глобального количества строк"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT lines_to_keep FROM bot_status WHERE id = 1')
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else 10
-
-def set_lines_to_keep(lines):
-    """Установка глобального количества строк"""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute('UPDATE bot_status SET lines_to_keep = ? WHERE id = 1', (lines,))
-        conn.commit()
-    finally:
-        conn.close()
+    return (await get_bot_status())['lines_to_keep']
 
-def get_all_users():
-    """Получение списка всех пользователей"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''SELECT user_id, username, is_verified, role, 
-                 usage_count, merged_count, qr_count, is_banned FROM users''')
-    users = c.fetchall()
-    conn.close()
-    return users
+async def set_lines_to_keep(lines):
+    """Установка глобального количества строк"""
+    await db_execute('UPDATE bot_status SET lines_to_keep = ? WHERE id = 1', (lines,))
+    user_profile_cache.invalidate_bot_status()
 
 async def get_all_users_async():
-    """Получение списка всех пользователей"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute('''SELECT user_id, username, is_verified, role, 
+    """Получение списка всех пользователей (счетчики с учетом неотправленных приращений)"""
+    async with usage_counters.lock:
+        users = await db_fetchall('''SELECT user_id, username, is_verified, role, 
                  usage_count, merged_count, qr_count, is_banned FROM users''')
-        users = await cursor.fetchall()
-    return users
+        pending = {user[0]: usage_counters.pending(user[0]) for user in users}
+    return [
+        user[:4] + tuple(count + pending[user[0]].get(column, 0)
+                         for count, column in zip(user[4:7], UsageCounters.COLUMNS)) + user[7:]
+        for user in users
+    ]
 
 async def remove_user(user_id):
     """Удаление пользователя из базы данных"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-        await conn.execute('DELETE FROM user_settings WHERE user_id = ?', (user_id,))
-        await conn.commit()
+    def _remove(conn):
+        conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM user_settings WHERE user_id = ?', (user_id,))
+
+    await db_transaction(_remove)
+    user_profile_cache.invalidate(user_id)
+
+FILE_SCAN_CHUNK_SIZE = 1024 * 1024  # Размер блока при потоковом чтении загруженного файла
+TAIL_SCAN_BLOCK_SIZE = 64 * 1024  # Начальный размер блока при чтении файла с конца
+LINE_BREAKS = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'  # Разделители строк str.splitlines()
+
+def scan_text_file(f, max_lines=MAX_LINKS):
+    """Определяет кодировку двоичного файла f и считает его непустые строки за один проход.
+
+    Файл читается блоками, строки считаются так же, как
+    [line for line in text.splitlines() if line.strip()]. Как только строк
+    становится больше max_lines, подсчет прекращается и файл только проверяется
+    на корректность кодировки. Возвращает (encoding, count) или (None, 0),
+    если файл не читается ни в UTF-8, ни в Windows-1251.
+    """
+    for encoding in ('utf-8', 'windows-1251'):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        count = 0
+        line_has_text = False  # Есть ли непробельные символы в незавершенной строке
+        f.seek(0)
+        try:
+            while True:
+                chunk = f.read(FILE_SCAN_CHUNK_SIZE)
+                text = decoder.decode(chunk, final=not chunk)
+                if text and count <= max_lines:
+                    lines = text.splitlines()
+                    first_has_text = line_has_text or bool(lines[0].strip())
+                    if text[-1] in LINE_BREAKS:
+                        complete = lines
+                        line_has_text = False
+                    else:
+                        complete = lines[:-1]
+                        line_has_text = bool(lines[-1].strip()) if complete else first_has_text
+                    if complete:
+                        count += first_has_text + sum(map(bool, map(str.strip, complete[1:])))
+                if not chunk:
+                    break
+            if line_has_text and count <= max_lines:
+                count += 1
+            return encoding, count
+        except UnicodeDecodeError:
+            continue
+    return None, 0
+
+def read_tail_lines(f, encoding, count):
+    """Последние count непустых строк двоичного файла f (после strip), прочитанные с конца.
+
+    Блоки читаются с конца файла, пока после первого найденного '\n' не
+    наберется count непустых строк; декодируется только этот хвост. Байт '\n'
+    в UTF-8 и Windows-1251 не встречается внутри других символов, поэтому
+    позиция после него всегда является началом строки.
+    """
+    position = f.seek(0, os.SEEK_END)
+    block_size = TAIL_SCAN_BLOCK_SIZE
+    blocks = []
+    while True:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        blocks.append(f.read(read_size))
+        block_size *= 2
+        tail = b''.join(reversed(blocks))
+        start = 0
+        if position > 0:
+            start = tail.find(b'\n') + 1
+            if not start:
+                continue
+        lines = [line.strip() for line in tail[start:].decode(encoding).splitlines() if line.strip()]
+        if len(lines) >= count or position == 0:
+            return lines[-count:]
 
 async def process_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка файла"""
     # Проверяем верификацию пользователя и статус бота
-    if not is_bot_enabled() and not is_admin(update.effective_user.id):
+    if not await is_bot_enabled() and not await is_admin(update.effective_user.id):
         await update.message.reply_text("Бот находится на техническом обслуживании. Пожалуйста, подождите.")
         return MENU
     
-    if not is_user_verified(update.effective_user.id):
+    if not await is_user_verified(update.effective_user.id):
         await update.message.reply_text(
             "Пожалуйста, пройдите верификацию с помощью команды /start"
         )
@@ -1956,65 +2494,56 @@ async def process_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return PROCESS_FILE
 
-        # Скачиваем файл
+        # Скачиваем файл в буфер (большие файлы уходят во временный файл)
         file = await context.bot.get_file(document.file_id)
-        downloaded_file = await file.download_as_bytearray()
-        
-        try:
-            content = downloaded_file.decode('utf-8')
-        except UnicodeDecodeError:
-            try:
-                content = downloaded_file.decode('windows-1251')
-            except UnicodeDecodeError:
+        with new_spooled_buffer() as upload:
+            await file.download_to_memory(upload)
+            
+            # Кодировка и число непустых строк — потоковым проходом по файлу
+            encoding, lines_count = await asyncio.to_thread(scan_text_file, upload)
+            if encoding is None:
                 await update.message.reply_text(
                     "Ошибка при чтении файла. Убедитесь, что файл в кодировке UTF-8 или Windows-1251."
                 )
                 return PROCESS_FILE
 
-        # Получаем строки из файла
-        lines = [line.strip() for line in content.splitlines() if line.strip()]
-        
-        # Проверка количества строк
-        if len(lines) > MAX_LINKS:
-            await update.message.reply_text(
-                f"Слишком много строк в файле. Максимально допустимо: {MAX_LINKS}"
-            )
-            return PROCESS_FILE
+            # Проверка количества строк
+            if lines_count > MAX_LINKS:
+                await update.message.reply_text(
+                    f"Слишком много строк в файле. Максимально допустимо: {MAX_LINKS}"
+                )
+                return PROCESS_FILE
 
-        if not lines:
-            await update.message.reply_text(
-                "Файл пуст или не содержит текстовых строк."
-            )
-            return PROCESS_FILE
+            if not lines_count:
+                await update.message.reply_text(
+                    "Файл пуст или не содержит текстовых строк."
+                )
+                return PROCESS_FILE
 
-        # Получаем количество строк для конкретного пользователя
-        lines_to_keep = get_user_lines_to_keep(update.effective_user.id)
-        
-        # Берем последние N строк
-        last_lines = lines[-lines_to_keep:]
-        
-        # Создаем имя выходного файла на основе оригинального имени
+            # Получаем количество строк для конкретного пользователя
+            lines_to_keep = await get_user_lines_to_keep(update.effective_user.id)
+            
+            # Берем последние N строк, декодируя только конец файла
+            last_lines = await asyncio.to_thread(read_tail_lines, upload, encoding, lines_to_keep)
+
+        # Имя отправляемого файла на основе оригинального имени
         original_name = os.path.splitext(document.file_name)[0]  # Получаем имя без расширения
-        output_filename = os.path.join(TEMP_DIR, f'{original_name}_{update.effective_user.id}.html')
         
-        try:
-            with open(output_filename, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(last_lines))
-            
-            # Отправляем файл
-            with open(output_filename, 'rb') as f:
-                await context.bot.send_document(
-                    chat_id=update.effective_chat.id,
-                    document=f,
-                    filename=f'{original_name}.html',
-                    caption=f"Найдено {len(lines)} строк. Показаны последние {lines_to_keep}."
-                )
-            # Увеличиваем счетчик после успешной отправки
-            await increment_usage_count(update.effective_user.id)
-        finally:
-            # Удаляем временный файл
-            if os.path.exists(output_filename):
-                os.remove(output_filename)
+        # Собираем результат в буфере и отправляем без промежуточного файла
+        with new_spooled_buffer(f'{original_name}.html') as buffer:
+            for index, line in enumerate(last_lines):
+                if index:
+                    buffer.write(b'\n')
+                buffer.write(line.encode('utf-8'))
+            buffer.seek(0)
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=buffer,
+                filename=f'{original_name}.html',
+                caption=f"Найдено {lines_count} строк. Показаны последние {lines_to_keep}."
+            )
+        # Увеличиваем счетчик после успешной отправки
+        await increment_usage_count(update.effective_user.id)
         
         # Возвращаемся в главное меню
         await show_menu(update, context)
@@ -2031,107 +2560,91 @@ async def process_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def increment_usage_count(user_id):
     """Увеличение счетчика использования бота"""   
-    conn = await safe_db_connect()
-    if not conn:
-        return
-    try:
-        await conn.execute('UPDATE users SET usage_count = usage_count + 1 WHERE user_id = ?', (user_id,))
-        await conn.commit()
-    except sqlite3.Error as e:
-            print(f"Ошибка при обновлении счетчика использования: {e}")
+    usage_counters.add(user_id, 'usage_count')
 
 async def get_user_active_storage(user_id,settings_flag=False):
     """Получение активных временных ссылок пользователя"""
     try:
-        # Получаем текущее московское время в формате без микросекунд
-        import pytz
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        now = datetime.now(moscow_tz)
-        current_time = now.strftime('%Y-%m-%d %H:%M:%S')
+        current_time = int(time.time())
         
-        logger.info(f"Получение хранилищ пользователя {user_id}, текущее время (Москва): {current_time}")
+        logger.info(f"Получение хранилищ пользователя {user_id}, текущее время (Москва): {format_datetime(current_time)}")
         
         # Проверяем, является ли пользователь администратором
-        is_user_admin = is_admin(user_id)
+        is_user_admin = await is_admin(user_id)
         
-        async with aiosqlite.connect(DB_PATH) as conn:
+        def _load_storages(conn):
             # Если пользователь - админ, получаем все хранилища, иначе только его собственные
             if is_user_admin and settings_flag:
-                cursor = await conn.execute('''
+                rows = conn.execute('''
                     SELECT tl.link_id, tl.expires_at, COUNT(tlf.file_id) as file_count, tl.user_id, u.username
                     FROM temp_links tl
                     LEFT JOIN temp_link_files tlf ON tl.link_id = tlf.link_id
                     LEFT JOIN users u ON tl.user_id = u.user_id
+                    WHERE tl.expires_at > ?
                     GROUP BY tl.link_id
                     ORDER BY tl.expires_at ASC
-                ''')
+                ''', (current_time,)).fetchall()
             else:
-                cursor = await conn.execute('''
+                rows = conn.execute('''
                     SELECT tl.link_id, tl.expires_at, COUNT(tlf.file_id) as file_count, tl.user_id, u.username
                     FROM temp_links tl
                     LEFT JOIN temp_link_files tlf ON tl.link_id = tlf.link_id
                     LEFT JOIN users u ON tl.user_id = u.user_id
-                    WHERE tl.user_id = ?
+                    WHERE tl.user_id = ? AND tl.expires_at > ?
                     GROUP BY tl.link_id
                     ORDER BY tl.expires_at ASC
-                ''', (user_id,))
-            result = await cursor.fetchall()
-            
-            # Получаем детали по каждой ссылке
-            storage_list = []
-            for link_id, expires_at, file_count, creator_id, creator_username in result:
-                # Очищаем дату от микросекунд, если они есть
-                clean_expires_at = expires_at
-                if '.' in expires_at:
-                    clean_expires_at = expires_at.split('.')[0]
-                
-                # Проверяем, не истек ли срок действия
-                if clean_expires_at <= current_time:
-                    logger.info(f"Хранилище {link_id} истекло ({clean_expires_at} <= {current_time})")
-                    continue
-                
-                # Получаем имена файлов
-                cursor = await conn.execute('''
+                ''', (user_id, current_time)).fetchall()
+
+            # Получаем имена файлов каждой ссылки в том же обращении к потоку БД
+            return [
+                (row, conn.execute('''
                     SELECT original_name 
                     FROM temp_link_files 
                     WHERE link_id = ?
-                ''', (link_id,))
-                
-                files = await cursor.fetchall()
-                file_names = [file[0] for file in files]
-                
-                # Форматируем оставшееся время
-                expires_date = datetime.strptime(clean_expires_at, '%Y-%m-%d %H:%M:%S')
-                time_left = expires_date - now.replace(tzinfo=None)
-                days = time_left.days
-                hours, remainder = divmod(time_left.seconds, 3600)
-                minutes, _ = divmod(remainder, 60)
-                
-                time_str = f"{days}д {hours}ч {minutes}м" if days > 0 else f"{hours}ч {minutes}м"
-                
-                # Определяем имя создателя
-                creator_name = creator_username or f"ID: {creator_id}"
-                
-                storage_list.append({
-                    'link_id': link_id,
-                    'expires_at': clean_expires_at,
-                    'file_count': file_count,
-                    'file_names': file_names,
-                    'time_left': time_str,
-                    'creator_id': creator_id,
-                    'creator_name': creator_name
-                })
-                
-                logger.info(f"Найдено активное хранилище {link_id}, срок действия до: {clean_expires_at}, создатель: {creator_name}")
+                ''', (row[0],)).fetchall())
+                for row in rows
+            ]
+
+        result = await db_transaction(_load_storages)
+        
+        # Получаем детали по каждой ссылке (истекшие отсеяны запросом)
+        storage_list = []
+        for (link_id, expires_at, file_count, creator_id, creator_username), files in result:
+            file_names = [file[0] for file in files]
+            
+            # Форматируем оставшееся время
+            time_left = timedelta(seconds=expires_at - current_time)
+            days = time_left.days
+            hours, remainder = divmod(time_left.seconds, 3600)
+            minutes, _ = divmod(remainder, 60)
             
-            return storage_list
+            time_str = f"{days}д {hours}ч {minutes}м" if days > 0 else f"{hours}ч {minutes}м"
+            
+            # Определяем имя создателя
+            creator_name = creator_username or f"ID: {creator_id}"
+            
+            storage_list.append({
+                'link_id': link_id,
+                'expires_at': expires_at,
+                'file_count': file_count,
+                'file_names': file_names,
+                'time_left': time_str,
+                'creator_id': creator_id,
+                'creator_name': creator_name
+            })
+            
+            logger.info(f"Найдено активное хранилище {link_id}, срок действия до: {format_datetime(expires_at)}, создатель: {creator_name}")
+        
+        return storage_list
             
     except Exception as e:
         logger.error(f"Ошибка при получении списка хранилища: {e}")
         return []
 
 def format_datetime(dt):
-    """Форматирование даты без миллисекунд"""
+    """Форматирование даты без миллисекунд (epoch выводится по московскому времени)"""
+    if isinstance(dt, (int, float)):
+        return datetime.fromtimestamp(dt, pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
     if isinstance(dt, str):
         if '.' in dt:
             dt = dt.split('.')[0]
@@ -2163,14 +2676,11 @@ async def show_storage_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
             creator_name = storage['creator_name']
             
             # Получаем количество продлений для этого хранилища
-            async with aiosqlite.connect(DB_PATH) as conn:
-                cursor = await conn.execute('SELECT extension_count FROM temp_links WHERE link_id = ?', 
-                    (link_id,))
-                result = await cursor.fetchone()
-                extension_count = result[0] if result and result[0] is not None else 0
-                # Максимум 1 продление
-                max_extensions = 1  # Максимально допустимое количество продлений
-                extensions_left = max_extensions - extension_count
+            result = await db_fetchone('SELECT extension_count FROM temp_links WHERE link_id = ?', (link_id,))
+            extension_count = result[0] if result and result[0] is not None else 0
+            # Максимум 1 продление
+            max_extensions = 1  # Максимально допустимое количество продлений
+            extensions_left = max_extensions - extension_count
             
             # Добавляем информацию о создателе в текст кнопки
             storage_text = f"Хранилище {link_id[:8]}... ({file_count} файлов, {time_left}) от {creator_name}"
@@ -2247,15 +2757,8 @@ async def process_storage_management(update: Update, context: ContextTypes.DEFAU
             return await show_storage_list(update, context)
         
         try:
-            # Удаляем файлы хранилища
-            storage_path = os.path.join(BOT_DIR, 'temp_storage', storage_data['link_id'])
-            if os.path.exists(storage_path):
-                shutil.rmtree(storage_path)
-            
-            # Удаляем запись из базы данных асинхронно
-            async with aiosqlite.connect(DB_PATH) as conn:
-                await conn.execute('DELETE FROM temp_links WHERE link_id = ?', (storage_data['link_id'],))
-                await conn.commit()
+            # Удаляем хранилище вместе с учетом места, индексом файлов и ссылками на блобы
+            await delete_storages([storage_data['link_id']])
             
             await update.message.reply_text(
                 "✅ Хранилище успешно удалено!",
@@ -2321,34 +2824,30 @@ async def process_storage_management(update: Update, context: ContextTypes.DEFAU
             duration_hours = duration_map[text]
             
             # Получаем текущее количество продлений хранилища
-            async with aiosqlite.connect(DB_PATH) as conn:
-                cursor = await conn.execute('SELECT extension_count FROM temp_links WHERE link_id = ?', 
-                         (storage_data['link_id'],))
-                result = await cursor.fetchone()
-                extension_count = result[0] if result and result[0] is not None else 0
-                
-                # Проверяем, достигнут ли лимит продлений
-                max_extensions = 1  # Максимально допустимое количество продлений
-                if extension_count >= max_extensions:
-                    await update.message.reply_text(
-                        f"Достигнут лимит продлений хранилища ({max_extensions}). Создайте новое хранилище.",
-                        reply_markup=ReplyKeyboardMarkup([['Назад']], resize_keyboard=True)
-                    )
-                    return STORAGE_MANAGEMENT
-            
-                # Создаем и форматируем новую дату без микросекунд
-                expires_dt = datetime.now() + timedelta(hours=duration_hours)
-                new_expires_at = expires_dt.strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Обновляем срок действия и счетчик продлений в базе данных
-                await conn.execute('UPDATE temp_links SET expires_at = ?, extension_count = extension_count + 1 WHERE link_id = ?', 
-                         (new_expires_at, storage_data['link_id']))
-                await conn.commit()
+            result = await db_fetchone('SELECT extension_count FROM temp_links WHERE link_id = ?',
+                                       (storage_data['link_id'],))
+            extension_count = result[0] if result and result[0] is not None else 0
+            
+            # Проверяем, достигнут ли лимит продлений
+            max_extensions = 1  # Максимально допустимое количество продлений
+            if extension_count >= max_extensions:
+                await update.message.reply_text(
+                    f"Достигнут лимит продлений хранилища ({max_extensions}). Создайте новое хранилище.",
+                    reply_markup=ReplyKeyboardMarkup([['Назад']], resize_keyboard=True)
+                )
+                return STORAGE_MANAGEMENT
+            
+            # Новый срок отсчитывается от текущего момента
+            new_expires_at = int(time.time()) + duration_hours * 3600
+            
+            # Обновляем срок действия и счетчик продлений в базе данных
+            await db_execute('UPDATE temp_links SET expires_at = ?, extension_count = extension_count + 1 WHERE link_id = ?',
+                             (new_expires_at, storage_data['link_id']))
+            notify_storage_changed()
             
             # Получаем обновленное количество продлений
-            cursor = await conn.execute('SELECT extension_count FROM temp_links WHERE link_id = ?', 
-                     (storage_data['link_id'],))
-            result = await cursor.fetchone()
+            result = await db_fetchone('SELECT extension_count FROM temp_links WHERE link_id = ?',
+                                       (storage_data['link_id'],))
             extension_count = result[0] if result and result[0] is not None else 0
             # Максимум 1 продление, но нужно учесть что продление уже произошло
             max_extensions = 1  # Максимально допустимое количество продлений
@@ -2366,7 +2865,7 @@ async def process_storage_management(update: Update, context: ContextTypes.DEFAU
             
             await update.message.reply_text(
                 f"✅ Срок действия хранилища успешно продлен на {duration_text}!\n\n"
-                f"⏱ Новый срок действия до: {new_expires_at}\n"
+                f"⏱ Новый срок действия до: {format_datetime(new_expires_at)}\n"
                 f"🔄 Осталось продлений: {extensions_left}",
                 reply_markup=ReplyKeyboardMarkup([['Назад']], resize_keyboard=True)
             )
@@ -2384,26 +2883,16 @@ async def process_storage_management(update: Update, context: ContextTypes.DEFAU
     
     return STORAGE_MANAGEMENT
 
-def is_user_banned(user_id):
+async def is_user_banned(user_id):
     """Проверка блокировки пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute('SELECT is_banned FROM users WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        return result[0] if result else False
-    finally:
-        conn.close()
+    return (await get_user_profile(user_id))['is_banned']
 
 async def ban_user(bot, user_id, ban=True):
     """Блокировка/разблокировка пользователя"""
     try:
         # Блокируем/разблокируем в базе данных
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('UPDATE users SET is_banned = ? WHERE user_id = ?', (ban, user_id))
-        conn.commit()
-        conn.close()
+        await db_execute('UPDATE users SET is_banned = ? WHERE user_id = ?', (ban, user_id))
+        user_profile_cache.invalidate(user_id)
         
         # Обновляем множество заблокированных пользователей
         if ban:
@@ -2420,11 +2909,7 @@ async def ban_user(bot, user_id, ban=True):
 async def notify_admins_about_spam(bot, user_id, username, action_count):
     """Отправка уведомления администраторам о спаме"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT user_id FROM users WHERE role = ?', (UserRole.ADMIN,))
-        admins = c.fetchall()
-        conn.close()
+        admins = await db_fetchall('SELECT user_id FROM users WHERE role = ?', (UserRole.ADMIN,))
         
         message = (
             f"⚠️ *Обнаружен спам!*\n\n"
@@ -2476,9 +2961,8 @@ async def check_action_cooldown(user_id):
                 user_ban_list.add(user_id)
                 
                 # Записываем в базу данных
-                async with aiosqlite.connect(DB_PATH) as conn:
-                    await conn.execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (user_id,))
-                    await conn.commit()
+                await db_execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (user_id,))
+                user_profile_cache.invalidate(user_id)
                 
                 # Логируем бан
                 logger.warning(f"Пользователь {user_id} заблокирован за спам")
@@ -2521,12 +3005,12 @@ async def check_user_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return False
     
     # Проверяем блокировку в базе данных
-    if is_user_banned(user_id):
+    if await is_user_banned(user_id):
         user_ban_list.add(user_id)
         return False
     
     # Для администраторов не применяем ограничения
-    if is_admin(user_id):
+    if await is_admin(user_id):
         return True
     
     # Проверяем спам
@@ -2568,11 +3052,14 @@ if __name__ == '__main__':
             raise
         
         # Запускаем очистку истекших ссылок через планировщик
-        app.job_queue.run_repeating(cleanup_expired_links, interval=3600, first=10)
+        app.job_queue.run_once(cleanup_expired_links, when=10, name=EXPIRY_CLEANUP_JOB)
         
         # Запускаем очистку кэша защиты от спама
         app.job_queue.run_repeating(cleanup_spam_protection, interval=300, first=300)
         
+        # Периодически записываем накопленные счетчики использования
+        app.job_queue.run_repeating(flush_usage_counters, interval=COUNTER_FLUSH_INTERVAL, first=COUNTER_FLUSH_INTERVAL)
+        
         print("Настройка обработчиков...")
         
         async def restore_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2580,8 +3067,8 @@ if __name__ == '__main__':
             if not await check_user_access(update, context):
                 return ConversationHandler.END
                 
-            if is_user_verified(update.effective_user.id):
-                if not is_bot_enabled() and not is_admin(update.effective_user.id):
+            if await is_user_verified(update.effective_user.id):
+                if not await is_bot_enabled() and not await is_admin(update.effective_user.id):
                     await update.message.reply_text("Бот находится на техническом обслуживании. Пожалуйста, подождите.")
                     return ConversationHandler.END
                 await show_menu(update, context)
@@ -2616,6 +3103,7 @@ if __name__ == '__main__':
                 SET_LINES: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_set_lines)],
                 QR_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_qr_type)],
                 QR_DATA: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_qr_data)],
+                QR_BATCH: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, process_qr_batch)],
                 TEMP_LINK: [
                     MessageHandler(filters.Document.ALL | filters.TEXT & ~filters.COMMAND, delete_user_storage)
                 ],
@@ -2656,6 +3144,9 @@ if __name__ == '__main__':
             # При остановке корректно завершаем работу
             loop.run_until_complete(app.stop())
             loop.run_until_complete(app.shutdown())
+            loop.run_until_complete(usage_counters.flush())
+            bot_db.close()
+            qr_renderer.shutdown()
         
         print("Бот остановлен.")
         
@@ -2667,59 +3158,3 @@ if __name__ == '__main__':
         import traceback
         traceback.print_exc()
         sys.exit(1)
-
-def import_aiolibs():
-    """Проверка и импорт асинхронных библиотек"""
-    try:
-        import aiosqlite
-        import aiofiles
-        logger.info("Асинхронные библиотеки успешно импортированы")
-        return True
-    except ImportError:
-        logger.warning("Асинхронные библиотеки не найдены, будут использованы синхронные версии")
-        return False
-
-def set_user_lines_to_keep_sync(user_id, lines):
-    """Синхронная установка количества строк для пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute(
-            'INSERT OR REPLACE INTO user_settings (user_id, lines_to_keep) VALUES (?, ?)',
-            (user_id, lines)
-        )
-        conn.commit()
-    finally:
-        conn.close()
-
-
-
-async def get_user_lines_to_keep(user_id):
-    """Асинхронное получение количества строк для пользователя"""
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute('SELECT lines_to_keep FROM user_settings WHERE user_id = ?', (user_id,))
-            result = await cursor.fetchone()
-            if not result:
-                cursor = await conn.execute('SELECT lines_to_keep FROM bot_status WHERE id = 1')
-                result = await cursor.fetchone()
-            return result[0] if result else 10
-    except Exception as e:
-        logger.error(f"Ошибка при получении количества строк для пользователя {user_id}: {e}")
-        # Fallback к синхронной версии
-        return get_user_lines_to_keep_sync(user_id)
-
-def get_user_lines_to_keep_sync(user_id):
-    """Получение количества строк для пользователя (синхронная версия)"""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute('SELECT lines_to_keep FROM user_settings WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        if not result:
-            c.execute('SELECT lines_to_keep FROM bot_status WHERE id = 1')
-            result = c.fetchone()
-        return result[0] if result else 10
-    finally:
-        conn.close()
-        conn.close()
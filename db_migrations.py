@@ -0,0 +1,248 @@
+"""Версионированные миграции схемы базы данных, общие для bot.py и web_server.py.
+
+Номер последней примененной миграции хранится в PRAGMA user_version, поэтому
+при актуальной схеме запуск процесса обходится одним чтением этого числа.
+Недостающие миграции применяются по порядку в одной транзакции BEGIN IMMEDIATE:
+если бот и веб-сервер стартуют одновременно, второй процесс дождется первого,
+перечитает версию и ничего не будет делать повторно.
+
+Новая миграция — это функция, дописанная в конец MIGRATIONS; существующие
+миграции не меняются, иначе базы, где они уже применены, разойдутся с новыми.
+"""
+import logging
+import sqlite3
+from datetime import datetime
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+
+def legacy_datetime_to_epoch(value, tz):
+    """Преобразует дату из старого формата temp_links (строка, возможно с микросекундами) в epoch"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).split('.')[0]
+    return int(tz.localize(datetime.strptime(value, '%Y-%m-%d %H:%M:%S')).timestamp())
+
+
+def add_missing_columns(conn, table, columns):
+    """Добавляет в таблицу колонки, которых нет в базах, созданных старыми версиями"""
+    existing = {column[1] for column in conn.execute(f'PRAGMA table_info({table})')}
+    for column_name, definition in columns:
+        if column_name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column_name} {definition}')
+            logger.info(f"Добавлена колонка {column_name} в таблицу {table}")
+
+
+def create_base_schema(conn):
+    """1: общая схема всех таблиц бота и веб-сервера.
+
+    Базы без user_version могли быть созданы любой из прежних версий бота или
+    веб-сервера, поэтому таблицы создаются через IF NOT EXISTS, а недостающие
+    колонки добавляются. Сроки temp_links у старых баз переводит миграция 2.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                 (user_id INTEGER PRIMARY KEY,
+                  username TEXT,
+                  is_verified BOOLEAN DEFAULT FALSE,
+                  role TEXT DEFAULT 'user',
+                  usage_count INTEGER DEFAULT 0,
+                  merged_count INTEGER DEFAULT 0,
+                  qr_count INTEGER DEFAULT 0,
+                  last_action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  is_banned BOOLEAN DEFAULT FALSE)''')
+    add_missing_columns(conn, 'users', [('is_banned', 'BOOLEAN DEFAULT FALSE')])
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS bot_status
+                 (id INTEGER PRIMARY KEY,
+                  status TEXT DEFAULT 'enabled',
+                  lines_to_keep INTEGER DEFAULT 10)''')
+    conn.execute("INSERT OR IGNORE INTO bot_status (id, status, lines_to_keep) VALUES (1, 'enabled', 10)")
+
+    # Раньше веб-сервер создавал user_settings без language, а бот — с внешним ключом на users
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_settings
+                 (user_id INTEGER PRIMARY KEY,
+                  language TEXT DEFAULT 'ru',
+                  lines_to_keep INTEGER DEFAULT 10,
+                  theme TEXT DEFAULT 'dark')''')
+    add_missing_columns(conn, 'user_settings', [
+        ('language', "TEXT DEFAULT 'ru'"),
+        ('lines_to_keep', 'INTEGER DEFAULT 10'),
+        ('theme', "TEXT DEFAULT 'dark'"),
+    ])
+
+    # Сроки — UTC epoch в секундах
+    conn.execute('''CREATE TABLE IF NOT EXISTS temp_links
+                 (link_id TEXT PRIMARY KEY,
+                  user_id INTEGER,
+                  expires_at INTEGER NOT NULL,
+                  created_at INTEGER,
+                  extension_count INTEGER DEFAULT 0)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS temp_link_files
+                 (file_id TEXT PRIMARY KEY,
+                  link_id TEXT,
+                  file_path TEXT,
+                  original_name TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS access_log
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  timestamp TEXT NOT NULL,
+                  ip_address TEXT,
+                  user_agent TEXT,
+                  request_path TEXT,
+                  request_method TEXT,
+                  status_code INTEGER,
+                  response_time REAL)''')
+
+    # Учет занятого места и версия списка файлов хранилища
+    conn.execute('''CREATE TABLE IF NOT EXISTS storage_usage
+                 (link_id TEXT PRIMARY KEY,
+                  used_bytes INTEGER NOT NULL DEFAULT 0,
+                  file_count INTEGER NOT NULL DEFAULT 0,
+                  updated_at TEXT,
+                  version INTEGER NOT NULL DEFAULT 0,
+                  base_version INTEGER NOT NULL DEFAULT 0)''')
+    add_missing_columns(conn, 'storage_usage', [
+        ('version', 'INTEGER NOT NULL DEFAULT 0'),
+        ('base_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ])
+
+    # Индекс файлов хранилищ для страницы хранилища (без обхода диска на каждый просмотр)
+    conn.execute('''CREATE TABLE IF NOT EXISTS storage_files
+                 (link_id TEXT NOT NULL,
+                  filename TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  mtime REAL NOT NULL,
+                  extension TEXT NOT NULL,
+                  icon_class TEXT NOT NULL,
+                  version INTEGER NOT NULL DEFAULT 0,
+                  deleted INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (link_id, filename))''')
+    add_missing_columns(conn, 'storage_files', [
+        ('version', 'INTEGER NOT NULL DEFAULT 0'),
+        ('deleted', 'INTEGER NOT NULL DEFAULT 0'),
+    ])
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_storage_files_version ON storage_files(link_id, version)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_storage_files_mtime ON storage_files(link_id, mtime)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_storage_files_size ON storage_files(link_id, size)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_storage_files_extension ON storage_files(link_id, extension)')
+
+    # Блобы дедупликации со счетчиком ссылок и ссылки файлов хранилищ на них
+    conn.execute('''CREATE TABLE IF NOT EXISTS storage_blobs
+                 (sha256 TEXT PRIMARY KEY,
+                  size INTEGER NOT NULL,
+                  refcount INTEGER NOT NULL DEFAULT 0)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS storage_blob_refs
+                 (link_id TEXT NOT NULL,
+                  filename TEXT NOT NULL,
+                  sha256 TEXT NOT NULL,
+                  PRIMARY KEY (link_id, filename))''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_storage_blob_refs_sha256 ON storage_blob_refs(sha256)')
+
+    # Сессии загрузки для возобновления прерванных загрузок
+    conn.execute('''CREATE TABLE IF NOT EXISTS upload_sessions
+                 (link_id TEXT NOT NULL,
+                  upload_session_id TEXT NOT NULL,
+                  filename TEXT NOT NULL,
+                  total_size INTEGER NOT NULL,
+                  received_ranges TEXT NOT NULL DEFAULT '[]',
+                  last_activity INTEGER NOT NULL,
+                  PRIMARY KEY (link_id, upload_session_id))''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_last_activity ON upload_sessions(last_activity)')
+
+
+def migrate_temp_links_to_epoch(conn):
+    """2: сроки temp_links в UTC epoch (INTEGER).
+
+    Раньше expires_at хранился строкой московского времени (в том числе с
+    микросекундами), а created_at — строкой UTC из datetime('now'). ALTER TABLE
+    не меняет тип колонки, поэтому таблица пересоздается и индекс строится заново.
+    """
+    columns = {column[1]: column[2].upper() for column in conn.execute('PRAGMA table_info(temp_links)')}
+    if columns.get('expires_at') != 'INTEGER':
+        moscow_tz = pytz.timezone('Europe/Moscow')
+        created_column = 'created_at' if 'created_at' in columns else 'NULL'
+        extension_column = 'extension_count' if 'extension_count' in columns else '0'
+        rows = conn.execute(f'SELECT link_id, expires_at, user_id, {created_column}, {extension_column} FROM temp_links').fetchall()
+
+        migrated = []
+        for link_id, expires_at, user_id, created_at, extension_count in rows:
+            try:
+                expires_epoch = legacy_datetime_to_epoch(expires_at, moscow_tz)
+            except ValueError as e:
+                # Нераспознанный срок считаем истекшим: хранилище удалит очистка
+                logger.error(f"Некорректный срок действия хранилища {link_id}: {str(e)}")
+                expires_epoch = None
+            try:
+                created_epoch = legacy_datetime_to_epoch(created_at, pytz.utc)
+            except ValueError:
+                created_epoch = None
+            if expires_epoch is None:
+                expires_epoch = 0
+            if created_epoch is None:
+                # Как и раньше, считаем, что хранилище создано за 7 дней до истечения срока
+                created_epoch = expires_epoch - 7 * 86400
+            migrated.append((link_id, expires_epoch, user_id, created_epoch, extension_count or 0))
+
+        conn.execute('DROP TABLE IF EXISTS temp_links_epoch')
+        conn.execute('''CREATE TABLE temp_links_epoch
+                     (link_id TEXT PRIMARY KEY,
+                      user_id INTEGER,
+                      expires_at INTEGER NOT NULL,
+                      created_at INTEGER,
+                      extension_count INTEGER DEFAULT 0)''')
+        conn.executemany('''INSERT INTO temp_links_epoch (link_id, expires_at, user_id, created_at, extension_count)
+                            VALUES (?, ?, ?, ?, ?)''', migrated)
+        conn.execute('DROP TABLE temp_links')
+        conn.execute('ALTER TABLE temp_links_epoch RENAME TO temp_links')
+        logger.info(f"Сроки действия {len(migrated)} хранилищ переведены в epoch")
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_temp_links_expires_at ON temp_links(expires_at)')
+
+
+def create_lookup_indexes(conn):
+    """3: индексы для выборок по хранилищу, владельцу и роли пользователя"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_temp_link_files_link_id ON temp_link_files(link_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_temp_links_user_id ON temp_links(user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_is_verified ON users(is_verified)')
+
+
+# Порядок важен: номер миграции — ее позиция в списке, начиная с 1
+MIGRATIONS = [
+    create_base_schema,
+    migrate_temp_links_to_epoch,
+    create_lookup_indexes,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def apply_migrations(db_path):
+    """Приводит схему базы к SCHEMA_VERSION и возвращает версию схемы"""
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return version
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Пока ждали блокировку, миграции мог применить другой процесс
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number in range(version + 1, SCHEMA_VERSION + 1):
+                MIGRATIONS[number - 1](conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+                logger.info(f"Применена миграция схемы БД {number}: {MIGRATIONS[number - 1].__name__}")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return SCHEMA_VERSION
+    finally:
+        conn.close()
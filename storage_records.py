@@ -0,0 +1,38 @@
+"""Удаление записей хранилищ из БД, общее для bot.py и web_server.py.
+
+Хранилище удаляет тот процесс, который первым до него добрался: бот по команде
+пользователя или при очистке, веб-сервер по расписанию сроков или по кнопке на
+странице. Поэтому набор таблиц, из которых убираются записи, задан в одном месте.
+"""
+
+# Таблицы с записями хранилища по link_id
+STORAGE_TABLES = ('temp_link_files', 'temp_links', 'storage_usage', 'storage_files', 'storage_blob_refs')
+
+
+def delete_storage_records(conn, link_ids):
+    """Удаляет записи хранилищ во всех связанных таблицах и уменьшает refcount их блобов.
+
+    Транзакцией управляет вызывающий код. Файлы с диска не удаляются: функция
+    возвращает (пути файлов temp_link_files, хэши блобов, на которые не осталось ссылок).
+    """
+    link_ids = list(link_ids)
+    if not link_ids:
+        return [], []
+    placeholders = ', '.join('?' * len(link_ids))
+    files = [row[0] for row in conn.execute(
+        f'SELECT file_path FROM temp_link_files WHERE link_id IN ({placeholders})', link_ids
+    )]
+    refs = conn.execute(
+        f'SELECT sha256, COUNT(*) FROM storage_blob_refs WHERE link_id IN ({placeholders}) GROUP BY sha256', link_ids
+    ).fetchall()
+    for table in STORAGE_TABLES:
+        conn.execute(f'DELETE FROM {table} WHERE link_id IN ({placeholders})', link_ids)
+
+    orphaned = []
+    for sha256, count in refs:
+        conn.execute('UPDATE storage_blobs SET refcount = refcount - ? WHERE sha256 = ?', (count, sha256))
+        row = conn.execute('SELECT refcount FROM storage_blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        if row and row[0] <= 0:
+            conn.execute('DELETE FROM storage_blobs WHERE sha256 = ?', (sha256,))
+            orphaned.append(sha256)
+    return files, orphaned
@@ -0,0 +1,170 @@
+"""Общие фикстуры тестов.
+
+bot.py и web_server.py держат БД, логи и хранилища рядом с собой, поэтому
+тесты импортируют их из копии проекта во временной директории.
+"""
+import asyncio
+import importlib
+import io
+import os
+import shutil
+import sys
+import time
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Обязательные переменные окружения для импорта модулей
+TEST_ENV = {
+    'BOT_TOKEN': 'test-token',
+    'ADMIN_CODE': 'admin-code',
+    'USER_PLUS_CODE': 'user-plus-code',
+    'MAX_REQUESTS_PER_MINUTE': '100000',
+    'MAX_FAILED_ATTEMPTS': '100',
+    'BLOCK_TIME_SECONDS': '1',
+    'SESSION_COOKIE_SECURE': 'false',
+    'CSRF_PROTECTION_ENABLED': 'false',
+}
+
+
+class FakeMessage:
+    """Сообщение Telegram, запоминающее ответы бота"""
+
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUser:
+    def __init__(self, user_id, username='tester'):
+        self.id = user_id
+        self.username = username
+
+
+class FakeUpdate:
+    def __init__(self, user_id, text):
+        self.message = FakeMessage(text)
+        self.effective_user = FakeUser(user_id)
+
+
+class FakeContext:
+    def __init__(self, args=None, user_data=None):
+        self.args = args or []
+        self.user_data = user_data if user_data is not None else {}
+
+
+@pytest.fixture(scope='session')
+def app_dir(tmp_path_factory):
+    """Копия проекта, из которой импортируются модули"""
+    path = tmp_path_factory.mktemp('app')
+    for name in os.listdir(PROJECT_DIR):
+        if name.endswith('.py'):
+            shutil.copy(os.path.join(PROJECT_DIR, name), path)
+    for name in ('templates', 'web'):
+        shutil.copytree(os.path.join(PROJECT_DIR, name), path / name)
+    os.makedirs(path / 'logs')
+
+    for key, value in TEST_ENV.items():
+        os.environ.setdefault(key, value)
+    cwd = os.getcwd()
+    os.chdir(path)
+    sys.path.insert(0, str(path))
+    yield path
+    sys.path.remove(str(path))
+    os.chdir(cwd)
+
+
+def import_project_module(app_dir, name):
+    """Импортирует модуль проекта из копии, а не из рабочего дерева"""
+    module = sys.modules.get(name)
+    if module is not None and os.path.dirname(module.__file__) != str(app_dir):
+        del sys.modules[name]
+    return importlib.import_module(name)
+
+
+@pytest.fixture(scope='session')
+def bot_module(app_dir):
+    module = import_project_module(app_dir, 'bot')
+    asyncio.run(module.ensure_directories())
+    yield module
+    module.bot_db.close()
+
+
+@pytest.fixture(scope='session')
+def web_module(app_dir):
+    module = import_project_module(app_dir, 'web_server')
+    yield module
+    module.access_log_writer.stop()
+    module.db_pool.close_all()
+
+
+@pytest.fixture()
+def client(web_module):
+    return web_module.app.test_client()
+
+
+@pytest.fixture()
+def make_storage(web_module):
+    """Создает действующее временное хранилище с файлами {имя: содержимое}"""
+    created = []
+
+    def _make_storage(link_id, files=None, user_id=1):
+        now = int(time.time())
+        web_module.db_execute(
+            'INSERT OR REPLACE INTO temp_links (link_id, expires_at, user_id, created_at) VALUES (?, ?, ?, ?)',
+            (link_id, now + 86400, user_id, now)
+        )
+        web_module.storage_validity_cache.invalidate(link_id)
+        storage_path = web_module.get_temp_storage_path(link_id)
+        os.makedirs(storage_path, exist_ok=True)
+        for name, content in (files or {}).items():
+            with open(os.path.join(storage_path, name), 'wb') as f:
+                f.write(content)
+        created.append(link_id)
+        return storage_path
+
+    yield _make_storage
+    for link_id in created:
+        shutil.rmtree(web_module.get_temp_storage_path(link_id), ignore_errors=True)
+
+
+@pytest.fixture()
+def make_update():
+    """Создает обновление Telegram с текстом сообщения от пользователя user_id"""
+    return FakeUpdate
+
+
+@pytest.fixture()
+def make_context():
+    """Создает контекст обработчика с аргументами команды и user_data"""
+    return FakeContext
+
+
+@pytest.fixture()
+def dedup_enabled(web_module, monkeypatch):
+    monkeypatch.setitem(web_module.app.config, 'STORAGE_DEDUP_ENABLED', True)
+
+
+@pytest.fixture()
+def upload_file(client):
+    """Отправляет чанк файла в /<link_id>/upload и возвращает ответ.
+
+    По умолчанию чанк — весь файл, а сессия загрузки названа по хранилищу и имени файла.
+    """
+    def _upload_file(link_id, filename, data, upload_session_id=None, total_size=None, offset=0):
+        total_size = len(data) if total_size is None else total_size
+        chunk_size = max(len(data), 1)
+        return client.post(f'/{link_id}/upload', data={
+            'file': (io.BytesIO(data), filename),
+            'chunk': offset // chunk_size,
+            'chunks': max(1, -(-total_size // chunk_size)),
+            'offset': offset,
+            'total_size': total_size,
+            'upload_session_id': upload_session_id or f'{link_id}{filename.replace(".", "")}',
+        })
+
+    return _upload_file
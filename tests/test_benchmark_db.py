@@ -0,0 +1,130 @@
+"""Нагрузочное сравнение доступа web_server к БД до и после пула соединений.
+
+Запуск: RUN_BENCHMARKS=1 python -m pytest -s tests/test_benchmark_db.py
+
+«До» воспроизводит прежнюю схему: каждый запрос создавал новый event loop
+(run_async) и новое соединение aiosqlite, а access_log писался отдельной
+транзакцией на каждый HTTP-запрос.
+"""
+import asyncio
+import os
+import sqlite3
+import time
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.getenv('RUN_BENCHMARKS'), reason='нагрузочные тесты: RUN_BENCHMARKS=1')
+
+ITERATIONS = 300
+
+LOOKUP_QUERIES = [
+    ('SELECT expires_at FROM temp_links WHERE link_id = ?', ('bench1',)),
+    ('SELECT user_id FROM temp_links WHERE link_id = ?', ('bench1',)),
+    ('SELECT theme FROM user_settings WHERE user_id = ?', (1,)),
+]
+
+ACCESS_LOG_ROW = ('2026-01-01 00:00:00', '127.0.0.1', 'bench', '/bench1', 'GET', 200, 0.01)
+
+
+def legacy_fetchone(db_path, query, params):
+    """Прежний путь запроса: новый event loop и новое соединение aiosqlite"""
+    aiosqlite = pytest.importorskip('aiosqlite')
+
+    async def fetch():
+        async with aiosqlite.connect(db_path) as conn:
+            cursor = await conn.execute(query, params)
+            return await cursor.fetchone()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(fetch())
+    finally:
+        loop.close()
+
+
+def legacy_fetchall(db_path, query, params):
+    """Прежний путь запроса списка строк"""
+    aiosqlite = pytest.importorskip('aiosqlite')
+
+    async def fetch():
+        async with aiosqlite.connect(db_path) as conn:
+            cursor = await conn.execute(query, params)
+            return await cursor.fetchall()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(fetch())
+    finally:
+        loop.close()
+
+
+def legacy_log_row(db_path, query, row):
+    """Прежняя запись access_log: отдельное соединение и фиксация на каждый запрос"""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(query, row)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def per_iteration_ms(func):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    return (time.perf_counter() - start) / ITERATIONS * 1000
+
+
+def test_lookup_latency_pool_vs_legacy(web_module, make_storage):
+    make_storage('bench1')
+
+    def legacy():
+        for query, params in LOOKUP_QUERIES:
+            legacy_fetchone(web_module.DB_PATH, query, params)
+
+    def pooled():
+        for query, params in LOOKUP_QUERIES:
+            web_module.db_fetchone(query, params)
+
+    legacy_ms = per_iteration_ms(legacy)
+    pooled_ms = per_iteration_ms(pooled)
+    print(f"\n3 запроса к БД на HTTP-запрос: {legacy_ms:.3f} мс -> {pooled_ms:.3f} мс")
+    assert pooled_ms < legacy_ms
+
+
+def test_access_log_writer_vs_per_request_commit(web_module):
+    writer = web_module.AccessLogWriter(ITERATIONS * 2, 200, 0.5)
+    writer.start()
+
+    legacy_ms = per_iteration_ms(lambda: legacy_log_row(web_module.DB_PATH, writer.INSERT_QUERY, ACCESS_LOG_ROW))
+    enqueue_ms = per_iteration_ms(lambda: writer.enqueue(ACCESS_LOG_ROW))
+    writer.stop()
+    print(f"\nЗапись access_log в обработчике запроса: {legacy_ms:.3f} мс -> {enqueue_ms:.3f} мс")
+    assert writer.dropped == 0
+    assert enqueue_ms < legacy_ms
+
+
+def test_request_latency_pool_vs_legacy(web_module, client, make_storage, monkeypatch):
+    make_storage('bench1', {'report.txt': b'benchmark'})
+
+    def request_page():
+        response = client.get('/bench1')
+        assert response.status_code == 200
+        assert b'report.txt' in response.data
+
+    request_page()
+    pooled_ms = per_iteration_ms(request_page)
+
+    # Тот же запрос через прежние функции доступа к БД
+    with monkeypatch.context() as patch:
+        patch.setattr(web_module, 'db_fetchone',
+                      lambda query, params=(): legacy_fetchone(web_module.DB_PATH, query, params))
+        patch.setattr(web_module, 'db_fetchall',
+                      lambda query, params=(): legacy_fetchall(web_module.DB_PATH, query, params))
+        patch.setattr(web_module.access_log_writer, 'enqueue',
+                      lambda row: legacy_log_row(web_module.DB_PATH, web_module.AccessLogWriter.INSERT_QUERY, row))
+        request_page()
+        legacy_ms = per_iteration_ms(request_page)
+
+    print(f"\nGET /<link_id>: {legacy_ms:.3f} мс -> {pooled_ms:.3f} мс")
+    assert pooled_ms < legacy_ms
@@ -0,0 +1,36 @@
+import asyncio
+import sqlite3
+import threading
+
+
+def test_handler_never_connects_on_event_loop_thread(bot_module, monkeypatch, make_update, make_context):
+    """Все подключения sqlite3 при обработке обновления выполняются вне потока цикла событий"""
+    connect_threads = []
+    original_connect = sqlite3.connect
+
+    def recording_connect(*args, **kwargs):
+        connect_threads.append(threading.current_thread())
+        return original_connect(*args, **kwargs)
+
+    monkeypatch.setattr(sqlite3, 'connect', recording_connect)
+    # Новый экземпляр, чтобы первое подключение произошло внутри теста
+    db = bot_module.BotDatabase(bot_module.DB_PATH)
+    monkeypatch.setattr(bot_module, 'bot_db', db)
+
+    async def scenario():
+        await bot_module.setup_database()
+        update = make_update(1001, f'/start admin{bot_module.ADMIN_CODE}')
+        await bot_module.start(update, make_context([f'admin{bot_module.ADMIN_CODE}']))
+        role = await bot_module.db_fetchone('SELECT role FROM users WHERE user_id = ?', (1001,))
+        return threading.current_thread(), update, role
+
+    try:
+        loop_thread, update, role = asyncio.run(scenario())
+    finally:
+        db.close()
+
+    assert role == (bot_module.UserRole.ADMIN,)
+    assert update.message.replies
+    assert connect_threads, 'обработчик не обращался к БД'
+    assert loop_thread not in connect_threads
+    assert any(thread.name.startswith('bot-db') for thread in connect_threads)
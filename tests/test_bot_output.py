@@ -0,0 +1,18 @@
+import pytest
+from telegram import InputFile
+
+
+@pytest.mark.parametrize('size', [100, 64 * 1024])
+def test_spooled_buffer_is_accepted_by_input_file(bot_module, monkeypatch, size):
+    """Буфер отправляется как есть и в памяти, и после переноса во временный файл"""
+    monkeypatch.setattr(bot_module, 'OUTPUT_SPOOL_MAX_SIZE', 1024)
+    payload = b'x' * size
+    with bot_module.new_spooled_buffer('links.html') as buffer:
+        buffer.write(payload)
+        assert buffer._rolled == (size > 1024)
+        buffer.seek(0)
+        input_file = InputFile(buffer)
+
+    assert input_file.filename == 'links.html'
+    assert input_file.mimetype == 'text/html'
+    assert input_file.input_file_content == payload
@@ -0,0 +1,46 @@
+import io
+import os
+
+
+class ReadOnlyStream:
+    """Поток без readinto, как SpooledTemporaryFile до Python 3.11"""
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+
+def test_write_chunk_to_part_without_readinto(web_module, tmp_path):
+    data = os.urandom(3 * web_module.app.config['UPLOAD_CHUNK_SIZE'] + 17)
+    part_path = tmp_path / 'chunk.part'
+    part_path.write_bytes(b'\0' * (len(data) + 10))
+
+    with web_module.app.app_context():
+        assert web_module.write_chunk_to_part(ReadOnlyStream(data), str(part_path), 10, len(data)) == len(data)
+        assert part_path.read_bytes()[10:] == data
+        assert web_module.write_chunk_to_part(ReadOnlyStream(data), str(part_path), 0, len(data) - 1) is None
+
+
+def test_oversized_chunk_is_rejected(web_module, make_storage, upload_file, monkeypatch):
+    monkeypatch.setitem(web_module.app.config, 'MAX_CHUNK_SIZE', 1024)
+    make_storage('chunk1')
+    response = upload_file('chunk1', 'chunked.zip', os.urandom(2048), 'chunksession1', total_size=4096)
+    assert response.status_code == 413
+    assert 'error' in response.json
+
+
+def test_failed_chunk_write_removes_part_file(web_module, client, make_storage, upload_file, monkeypatch):
+    def failing_write(stream, temp_file_path, offset, max_length):
+        with open(temp_file_path, 'r+b') as f:
+            f.write(stream.read(100))
+        raise AttributeError('readinto')
+
+    monkeypatch.setattr(web_module, 'write_chunk_to_part', failing_write)
+    make_storage('chunk2')
+    response = upload_file('chunk2', 'chunked.zip', os.urandom(1024), 'chunksession2', total_size=4096)
+    assert response.status_code == 500
+    assert 'error' in response.json
+    assert not os.path.exists(web_module.get_upload_part_path('chunk2', 'chunksession2'))
+    assert client.get('/chunk2/upload-status/chunksession2').json == {'exists': False}
@@ -0,0 +1,41 @@
+from urllib.parse import quote, unquote
+
+import pytest
+
+
+@pytest.fixture()
+def offload_storage(make_storage):
+    make_storage('offload1', {'отчет 1.pdf': b'%PDF-1.4 test'})
+    return 'offload1'
+
+
+def test_nginx_offload_sends_headers_without_body(web_module, client, offload_storage, monkeypatch):
+    monkeypatch.setitem(web_module.app.config, 'DOWNLOAD_OFFLOAD_MODE', 'nginx')
+    response = client.get(f'/{offload_storage}/download/{quote("отчет 1.pdf")}?download=true')
+
+    assert response.status_code == 200
+    assert response.data == b''
+    assert response.mimetype == 'application/pdf'
+    assert response.headers['X-Accel-Redirect'] == f'/protected_storage/{offload_storage}/{quote("отчет 1.pdf")}'
+    assert response.headers['Content-Disposition'] == f"attachment; filename*=UTF-8''{quote('отчет 1.pdf')}"
+    assert 'X-Sendfile' not in response.headers
+
+
+def test_sendfile_offload_points_to_storage_file(web_module, client, offload_storage, monkeypatch):
+    monkeypatch.setitem(web_module.app.config, 'DOWNLOAD_OFFLOAD_MODE', 'sendfile')
+    response = client.get(f'/{offload_storage}/download/{quote("отчет 1.pdf")}')
+
+    assert response.status_code == 200
+    assert response.data == b''
+    assert response.mimetype == 'application/pdf'
+    assert 'Content-Disposition' not in response.headers
+    with open(unquote(response.headers['X-Sendfile']), 'rb') as f:
+        assert f.read() == b'%PDF-1.4 test'
+
+
+def test_offload_skipped_for_missing_file(web_module, client, offload_storage, monkeypatch):
+    monkeypatch.setitem(web_module.app.config, 'DOWNLOAD_OFFLOAD_MODE', 'nginx')
+    response = client.get(f'/{offload_storage}/download/missing.pdf')
+
+    assert response.status_code == 404
+    assert 'X-Accel-Redirect' not in response.headers
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import time
+
+
+def storage_rows(web_module, link_id):
+    return {
+        table: web_module.db_fetchone(f'SELECT COUNT(*) FROM {table} WHERE link_id = ?', (link_id,))[0]
+        for table in ('temp_links', 'temp_link_files', 'storage_usage', 'storage_files', 'storage_blob_refs')
+    }
+
+
+def test_bot_delete_cleans_ledger_index_and_blobs(web_module, bot_module, client, make_storage, upload_file,
+                                                  dedup_enabled, make_update, make_context):
+    data = os.urandom(64 * 1024)
+    make_storage('botdel1', user_id=2001)
+    make_storage('botdel2', user_id=2001)
+    for link_id, filename in (('botdel1', 'a.zip'), ('botdel2', 'b.zip')):
+        assert upload_file(link_id, filename, data).status_code == 200
+    sha256 = web_module.db_fetchone('SELECT sha256 FROM storage_blob_refs WHERE link_id = ?', ('botdel1',))[0]
+    blob_path = web_module.get_blob_path(sha256)
+    web_module.db_execute('INSERT INTO temp_link_files (link_id, file_path, original_name) VALUES (?, ?, ?)',
+                          ('botdel1', os.path.join(bot_module.TEMP_LINKS_DIR, 'missing.bin'), 'a.zip'))
+    assert all(storage_rows(web_module, 'botdel1').values())
+    bot_module.notify_storage_changed()
+    marker_mtime = os.stat(bot_module.STORAGE_CACHE_MARKER).st_mtime_ns
+
+    update = make_update(2001, '🗑️ Удалить хранилище')
+    state = asyncio.run(bot_module.delete_user_storage(update, make_context(user_data={'current_storage': 'botdel1'})))
+
+    assert state == bot_module.MENU
+    assert update.message.replies == ['✅ Хранилище успешно удалено!']
+    assert not any(storage_rows(web_module, 'botdel1').values())
+    assert not os.path.exists(web_module.get_temp_storage_path('botdel1'))
+    # Блоб еще нужен второму хранилищу
+    assert web_module.db_fetchone('SELECT refcount FROM storage_blobs WHERE sha256 = ?', (sha256,)) == (1,)
+    assert os.path.exists(blob_path)
+    assert os.stat(bot_module.STORAGE_CACHE_MARKER).st_mtime_ns != marker_mtime
+    # Веб-сервер сразу видит удаление
+    assert client.get('/botdel1/download/a.zip').status_code != 200
+
+    asyncio.run(bot_module.delete_storages(['botdel2']))
+    assert web_module.db_fetchone('SELECT refcount FROM storage_blobs WHERE sha256 = ?', (sha256,)) is None
+    assert not os.path.exists(blob_path)
+
+
+def test_expiry_scheduler_reloads_when_bot_changes_storages(web_module, bot_module, make_storage):
+    scheduler = web_module.ExpiryScheduler(bot_module.STORAGE_CACHE_MARKER)
+    now = time.time()
+    scheduler.run_pending(now)
+
+    # Бот создает хранилище, истекающее в пределах горизонта планировщика
+    make_storage('sched1')
+    expires_at = int(now) + 1800
+    web_module.db_execute('UPDATE temp_links SET expires_at = ? WHERE link_id = ?', (expires_at, 'sched1'))
+    scheduler.run_pending(now + 1)
+    assert 'sched1' not in scheduler._deadlines
+
+    bot_module.notify_storage_changed()
+    scheduler.run_pending(now + 2)
+    assert scheduler._deadlines['sched1'] == expires_at
+
+    # Бот продлевает хранилище за пределы горизонта
+    asyncio.run(bot_module.db_execute('UPDATE temp_links SET expires_at = ? WHERE link_id = ?',
+                                      (expires_at + 3 * 3600, 'sched1')))
+    bot_module.notify_storage_changed()
+    scheduler.run_pending(now + 3)
+    assert 'sched1' not in scheduler._deadlines
+
+
+def test_web_deletes_clean_the_same_tables_as_bot(web_module, bot_module, client, make_storage, upload_file,
+                                                  dedup_enabled):
+    data = os.urandom(64 * 1024)
+    for link_id in ('webdel1', 'webdel2'):
+        make_storage(link_id, user_id=2002)
+        assert upload_file(link_id, 'a.zip', data).status_code == 200
+        link_file = os.path.join(bot_module.TEMP_LINKS_DIR, f'{link_id}.bin')
+        with open(link_file, 'wb') as f:
+            f.write(data)
+        web_module.db_execute('INSERT INTO temp_link_files (link_id, file_path, original_name) VALUES (?, ?, ?)',
+                              (link_id, link_file, 'a.zip'))
+        assert all(storage_rows(web_module, link_id).values())
+    sha256 = web_module.db_fetchone('SELECT sha256 FROM storage_blob_refs WHERE link_id = ?', ('webdel1',))[0]
+
+    # Истечение срока по расписанию
+    web_module.db_execute('UPDATE temp_links SET expires_at = 946684800 WHERE link_id = ?', ('webdel1',))
+    assert web_module.delete_expired_storages(['webdel1']) == ['webdel1']
+    assert not any(storage_rows(web_module, 'webdel1').values())
+    assert not os.path.exists(os.path.join(bot_module.TEMP_LINKS_DIR, 'webdel1.bin'))
+    assert web_module.db_fetchone('SELECT refcount FROM storage_blobs WHERE sha256 = ?', (sha256,)) == (1,)
+
+    # Удаление хранилища со страницы
+    assert client.post('/webdel2/delete-all').json == {'success': True}
+    assert not any(storage_rows(web_module, 'webdel2').values())
+    assert not os.path.exists(os.path.join(bot_module.TEMP_LINKS_DIR, 'webdel2.bin'))
+    assert web_module.db_fetchone('SELECT refcount FROM storage_blobs WHERE sha256 = ?', (sha256,)) is None
+    assert not os.path.exists(web_module.get_blob_path(sha256))
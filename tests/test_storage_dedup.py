@@ -0,0 +1,32 @@
+import asyncio
+import os
+
+
+def test_identical_uploads_are_reported_as_logical_and_physical_bytes(web_module, bot_module, client, make_storage,
+                                                                      upload_file, dedup_enabled):
+    before = web_module.reconcile_blob_store()
+    data = os.urandom(256 * 1024)
+    make_storage('dedup1')
+    make_storage('dedup2')
+
+    for link_id, filename in (('dedup1', 'report.zip'), ('dedup2', 'copy.zip')):
+        response = upload_file(link_id, filename, data)
+        assert response.status_code == 200, response.json
+        assert response.json['complete']
+
+    assert os.path.samefile(
+        os.path.join(web_module.get_temp_storage_path('dedup1'), 'report.zip'),
+        os.path.join(web_module.get_temp_storage_path('dedup2'), 'copy.zip'),
+    )
+
+    after = web_module.reconcile_blob_store()
+    assert after['logical_bytes'] - before['logical_bytes'] == 2 * len(data)
+    assert after['physical_bytes'] - before['physical_bytes'] == len(data)
+
+    # Бот показывает администратору те же итоги
+    _, logical_bytes, physical_bytes = asyncio.run(bot_module.get_storage_usage_totals())
+    assert (logical_bytes, physical_bytes) == (after['logical_bytes'], after['physical_bytes'])
+
+    client.post('/dedup1/delete-all')
+    client.post('/dedup2/delete-all')
+    assert web_module.reconcile_blob_store()['physical_bytes'] == before['physical_bytes']
@@ -0,0 +1,39 @@
+ASCII_PREFIX = b''.join(b'line %05d of plain ascii text\n' % i for i in range(4000))
+
+
+def preview(client, link_id, filename, **params):
+    response = client.get(f'/{link_id}/preview/{filename}', query_string=params)
+    assert response.status_code == 200, response.json
+    return response.json
+
+
+def test_encoding_detected_per_window_far_from_start(client, make_storage):
+    assert len(ASCII_PREFIX) > 64 * 1024
+    make_storage('txtenc1', {
+        'utf8.txt': ASCII_PREFIX + 'Привет, мир\n'.encode('utf-8'),
+        'cp1251.txt': ASCII_PREFIX + 'Привет, мир\n'.encode('windows-1251'),
+    })
+
+    for filename, encoding in (('utf8.txt', 'utf-8'), ('cp1251.txt', 'windows-1251')):
+        head = preview(client, 'txtenc1', filename, lines=10)
+        assert head['lines'][0] == 'line 00000 of plain ascii text'
+
+        by_line = preview(client, 'txtenc1', filename, line=3999)
+        assert by_line['lines'] == ['line 03999 of plain ascii text', 'Привет, мир']
+        assert by_line['encoding'] == encoding
+
+        by_offset = preview(client, 'txtenc1', filename, offset=len(ASCII_PREFIX))
+        assert by_offset['lines'] == ['Привет, мир']
+        assert by_offset['encoding'] == encoding
+
+
+def test_truncated_utf8_line_keeps_encoding(web_module, client, make_storage):
+    # Обрезка длинной строки приходится на середину двухбайтового символа
+    long_line = b'a' + 'ж'.encode('utf-8') * web_module.TEXT_PREVIEW_MAX_LINE_BYTES + b'\n'
+    make_storage('txtenc2', {'long.txt': long_line + 'конец\n'.encode('utf-8')})
+
+    window = preview(client, 'txtenc2', 'long.txt')
+    assert window['encoding'] == 'utf-8'
+    assert window['truncated'] is True
+    assert window['lines'][0] == 'a' + 'ж' * ((web_module.TEXT_PREVIEW_MAX_LINE_BYTES - 1) // 2)
+    assert window['lines'][1] == 'конец'
@@ -0,0 +1,27 @@
+import os
+
+
+def test_upload_abort_removes_part_file(web_module, client, make_storage, upload_file):
+    make_storage('abort1')
+    data = os.urandom(4096)
+    response = upload_file('abort1', 'partial.zip', data[:1024], 'abortsession1', total_size=len(data))
+    assert response.status_code == 200, response.json
+    part_path = web_module.get_upload_part_path('abort1', 'abortsession1')
+    assert os.path.exists(part_path)
+
+    response = client.post('/abort1/upload-abort/abortsession1')
+    assert response.status_code == 200
+    assert response.json == {'success': True}
+    assert not os.path.exists(part_path)
+    assert client.get('/abort1/upload-status/abortsession1').json == {'exists': False}
+
+
+def test_upload_abort_rejects_unknown_and_expired_storages(web_module, client, make_storage):
+    assert client.post('/nosuchstorage/upload-abort/abortsession2').status_code == 404
+
+    make_storage('abort2')
+    web_module.db_execute('UPDATE temp_links SET expires_at = 946684800 WHERE link_id = ?', ('abort2',))
+    web_module.storage_validity_cache.invalidate('abort2')
+    response = client.post('/abort2/upload-abort/abortsession2')
+    assert response.status_code == 404
+    assert 'error' in response.json
@@ -170,6 +170,8 @@ class FilePreviewManager {
         const absoluteFileUrl = new URL(fileUrl, window.location.origin).href;
 
         const imageTypes = ['jpg', 'jpeg', 'png', 'gif', 'svg', 'webp', 'bmp', 'ico', 'tiff', 'tif'];
+        // Для этих форматов сервер отдает уменьшенную копию вместо оригинала
+        const thumbnailTypes = ['jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff', 'tif'];
         const unsupportedPreviewTypes = [
             'zip', 'rar', '7z', 'tar', 'gz', 'bz2',
             'doc', 'docx', 'docm', 'dot', 'dotx', 'dotm', 'rtf',
@@ -189,12 +191,26 @@ class FilePreviewManager {
             img.className = 'preview-image';
             img.alt = filename;
             img.onload = () => {
-                this.previewFilename.textContent = `${filename} (${img.naturalWidth}x${img.naturalHeight})`;
+                // Размеры миниатюры не совпадают с оригиналом, поэтому показываем их только для оригинала
+                if (img.src === absoluteFileUrl) {
+                    this.previewFilename.textContent = `${filename} (${img.naturalWidth}x${img.naturalHeight})`;
+                }
                 const loadingDiv = this.previewContainer.querySelector('.preview-loading');
                 if (loadingDiv) loadingDiv.style.display = 'none';
             };
-            img.onerror = () => this.showPreviewError();
-            img.src = fileUrl;
+            if (thumbnailTypes.includes(ext)) {
+                // Ширина под окно предпросмотра с учетом плотности пикселей экрана
+                const width = Math.ceil(Math.min(window.innerWidth, 1024) * (window.devicePixelRatio || 1));
+                img.onerror = () => {
+                    // Если миниатюру создать не удалось, показываем оригинал
+                    img.onerror = () => this.showPreviewError();
+                    img.src = fileUrl;
+                };
+                img.src = `/${this.linkId}/thumb/${encodeURIComponent(filename)}?w=${width}`;
+            } else {
+                img.onerror = () => this.showPreviewError();
+                img.src = fileUrl;
+            }
             this.previewContainer.innerHTML = '';
             this.previewContainer.appendChild(img);
         }
@@ -217,34 +233,40 @@ class FilePreviewManager {
             this.showPreviewError('Предпросмотр для этого типа файла недоступен. Вы можете скачать файл.');
         }
         else if (textTypes.includes(ext)) {
-            fetch(fileUrl)
-                .then(response => {
-                    if (!response.ok) throw new Error('Network response was not ok');
-                    const contentType = response.headers.get('content-type');
-                    let charset = 'utf-8';
-                    if (contentType && contentType.includes('charset=')) {
-                        charset = contentType.split('charset=')[1].split(';')[0];
-                    }
-                    return response.arrayBuffer().then(buffer => {
-                        try {
-                            return new TextDecoder(charset, { fatal: true }).decode(buffer);
-                        } catch (e) {
-                            try {
-                                console.warn(`Failed to decode with ${charset}, trying windows-1251`);
-                                return new TextDecoder('windows-1251', { fatal: true }).decode(buffer);
-                            } catch (e2) {
-                                console.warn('Failed to decode with windows-1251, trying default');
-                                return new TextDecoder().decode(buffer);
-                            }
-                        }
+            // Сервер отдает файл окнами строк, поэтому большой лог не скачивается целиком
+            const pre = document.createElement('pre');
+            pre.className = 'preview-text';
+            const moreButton = document.createElement('button');
+            moreButton.className = 'btn btn-primary';
+            moreButton.textContent = 'Показать еще';
+            moreButton.style.display = 'none';
+
+            const loadWindow = (offset) => {
+                moreButton.disabled = true;
+                return fetch(`/${this.linkId}/preview/${encodeURIComponent(filename)}?lines=500&offset=${offset}`)
+                    .then(response => {
+                        if (!response.ok) throw new Error('Network response was not ok');
+                        return response.json();
+                    })
+                    .then(data => {
+                        // Пользователь мог перейти к другому файлу, пока окно загружалось
+                        if (this.previewableFiles[this.currentIndex] !== filename) return;
+                        pre.appendChild(document.createTextNode((offset > 0 ? '\n' : '') + data.lines.join('\n')));
+                        moreButton.disabled = false;
+                        moreButton.style.display = data.next_offset !== null ? '' : 'none';
+                        moreButton.onclick = () => loadWindow(data.next_offset).catch(error => {
+                            console.error('Error fetching text file:', error);
+                            moreButton.disabled = false;
+                        });
                     });
-                })
-                .then(text => {
-                    const pre = document.createElement('pre');
-                    pre.className = 'preview-text';
-                    pre.textContent = text;
+            };
+
+            loadWindow(0)
+                .then(() => {
+                    if (this.previewableFiles[this.currentIndex] !== filename) return;
                     this.previewContainer.innerHTML = '';
                     this.previewContainer.appendChild(pre);
+                    this.previewContainer.appendChild(moreButton);
                 })
                 .catch(error => {
                     console.error('Error fetching text file:', error);
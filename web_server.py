@@ -1,46 +1,43 @@
-from flask import Flask, send_file, request, render_template, jsonify, session, redirect, url_for, send_from_directory
+from flask import Flask, send_file, request, render_template, jsonify, session, redirect, url_for, send_from_directory, Response, stream_with_context, g
 from flask_session import Session
 import sqlite3
-import aiosqlite
-import asyncio
+import queue
 import os
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import shutil
 import secrets
 from werkzeug.utils import secure_filename
+from werkzeug.http import parse_range_header, is_resource_modified, http_date
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 import threading
 import time
+import atexit
 import tempfile
 import zipfile
-from io import BytesIO
 from functools import wraps
+from contextlib import contextmanager
 import pytz
 import re
 from dotenv import load_dotenv
 import html
 import hashlib
-from collections import defaultdict
+import json
+import codecs
+from collections import defaultdict, OrderedDict
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps, features
 import traceback  # Добавляем импорт traceback
-from urllib.parse import unquote  # Добавляем unquote
+from urllib.parse import unquote, quote  # Добавляем unquote
 import math  # Добавляем импорт math
+from db_migrations import apply_migrations
+from storage_records import delete_storage_records
 
 # Загружаем переменные окружения из .env файла
 from dotenv import load_dotenv
 load_dotenv()
 
-# Функция для выполнения асинхронных задач в синхронном контексте Flask
-def run_async(func):
-    """Декоратор для запуска асинхронных функций в синхронном контексте Flask"""
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        loop = asyncio.new_event_loop()
-        try:
-            return loop.run_until_complete(func(*args, **kwargs))
-        finally:
-            loop.close()
-    return wrapper
-
 # Создаем необходимые директории
 os.makedirs('logs', exist_ok=True)
 
@@ -61,6 +58,78 @@ TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
 STATIC_DIR = os.path.join(BASE_DIR, 'web', 'static')  # Добавляем путь к статическим файлам
 DB_PATH = os.path.join(BASE_DIR, 'bot_users.db')
 TEMP_STORAGE_DIR = os.path.join(BASE_DIR, 'temp_storage')
+# Хранилище блобов для дедупликации; должно быть на той же файловой системе, что и TEMP_STORAGE_DIR
+BLOB_STORAGE_DIR = os.getenv('BLOB_STORAGE_DIR', os.path.join(BASE_DIR, 'blob_storage'))
+THUMBNAIL_CACHE_DIR = os.path.join(BASE_DIR, 'thumbnail_cache')
+
+# Размер пула соединений с базой данных
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+
+class SQLiteConnectionPool:
+    """Пул долгоживущих соединений sqlite3, общий для всех потоков Flask.
+
+    Соединения создаются лениво и возвращаются в пул после использования,
+    поэтому запрос к БД не создает ни нового event loop, ни нового подключения.
+    Каждое соединение хранит кэш подготовленных выражений (cached_statements).
+    """
+
+    def __init__(self, db_path, size):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self._pool = queue.LifoQueue(maxsize=self.size)
+
+    def _connect(self):
+        """Создает новое соединение с включенным WAL-режимом"""
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Выдает соединение из пула и возвращает его обратно после использования"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                # Пул заполнен - лишнее соединение закрываем
+                conn.close()
+
+    def close_all(self):
+        """Закрывает все простаивающие соединения пула"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+db_pool = SQLiteConnectionPool(DB_PATH, DB_POOL_SIZE)
+
+def db_fetchone(query, params=()):
+    """Выполняет SELECT и возвращает первую строку результата"""
+    with db_pool.connection() as conn:
+        return conn.execute(query, params).fetchone()
+
+def db_fetchall(query, params=()):
+    """Выполняет SELECT и возвращает все строки результата"""
+    with db_pool.connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+def db_execute(query, params=()):
+    """Выполняет изменяющий запрос с фиксацией транзакции, возвращает rowcount"""
+    with db_pool.connection() as conn:
+        cursor = conn.execute(query, params)
+        conn.commit()
+        return cursor.rowcount
 
 app = Flask(__name__, template_folder=TEMPLATE_DIR, static_folder=STATIC_DIR)
 
@@ -97,6 +166,10 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', secrets.token_hex(32))
 STORAGE_EXPIRATION_DAYS = int(os.getenv('STORAGE_EXPIRATION_DAYS', 7))
 app.config['STORAGE_EXPIRATION_DAYS'] = STORAGE_EXPIRATION_DAYS
 
+# Кэш проверки валидности хранилищ (количество записей и время жизни записи в секундах)
+app.config['STORAGE_CACHE_SIZE'] = int(os.getenv('STORAGE_CACHE_SIZE', 1024))
+app.config['STORAGE_CACHE_TTL'] = int(os.getenv('STORAGE_CACHE_TTL', 300))
+
 # Включение/отключение проверки CSRF (для отладки можно отключить)
 CSRF_PROTECTION_ENABLED = os.getenv('CSRF_PROTECTION_ENABLED', 'true').lower() == 'true'
 app.config['CSRF_PROTECTION_ENABLED'] = CSRF_PROTECTION_ENABLED
@@ -120,6 +193,18 @@ app.config['BLOCK_TIME_SECONDS'] = int(os.getenv('BLOCK_TIME_SECONDS'))  # Бы
 # Отключаем кэширование ответов для предотвращения устаревших данных
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
+# Политика кэширования скачиваемых файлов: только в браузере пользователя (private).
+# По умолчанию браузер перепроверяет файл по ETag при каждом обращении и получает 304 без тела
+app.config['DOWNLOAD_CACHE_MAX_AGE'] = int(os.getenv('DOWNLOAD_CACHE_MAX_AGE', 0))
+
+# Режим отдачи файлов фронтенд-прокси: '' — файл отдает сам Flask,
+# 'nginx' — заголовок X-Accel-Redirect, 'sendfile' — заголовок X-Sendfile (Apache, lighttpd)
+app.config['DOWNLOAD_OFFLOAD_MODE'] = os.getenv('DOWNLOAD_OFFLOAD_MODE', '').strip().lower()
+# internal-location nginx, которая указывает на TEMP_STORAGE_DIR
+app.config['DOWNLOAD_OFFLOAD_PREFIX'] = os.getenv('DOWNLOAD_OFFLOAD_PREFIX', '/protected_storage/')
+if app.config['DOWNLOAD_OFFLOAD_MODE'] not in ('', 'nginx', 'sendfile'):
+    raise ValueError(f"Неизвестный DOWNLOAD_OFFLOAD_MODE: {app.config['DOWNLOAD_OFFLOAD_MODE']}")
+
 # Инициализация сессий
 Session(app)
 
@@ -129,6 +214,14 @@ app.config['MAX_CONTENT_LENGTH'] = None
 # Добавляем конфигурацию для загрузки файлов
 app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv('UPLOAD_CHUNK_SIZE', 64)) * 1024  # по умолчанию 64 KB
 app.config['MAX_CHUNK_SIZE'] = int(os.getenv('MAX_CHUNK_SIZE', 2)) * 1024 * 1024  # по умолчанию 2 MB
+# Сколько файлов показывать на одной странице хранилища
+app.config['STORAGE_PAGE_SIZE'] = int(os.getenv('STORAGE_PAGE_SIZE', 100))
+# Через сколько часов без новых чанков незавершенная загрузка считается брошенной
+app.config['UPLOAD_SESSION_TTL_HOURS'] = int(os.getenv('UPLOAD_SESSION_TTL_HOURS', 24))
+# Дедупликация: одинаковые файлы разных хранилищ хранятся на диске один раз (жесткие ссылки на блоб по SHA-256)
+app.config['STORAGE_DEDUP_ENABLED'] = os.getenv('STORAGE_DEDUP_ENABLED', 'false').lower() == 'true'
+# Сколько миниатюр изображений может генерироваться одновременно
+app.config['THUMBNAIL_WORKERS'] = int(os.getenv('THUMBNAIL_WORKERS', 2))
 
 # Константа для количества строк по умолчанию
 DEFAULT_LINES_TO_KEEP = int(os.getenv('DEFAULT_LINES_TO_KEEP', 10))
@@ -247,8 +340,13 @@ def add_security_headers(response):
         "worker-src 'self' blob:;"
     )
     response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
+    # Маршруты с декоратором cache_policy задают собственную политику кэширования для успешных ответов
+    route_cache_control = g.get('cache_control')
+    if route_cache_control and response.status_code in (200, 206, 304):
+        response.headers['Cache-Control'] = route_cache_control
+    else:
+        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+        response.headers['Pragma'] = 'no-cache'
     response.headers['Referrer-Policy'] = 'same-origin'
     response.headers['Permissions-Policy'] = 'geolocation=(), microphone=(), camera=()'
 
@@ -268,6 +366,111 @@ def add_security_headers(response):
 
     return response
 
+# Параметры фоновой записи access_log
+app.config['ACCESS_LOG_QUEUE_SIZE'] = int(os.getenv('ACCESS_LOG_QUEUE_SIZE', 10000))
+app.config['ACCESS_LOG_BATCH_SIZE'] = int(os.getenv('ACCESS_LOG_BATCH_SIZE', 200))
+app.config['ACCESS_LOG_FLUSH_INTERVAL'] = float(os.getenv('ACCESS_LOG_FLUSH_INTERVAL', 2))
+
+class AccessLogWriter:
+    """Фоновая пакетная запись access_log.
+
+    Поток запроса только кладет кортеж в ограниченную очередь. Единственный
+    поток-писатель забирает записи и вставляет их через executemany, когда
+    набирается пакет или истекает интервал. При переполнении очереди запись
+    отбрасывается и учитывается в счетчике dropped.
+    """
+
+    INSERT_QUERY = ('INSERT INTO access_log (timestamp, ip_address, user_agent, request_path, '
+                    'request_method, status_code, response_time) VALUES (?, ?, ?, ?, ?, ?, ?)')
+
+    def __init__(self, queue_size, batch_size, flush_interval):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='access-log-writer', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, row):
+        """Кладет запись в очередь, не блокируя поток запроса"""
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Очередь access_log переполнена, отброшено записей: {self.dropped}")
+
+    def _collect_batch(self):
+        """Ждет первую запись и добирает пакет до batch_size или до истечения интервала"""
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop_event.is_set():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            with db_pool.connection() as conn:
+                conn.executemany(self.INSERT_QUERY, batch)
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при записи {len(batch)} записей access_log в БД: {str(e)}")
+
+    def _drain(self):
+        """Забирает из очереди все накопленные записи"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._collect_batch()
+            if batch:
+                self._write(batch)
+        # Дописываем остаток очереди перед завершением
+        batch = self._drain()
+        if batch:
+            self._write(batch)
+
+    def stop(self, timeout=10):
+        """Останавливает поток-писатель, дописав все записи из очереди"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            batch = self._drain()
+            if batch:
+                self._write(batch)
+        if self.dropped:
+            logger.warning(f"Всего отброшено записей access_log из-за переполнения очереди: {self.dropped}")
+
+access_log_writer = AccessLogWriter(
+    app.config['ACCESS_LOG_QUEUE_SIZE'],
+    app.config['ACCESS_LOG_BATCH_SIZE'],
+    app.config['ACCESS_LOG_FLUSH_INTERVAL']
+)
+access_log_writer.start()
+atexit.register(access_log_writer.stop)
+
 @app.after_request
 def log_request(response):
     """Логирует информацию о запросе после его завершения"""
@@ -292,34 +495,22 @@ def log_request(response):
     else:
         logger.info(log_message)
         
-    # Асинхронно сохраняем информацию о запросе в базу данных
-    @run_async
-    async def log_to_db():
-        try:
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            path = request.path[:255]  # Ограничиваем длину пути
-            method = request.method[:10]  # Ограничиваем длину метода
-            
-            async with aiosqlite.connect(DB_PATH) as conn:
-                await conn.execute(
-                    'INSERT INTO access_log (timestamp, ip_address, user_agent, request_path, request_method, status_code, response_time) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                    (current_time, ip_address, user_agent, path, method, response.status_code, duration)
-                )
-                await conn.commit()
-        except Exception as e:
-            logger.error(f"Ошибка при логировании запроса в БД: {str(e)}")
-    
-    # Запускаем асинхронное логирование, только если это не обращение к статическим файлам
+    # Передаем запись в фоновый писатель access_log, только если это не обращение к статическим файлам
     if not request.path.startswith('/static/'):
-        try:
-            log_to_db()
-        except Exception as e:
-            logger.error(f"Ошибка при запуске асинхронного логирования: {str(e)}")
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        path = request.path[:255]  # Ограничиваем длину пути
+        method = request.method[:10]  # Ограничиваем длину метода
+        access_log_writer.enqueue(
+            (current_time, ip_address, user_agent, path, method, response.status_code, duration)
+        )
     
     return response
 
 # Создаем необходимые директории
 os.makedirs(TEMP_STORAGE_DIR, exist_ok=True)
+os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+if app.config['STORAGE_DEDUP_ENABLED']:
+    os.makedirs(BLOB_STORAGE_DIR, exist_ok=True)
 os.makedirs(app.config['SESSION_FILE_DIR'], exist_ok=True)  # Создаем директорию для сессий
 
 # Логирование загруженных конфигураций
@@ -330,293 +521,424 @@ logger.info(f"MAX_FILES_PER_STORAGE: {MAX_FILES_PER_STORAGE} (0 = не огра
 logger.info(f"ALLOWED_EXTENSIONS: {ALLOWED_EXTENSIONS_STRING}")
 logger.info(f"STORAGE_EXPIRATION_DAYS: {STORAGE_EXPIRATION_DAYS}")
 logger.info(f"CSRF_PROTECTION_ENABLED: {CSRF_PROTECTION_ENABLED}")
+logger.info(f"DOWNLOAD_OFFLOAD_MODE: {app.config['DOWNLOAD_OFFLOAD_MODE'] or 'выключен'}")
 
 # Инициализация базы данных
-async def init_db_async():
-    """Асинхронная инициализация базы данных"""
+def init_db():
+    """Инициализация базы данных: применяет недостающие миграции схемы (см. db_migrations)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # Включаем защиту от внешних ключей
-            await conn.execute("PRAGMA foreign_keys = ON")
-            
-            # Включаем WAL-режим для улучшения конкурентности и безопасности
-            await conn.execute("PRAGMA journal_mode = WAL")
-            
-            # Создаем таблицу настроек пользователя, если её нет
-            await conn.execute('''CREATE TABLE IF NOT EXISTS user_settings
-                         (user_id INTEGER PRIMARY KEY,
-                          lines_to_keep INTEGER DEFAULT 10,
-                          theme TEXT DEFAULT 'dark')''')
-            
-            # Проверяем, есть ли колонка theme
-            cursor = await conn.execute("PRAGMA table_info(user_settings)")
-            columns_raw = await cursor.fetchall()
-            columns = [column[1] for column in columns_raw]
-            
-            # Если колонки theme нет, добавляем её
-            if 'theme' not in columns:
-                await conn.execute('ALTER TABLE user_settings ADD COLUMN theme TEXT DEFAULT "dark"')
-            
-            # Проверяем, есть ли таблица temp_links
-            cursor = await conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='temp_links'")
-            table_exists = await cursor.fetchone()
-            
-            # Если таблица не существует, создаем её
-            if not table_exists:
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS temp_links (
-                        link_id TEXT PRIMARY KEY,
-                        expires_at TEXT NOT NULL,
-                        user_id INTEGER,
-                        created_at TEXT,
-                        extension_count INTEGER DEFAULT 0
-                    )
-                ''')
-                logger.info("Создана таблица temp_links")
-            
-            # Если таблица существует, проверяем наличие нужных колонок
-            else:
-                cursor = await conn.execute("PRAGMA table_info(temp_links)")
-                columns_raw = await cursor.fetchall()
-                columns = [column[1] for column in columns_raw]
-                
-                # Если колонки created_at нет, добавляем её
-                if 'created_at' not in columns:
-                    try:
-                        # Добавляем колонку created_at
-                        await conn.execute('ALTER TABLE temp_links ADD COLUMN created_at TEXT')
-                        
-                        # Обновляем значения created_at на основе expires_at
-                        # Предполагаем, что хранилище было создано за 7 дней до истечения срока
-                        cursor = await conn.execute('SELECT link_id, expires_at FROM temp_links')
-                        links = await cursor.fetchall()
-                        
-                        for link in links:
-                            link_id, expires_at = link
-                            if expires_at:
-                                # Очищаем от микросекунд
-                                if '.' in expires_at:
-                                    expires_at = expires_at.split('.')[0]
-                                    
-                                try:
-                                    # Преобразуем в datetime и вычитаем 7 дней
-                                    expires_datetime = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S')
-                                    created_datetime = expires_datetime - timedelta(days=7)
-                                    created_at = created_datetime.strftime('%Y-%m-%d %H:%M:%S')
-                                    
-                                    # Обновляем запись с использованием параметризованного запроса
-                                    await conn.execute('UPDATE temp_links SET created_at = ? WHERE link_id = ?', 
-                                                    (created_at, link_id))
-                                except Exception as e:
-                                    logger.error(f"Ошибка при обновлении created_at для {link_id}: {str(e)}")
-                        
-                        logger.info("Добавлена колонка created_at в таблицу temp_links")
-                    except Exception as e:
-                        logger.error(f"Ошибка при добавлении колонки created_at: {str(e)}")
-                
-                # Если колонки extension_count нет, добавляем её
-                if 'extension_count' not in columns:
-                    try:
-                        # Добавляем колонку extension_count
-                        await conn.execute('ALTER TABLE temp_links ADD COLUMN extension_count INTEGER DEFAULT 0')
-                        logger.info("Добавлена колонка extension_count в таблицу temp_links")
-                    except Exception as e:
-                        logger.error(f"Ошибка при добавлении колонки extension_count: {str(e)}")
-            
-            # Добавляем индекс для ускорения поиска по expires_at
-            try:
-                await conn.execute('CREATE INDEX IF NOT EXISTS idx_temp_links_expires_at ON temp_links(expires_at)')
-                logger.info("Создан индекс на колонку expires_at")
-            except Exception as e:
-                logger.error(f"Ошибка при создании индекса: {str(e)}")
-                
-            # Создаем таблицу для логирования доступа, если её нет
-            try:
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS access_log (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        timestamp TEXT NOT NULL,
-                        ip_address TEXT,
-                        user_agent TEXT,
-                        request_path TEXT,
-                        request_method TEXT,
-                        status_code INTEGER,
-                        response_time REAL
-                    )
-                ''')
-                logger.info("Создана таблица access_log")
-            except Exception as e:
-                logger.error(f"Ошибка при создании таблицы access_log: {str(e)}")
-                
-            await conn.commit()
+        schema_version = apply_migrations(DB_PATH)
+        logger.info(f"Схема базы данных актуальна (версия {schema_version})")
     except Exception as e:
         logger.error(f"Ошибка при инициализации базы данных: {str(e)}")
         raise
 
-# Синхронная обертка для инициализации базы данных
-def init_db():
-    """Инициализация базы данных"""
-    return run_async(init_db_async)()
-
 # Инициализируем базу данных при запуске
 init_db()
 
-# Асинхронная функция для получения user_id по link_id
-async def get_user_id_by_link_id_async(link_id):
-    """Асинхронное получение user_id по link_id"""
+def get_user_id_by_link_id(link_id):
+    """Получение user_id по link_id"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute('SELECT user_id FROM temp_links WHERE link_id = ?', (link_id,))
-            result = await cursor.fetchone()
-            return result[0] if result else None
+        result = db_fetchone('SELECT user_id FROM temp_links WHERE link_id = ?', (link_id,))
+        return result[0] if result else None
     except Exception as e:
         logger.error(f"Ошибка при получении user_id для link_id {link_id}: {str(e)}")
         return None
 
-# Синхронная обертка
-def get_user_id_by_link_id(link_id):
-    """Получение user_id по link_id (синхронная обертка)"""
-    return run_async(get_user_id_by_link_id_async)(link_id)
-
 def get_temp_storage_path(link_id):
     """Получение пути к временному хранилищу"""
     return os.path.join(TEMP_STORAGE_DIR, link_id)
 
-def get_temp_storage_size(link_id):
-    """Получение размера временного хранилища"""
-    storage_path = get_temp_storage_path(link_id)
-    if not os.path.exists(storage_path):
-        return 0
-    total_size = 0
-    for dirpath, _, filenames in os.walk(storage_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return max(0, total_size)  # Гарантируем положительное значение
-
 def check_temp_storage_limit(link_id):
     """Проверка лимита временного хранилища (500 MB)"""
-    return get_temp_storage_size(link_id) < 500 * 1024 * 1024
+    return get_storage_usage(link_id)[0] < 500 * 1024 * 1024
 
-async def is_temp_storage_valid_async(link_id):
-    """Асинхронная проверка валидности временного хранилища"""
+def is_upload_part_file(filename):
+    """Проверяет, является ли файл незавершенной загрузкой (upload_<session>.part)"""
+    return filename.startswith('upload_') and filename.endswith('.part')
+
+def get_file_extension(filename):
+    """Расширение файла в нижнем регистре (пустая строка, если его нет)"""
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+def scan_storage_files(link_id):
+    """Обходит хранилище на диске: возвращает (занятые байты, [(имя, размер, mtime), ...])"""
+    storage_path = get_temp_storage_path(link_id)
+    used_bytes = 0
+    files = []
     try:
-        # Получаем текущее московское время
-        from datetime import datetime
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        now = datetime.now(moscow_tz)
-        current_time_iso = now.strftime('%Y-%m-%d %H:%M:%S')
-        
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # Сначала проверяем существование хранилища
-            cursor = await conn.execute('SELECT expires_at FROM temp_links WHERE link_id = ?', (link_id,))
-            result = await cursor.fetchone()
-            
-            if not result:
+        with os.scandir(storage_path) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                entry_stat = entry.stat(follow_symlinks=False)
+                used_bytes += entry_stat.st_size
+                # Незавершенные загрузки занимают место, но не считаются файлами
+                if not is_upload_part_file(entry.name):
+                    files.append((entry.name, entry_stat.st_size, entry_stat.st_mtime))
+    except FileNotFoundError:
+        pass
+    return max(0, used_bytes), files
+
+def make_file_index_row(link_id, filename, size, mtime):
+    """Строка индекса файлов: расширение и иконка вычисляются один раз при индексации"""
+    extension = get_file_extension(filename)
+    return (link_id, filename, size, mtime, extension, get_icon_class(extension))
+
+def seed_storage_state(link_id):
+    """Сканирует хранилище на диске и заново записывает его учет места и индекс файлов.
+
+    Версия списка файлов увеличивается, а base_version подтягивается к ней:
+    клиенты с более старой версией получат список целиком, а не разницу.
+    Начальная версия новой записи — текущее время, чтобы версии не повторялись
+    после удаления и повторного создания учета.
+    """
+    used_bytes, files = scan_storage_files(link_id)
+    with db_pool.connection() as conn:
+        initial_version = int(time.time())
+        conn.execute(
+            '''INSERT INTO storage_usage (link_id, used_bytes, file_count, updated_at, version, base_version)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(link_id) DO UPDATE SET used_bytes = excluded.used_bytes,
+                                                  file_count = excluded.file_count,
+                                                  updated_at = excluded.updated_at,
+                                                  version = version + 1,
+                                                  base_version = version + 1''',
+            (link_id, used_bytes, len(files), datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+             initial_version, initial_version)
+        )
+        version = conn.execute('SELECT version FROM storage_usage WHERE link_id = ?', (link_id,)).fetchone()[0]
+        conn.execute('DELETE FROM storage_files WHERE link_id = ?', (link_id,))
+        conn.executemany(
+            '''INSERT INTO storage_files (link_id, filename, size, mtime, extension, icon_class, version)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            [make_file_index_row(link_id, name, size, mtime) + (version,) for name, size, mtime in files]
+        )
+        conn.commit()
+    return used_bytes, len(files)
+
+def bump_storage_version(conn, link_id):
+    """Увеличивает версию списка файлов хранилища в рамках транзакции conn.
+
+    Возвращает новую версию или None, если учета хранилища еще нет
+    (тогда индекс будет заполнен сканированием при первом обращении).
+    """
+    if conn.execute('UPDATE storage_usage SET version = version + 1 WHERE link_id = ?', (link_id,)).rowcount == 0:
+        return None
+    return conn.execute('SELECT version FROM storage_usage WHERE link_id = ?', (link_id,)).fetchone()[0]
+
+def index_storage_file(link_id, filename, file_path):
+    """Добавляет или обновляет файл в индексе хранилища"""
+    try:
+        file_stat = os.stat(file_path)
+        with db_pool.connection() as conn:
+            version = bump_storage_version(conn, link_id)
+            if version is not None:
+                conn.execute(
+                    '''INSERT OR REPLACE INTO storage_files (link_id, filename, size, mtime, extension, icon_class, version, deleted)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, 0)''',
+                    make_file_index_row(link_id, filename, file_stat.st_size, file_stat.st_mtime) + (version,)
+                )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Ошибка при индексации файла {filename} хранилища {link_id}: {str(e)}")
+
+def unindex_storage_file(link_id, filename):
+    """Помечает файл удаленным в индексе хранилища (для передачи удаления клиентам по версии)"""
+    try:
+        with db_pool.connection() as conn:
+            version = bump_storage_version(conn, link_id)
+            if version is not None:
+                conn.execute(
+                    'UPDATE storage_files SET deleted = 1, version = ? WHERE link_id = ? AND filename = ?',
+                    (version, link_id, filename)
+                )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Ошибка при удалении файла {filename} из индекса хранилища {link_id}: {str(e)}")
+
+# Допустимые поля сортировки списка файлов -> колонки индекса
+STORAGE_FILES_SORT_COLUMNS = {
+    'name': 'filename COLLATE NOCASE',
+    'ext': 'extension',
+    'size': 'size',
+    'modified': 'mtime',
+}
+
+def get_storage_files(link_id, sort='modified', order='desc', limit=100, offset=0):
+    """Страница списка файлов хранилища из индекса: ([файлы], общее количество)"""
+    # Учет места и индекс заполняются вместе при первом обращении к хранилищу
+    _, file_count = get_storage_usage(link_id)
+    column = STORAGE_FILES_SORT_COLUMNS.get(sort, STORAGE_FILES_SORT_COLUMNS['modified'])
+    direction = 'ASC' if order == 'asc' else 'DESC'
+    rows = db_fetchall(
+        f'''SELECT filename, size, mtime, extension, icon_class FROM storage_files
+            WHERE link_id = ? AND deleted = 0 ORDER BY {column} {direction}, filename LIMIT ? OFFSET ?''',
+        (link_id, limit, offset)
+    )
+    files = [{
+        'name': html.escape(filename),  # Экранируем имя файла для предотвращения XSS
+        'raw_name': filename,  # Оригинальное имя для операций с файлами
+        'size': size,
+        'modified': datetime.fromtimestamp(mtime),
+        'ext': extension,
+        'icon_class': icon_class,
+    } for filename, size, mtime, extension, icon_class in rows]
+    return files, file_count
+
+def get_storage_version(link_id):
+    """Возвращает (версия списка файлов, минимальная версия, от которой возможна разница)"""
+    get_storage_usage(link_id)
+    result = db_fetchone('SELECT version, base_version FROM storage_usage WHERE link_id = ?', (link_id,))
+    return (result[0], result[1]) if result else (0, 0)
+
+def get_storage_files_changes(link_id, since, until):
+    """Изменения индекса в версиях (since, until]: ([добавленные/измененные файлы], [имена удаленных])"""
+    rows = db_fetchall(
+        '''SELECT filename, size, mtime, extension, icon_class, deleted FROM storage_files
+           WHERE link_id = ? AND version > ? AND version <= ? ORDER BY version''',
+        (link_id, since, until)
+    )
+    upserted = []
+    removed = []
+    for filename, size, mtime, extension, icon_class, deleted in rows:
+        if deleted:
+            removed.append(filename)
+        else:
+            upserted.append({
+                'name': filename,
+                'size': size,
+                'modified': datetime.fromtimestamp(mtime),
+                'ext': extension,
+                'icon_class': icon_class,
+            })
+    return upserted, removed
+
+def update_storage_usage(link_id, bytes_delta=0, files_delta=0):
+    """Инкрементально изменяет учет занятого места и количества файлов хранилища.
+
+    Если записи учета еще нет, ничего не делаем: при следующем чтении
+    get_storage_usage пересчитает хранилище по диску.
+    """
+    if not bytes_delta and not files_delta:
+        return
+    try:
+        db_execute(
+            '''UPDATE storage_usage
+               SET used_bytes = MAX(0, used_bytes + ?), file_count = MAX(0, file_count + ?), updated_at = ?
+               WHERE link_id = ?''',
+            (bytes_delta, files_delta, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), link_id)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении учета места хранилища {link_id}: {str(e)}")
+
+def discard_upload_part(link_id, temp_file_path):
+    """Удаляет временный файл незавершенной загрузки и списывает его размер из учета"""
+    part_size = os.path.getsize(temp_file_path)
+    os.remove(temp_file_path)
+    update_storage_usage(link_id, bytes_delta=-part_size)
+
+def get_storage_usage(link_id):
+    """Возвращает (занятые байты, количество файлов) хранилища из учета.
+
+    Если записи еще нет, хранилище один раз сканируется на диске
+    (заодно заполняется индекс файлов).
+    """
+    result = db_fetchone('SELECT used_bytes, file_count FROM storage_usage WHERE link_id = ?', (link_id,))
+    if result:
+        return result[0], result[1]
+    return seed_storage_state(link_id)
+
+def delete_storage_usage(link_id):
+    """Удаляет учет занятого места, индекс файлов, ссылки на блобы и миниатюры хранилища"""
+    try:
+        db_execute('DELETE FROM storage_files WHERE link_id = ?', (link_id,))
+        db_execute('DELETE FROM storage_usage WHERE link_id = ?', (link_id,))
+    except Exception as e:
+        logger.error(f"Ошибка при удалении учета места хранилища {link_id}: {str(e)}")
+    release_file_blob(link_id)
+    invalidate_thumbnails(link_id)
+
+def reconcile_storage_usage():
+    """Сверяет учет занятого места с фактическим содержимым хранилищ на диске"""
+    try:
+        link_ids = set()
+        with os.scandir(TEMP_STORAGE_DIR) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    link_ids.add(entry.name)
+
+        corrected = 0
+        ledger = {row[0]: (row[1], row[2]) for row in db_fetchall('SELECT link_id, used_bytes, file_count FROM storage_usage')}
+        for link_id in link_ids:
+            used_bytes, files = scan_storage_files(link_id)
+            indexed = db_fetchall('SELECT filename, size, mtime FROM storage_files WHERE link_id = ? AND deleted = 0', (link_id,))
+            if ledger.get(link_id) != (used_bytes, len(files)) or set(indexed) != set(files):
+                seed_storage_state(link_id)
+                corrected += 1
+
+        # Удаляем учет и индекс хранилищ, директорий которых больше нет
+        stale = [link_id for link_id in ledger if link_id not in link_ids]
+        for link_id in stale:
+            delete_storage_usage(link_id)
+
+        # Убираем пометки удаленных файлов: клиенты со старой версией получат список целиком
+        with db_pool.connection() as conn:
+            conn.execute('''UPDATE storage_usage SET base_version = version
+                            WHERE link_id IN (SELECT DISTINCT link_id FROM storage_files WHERE deleted = 1)''')
+            conn.execute('DELETE FROM storage_files WHERE deleted = 1')
+            conn.commit()
+
+        logger.info(f"Сверка учета места и индекса файлов: проверено {len(link_ids)} хранилищ, исправлено {corrected}, удалено {len(stale)}")
+    except Exception as e:
+        logger.error(f"Ошибка при сверке учета места хранилищ: {str(e)}")
+
+class StorageValidityCache:
+    """Ограниченный LRU-кэш сроков действия хранилищ: link_id -> expires_at (epoch).
+
+    Записи удаляются явно при изменении строки temp_links в веб-сервере и
+    живут не дольше TTL. Бот работает в отдельном процессе, поэтому о своих
+    изменениях (продление, удаление) он сообщает, обновляя mtime файла-маркера;
+    при смене маркера кэш сбрасывается целиком.
+    """
+
+    MARKER_CHECK_INTERVAL = 1.0  # Как часто (в секундах) проверять файл-маркер
+
+    def __init__(self, max_size, ttl, marker_path):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.marker_path = marker_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._marker_mtime = self._read_marker_mtime()
+        self._marker_checked_at = time.monotonic()
+
+    def _read_marker_mtime(self):
+        try:
+            return os.stat(self.marker_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _check_marker(self, now):
+        """Сбрасывает кэш, если бот изменил записи temp_links"""
+        if now - self._marker_checked_at < self.MARKER_CHECK_INTERVAL:
+            return
+        self._marker_checked_at = now
+        marker_mtime = self._read_marker_mtime()
+        if marker_mtime != self._marker_mtime:
+            self._marker_mtime = marker_mtime
+            self._entries.clear()
+
+    def get(self, link_id):
+        """Возвращает срок действия хранилища в epoch или None, если записи нет"""
+        now = time.monotonic()
+        with self._lock:
+            self._check_marker(now)
+            entry = self._entries.get(link_id)
+            if entry is None:
+                return None
+            expires_epoch, cached_at = entry
+            if now - cached_at > self.ttl:
+                del self._entries[link_id]
+                return None
+            self._entries.move_to_end(link_id)
+            return expires_epoch
+
+    def set(self, link_id, expires_epoch):
+        with self._lock:
+            self._entries[link_id] = (expires_epoch, time.monotonic())
+            self._entries.move_to_end(link_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, link_id):
+        with self._lock:
+            self._entries.pop(link_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+storage_validity_cache = StorageValidityCache(
+    app.config['STORAGE_CACHE_SIZE'],
+    app.config['STORAGE_CACHE_TTL'],
+    os.path.join(TEMP_STORAGE_DIR, '.cache_generation')
+)
+
+def format_moscow_datetime(epoch):
+    """Форматирует epoch как московское время для логов и страниц"""
+    return datetime.fromtimestamp(epoch, pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
+
+def load_storage_expiry(link_id):
+    """Читает срок действия хранилища из БД и возвращает его в epoch (None, если хранилища нет)"""
+    with db_pool.connection() as conn:
+        result = conn.execute('SELECT expires_at, created_at FROM temp_links WHERE link_id = ?', (link_id,)).fetchone()
+        if not result:
+            return None
+
+        expires_epoch, created_at = result
+
+        # Обновляем срок действия хранилища, если изменилась настройка STORAGE_EXPIRATION_DAYS
+        if app.config['STORAGE_EXPIRATION_DAYS'] != 7 and created_at:  # Если отличается от дефолтной
+            try:
+                new_expires_epoch = created_at + app.config['STORAGE_EXPIRATION_DAYS'] * 86400
+                if new_expires_epoch != expires_epoch:
+                    logger.info(f"Обновляем срок действия хранилища {link_id} с {format_moscow_datetime(expires_epoch)} на {format_moscow_datetime(new_expires_epoch)}")
+                    conn.execute('UPDATE temp_links SET expires_at = ? WHERE link_id = ?', (new_expires_epoch, link_id))
+                    conn.commit()
+                    expires_epoch = new_expires_epoch
+                    expiry_scheduler.schedule(link_id, expires_epoch)
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении срока действия хранилища {link_id}: {str(e)}")
+
+        return expires_epoch
+
+def is_temp_storage_valid(link_id):
+    """Проверка валидности временного хранилища (через кэш сроков действия)"""
+    try:
+        expires_epoch = storage_validity_cache.get(link_id)
+        if expires_epoch is None:
+            expires_epoch = load_storage_expiry(link_id)
+            if expires_epoch is None:
                 logger.info(f"Хранилище {link_id} не найдено")
                 return False
-                
-            # Получаем дату истечения и убираем микросекунды, если они есть
-            expires_at = result[0]
-            if '.' in expires_at:
-                expires_at = expires_at.split('.')[0]
-                
-            # Обновляем срок действия хранилища, если изменилась настройка STORAGE_EXPIRATION_DAYS
-            if app.config['STORAGE_EXPIRATION_DAYS'] != 7:  # Если отличается от дефолтной
-                try:
-                    # Проверяем наличие поля created_at в таблице temp_links
-                    cursor = await conn.execute("PRAGMA table_info(temp_links)")
-                    columns = await cursor.fetchall()
-                    column_names = [column[1] for column in columns]
-                    
-                    has_created_at = 'created_at' in column_names
-                    
-                    if has_created_at:
-                        # Получаем время создания хранилища
-                        cursor = await conn.execute('SELECT created_at FROM temp_links WHERE link_id = ?', (link_id,))
-                        created_result = await cursor.fetchone()
-                        
-                        if created_result and created_result[0]:
-                            created_at = created_result[0]
-                            # Если есть поле created_at, вычисляем новое expires_at
-                            if '.' in created_at:
-                                created_at = created_at.split('.')[0]
-                                
-                            # Преобразуем строку в объект datetime
-                            created_datetime = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
-                            created_datetime = moscow_tz.localize(created_datetime)
-                            
-                            # Вычисляем новую дату истечения
-                            new_expires_datetime = created_datetime + timedelta(days=app.config['STORAGE_EXPIRATION_DAYS'])
-                            new_expires_at = new_expires_datetime.strftime('%Y-%m-%d %H:%M:%S')
-                            
-                            # Проверяем, отличается ли новая дата истечения от текущей
-                            if new_expires_at != expires_at:
-                                logger.info(f"Обновляем срок действия хранилища {link_id} с {expires_at} на {new_expires_at}")
-                                await conn.execute('UPDATE temp_links SET expires_at = ? WHERE link_id = ?', 
-                                                (new_expires_at, link_id))
-                                await conn.commit()
-                                expires_at = new_expires_at
-                    else:
-                        logger.warning(f"Поле created_at не найдено в таблице temp_links. Срок действия хранилища {link_id} не обновлен.")
-                except Exception as e:
-                    logger.error(f"Ошибка при обновлении срока действия хранилища {link_id}: {str(e)}")
-                    
-            # Сравниваем даты в строковом формате
-            is_valid = expires_at > current_time_iso
-            
-            if not is_valid:
-                logger.info(f"Хранилище {link_id} истекло ({expires_at} <= {current_time_iso})")
-            else:
-                logger.info(f"Хранилище {link_id} действительно ({expires_at} > {current_time_iso})")
-                
-            return is_valid
-                
+            storage_validity_cache.set(link_id, expires_epoch)
+
+        is_valid = expires_epoch > time.time()
+        if not is_valid:
+            logger.info(f"Хранилище {link_id} истекло")
+            storage_validity_cache.invalidate(link_id)
+        return is_valid
+
     except Exception as e:
         logger.error(f"Ошибка при проверке срока действия хранилища {link_id}: {str(e)}")
         return False
 
-def is_temp_storage_valid(link_id):
-    """Проверка валидности временного хранилища (синхронная обертка)"""
-    return run_async(is_temp_storage_valid_async)(link_id)
-
-async def get_user_theme_async(user_id):
-    """Асинхронное получение темы пользователя"""
+def get_user_theme(user_id):
+    """Получение темы пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute('SELECT theme FROM user_settings WHERE user_id = ?', (user_id,))
-            result = await cursor.fetchone()
-            return result[0] if result and result[0] else 'dark'
+        result = db_fetchone('SELECT theme FROM user_settings WHERE user_id = ?', (user_id,))
+        return result[0] if result and result[0] else 'dark'
     except Exception as e:
         logger.error(f"Ошибка при получении темы пользователя: {str(e)}")
         return 'dark'
 
-def get_user_theme(user_id):
-    """Получение темы пользователя (синхронная обертка)"""
-    return run_async(get_user_theme_async)(user_id)
-
-async def set_user_theme_async(user_id, theme):
-    """Асинхронная установка темы пользователя"""
+def set_user_theme(user_id, theme):
+    """Установка темы пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''INSERT OR REPLACE INTO user_settings 
-                         (user_id, theme, lines_to_keep) 
-                         VALUES (?, ?, 
-                                COALESCE((SELECT lines_to_keep FROM user_settings WHERE user_id = ?), 
-                                ?))''', 
-                     (user_id, theme, user_id, DEFAULT_LINES_TO_KEEP))
-            await conn.commit()
-            logger.info(f"Тема '{theme}' успешно установлена для пользователя {user_id}")  # Добавлено логирование успеха
-            return True
+        db_execute('''INSERT OR REPLACE INTO user_settings 
+                     (user_id, theme, lines_to_keep) 
+                     VALUES (?, ?, 
+                            COALESCE((SELECT lines_to_keep FROM user_settings WHERE user_id = ?), 
+                            ?))''', 
+                 (user_id, theme, user_id, DEFAULT_LINES_TO_KEEP))
+        logger.info(f"Тема '{theme}' успешно установлена для пользователя {user_id}")  # Добавлено логирование успеха
+        return True
     except Exception as e:
         # Логируем конкретную ошибку базы данных
         logger.error(f"Ошибка базы данных при установке темы для пользователя {user_id}: {str(e)}", exc_info=True)
         return False
 
-def set_user_theme(user_id, theme):
-    """Установка темы пользователя (синхронная обертка)"""
-    return run_async(set_user_theme_async)(user_id, theme)
-
 # Функция для проверки валидности расширения файла
 def allowed_file(filename):
     """Проверяет, что загружаемый файл имеет разрешенное расширение из белого списка"""
@@ -722,6 +1044,16 @@ def csrf_protected(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def cache_policy(cache_control):
+    """Декоратор: задает маршруту собственный Cache-Control вместо глобального no-store"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            g.cache_control = cache_control() if callable(cache_control) else cache_control
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 # Внедряем CSRF токен в шаблоны
 @app.context_processor
 def inject_csrf_token():
@@ -802,49 +1134,174 @@ app.jinja_env.globals.update(format_file_size=format_file_size)
 
 # --- Добавленные функции для очистки ---
 
-async def cleanup_expired_storages_async():
-    """Асинхронная очистка истекших временных хранилищ"""
-    try:
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        now = datetime.now(moscow_tz)
-        current_time_iso = now.strftime('%Y-%m-%d %H:%M:%S')
-        
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # Находим все истекшие хранилища
-            cursor = await conn.execute('SELECT link_id FROM temp_links WHERE expires_at <= ?', (current_time_iso,))
-            expired_links = await cursor.fetchall()
-            
-            if not expired_links:
-                logger.info("Нет истекших хранилищ для очистки.")
-                return
+EXPIRY_DELETE_BATCH_SIZE = 200  # Сколько хранилищ удалять в одной транзакции
 
-            logger.info(f"Найдено {len(expired_links)} истекших хранилищ для удаления.")
-            
-            deleted_count = 0
-            for link_tuple in expired_links:
-                link_id = link_tuple[0]
-                storage_path = get_temp_storage_path(link_id)
-                
-                # Удаляем директорию хранилища
-                if os.path.exists(storage_path):
-                    try:
-                        shutil.rmtree(storage_path)
-                        logger.info(f"Удалена директория истекшего хранилища: {link_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при удалении директории хранилища {link_id}: {str(e)}")
-                
-                # Удаляем запись из базы данных
-                try:
-                    await conn.execute('DELETE FROM temp_links WHERE link_id = ?', (link_id,))
-                    deleted_count += 1
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении записи о хранилище {link_id} из БД: {str(e)}")
+def delete_expired_storages(link_ids):
+    """Удаление истекших временных хранилищ пакетными транзакциями.
 
-            await conn.commit()
-            logger.info(f"Успешно удалено {deleted_count} записей об истекших хранилищах из БД.")
-            
-    except Exception as e:
-        logger.error(f"Ошибка во время очистки истекших хранилищ: {str(e)}")
+    Срок действия перепроверяется в той же транзакции, что и удаление, поэтому
+    хранилище, продленное ботом уже после планирования, не удаляется.
+    Возвращает список удаленных link_id.
+    """
+    current_time = time.time()
+    link_ids = list(link_ids)
+    deleted = []
+    link_files = []
+
+    for start in range(0, len(link_ids), EXPIRY_DELETE_BATCH_SIZE):
+        batch = link_ids[start:start + EXPIRY_DELETE_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch))
+        try:
+            with blob_store_lock:
+                with db_pool.connection() as conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    expired = [row[0] for row in conn.execute(
+                        f'SELECT link_id FROM temp_links WHERE link_id IN ({placeholders}) AND expires_at <= ?',
+                        (*batch, current_time)
+                    )]
+                    # Тот же набор таблиц, что и при удалении хранилища ботом
+                    files, orphaned = delete_storage_records(conn, expired)
+                    conn.commit()
+                remove_blob_files(orphaned)
+            deleted.extend(expired)
+            link_files.extend(files)
+        except Exception as e:
+            logger.error(f"Ошибка при удалении записей об истекших хранилищах из БД: {str(e)}")
+
+    # Файлы и миниатюры убираем после фиксации транзакций
+    remove_link_files(link_files)
+    for link_id in deleted:
+        storage_validity_cache.invalidate(link_id)
+        storage_path = get_temp_storage_path(link_id)
+        if os.path.exists(storage_path):
+            try:
+                shutil.rmtree(storage_path)
+                logger.info(f"Удалена директория истекшего хранилища: {link_id}")
+            except Exception as e:
+                logger.error(f"Ошибка при удалении директории хранилища {link_id}: {str(e)}")
+        drop_storage_upload_sessions(link_id)
+        invalidate_thumbnails(link_id)
+
+    if deleted:
+        logger.info(f"Успешно удалено {len(deleted)} истекших хранилищ.")
+    return deleted
+
+class ExpiryScheduler:
+    """Планировщик удаления истекших хранилищ на мин-куче сроков действия.
+
+    В куче лежат (expires_at в epoch, link_id) хранилищ, истекающих в ближайшие
+    LOAD_HORIZON секунд; они загружаются диапазонным запросом по индексу
+    idx_temp_links_expires_at. Поток спит ровно до ближайшего срока.
+    Изменения в веб-сервере попадают в кучу сразу через schedule/cancel, а
+    хранилища, созданные, продленные или удаленные ботом (отдельный процесс),
+    подхватываются перезагрузкой при смене файла-маркера, который бот обновляет
+    после каждого изменения (проверяется раз в MARKER_CHECK_INTERVAL секунд).
+    Плановая перезагрузка раз в RELOAD_INTERVAL секунд страхует от пропущенных
+    уведомлений: самый короткий срок хранилища в боте — час, поэтому при
+    RELOAD_INTERVAL < LOAD_HORIZON ни один срок не пропускается.
+    """
+
+    LOAD_HORIZON = 3600
+    RELOAD_INTERVAL = 300
+    MARKER_CHECK_INTERVAL = 5
+
+    def __init__(self, marker_path):
+        self.marker_path = marker_path
+        self._heap = []
+        self._deadlines = {}  # link_id -> актуальный срок; записи кучи с другим сроком устарели
+        self._condition = threading.Condition()
+        self._loaded_until = 0.0
+        self._next_reload = 0.0
+        self._marker_mtime = None
+
+    def _marker_changed(self):
+        """Проверяет, обновил ли бот файл-маркер с момента прошлой проверки"""
+        try:
+            marker_mtime = os.stat(self.marker_path).st_mtime_ns
+        except OSError:
+            marker_mtime = None
+        changed = marker_mtime != self._marker_mtime
+        self._marker_mtime = marker_mtime
+        return changed
+
+    def _load(self, now):
+        """Перечитывает из БД сроки хранилищ, истекающих до now + LOAD_HORIZON"""
+        horizon = now + self.LOAD_HORIZON
+        rows = db_fetchall('SELECT link_id, expires_at FROM temp_links WHERE expires_at <= ? ORDER BY expires_at',
+                           (horizon,))
+        deadlines = dict(rows)
+
+        with self._condition:
+            self._deadlines = deadlines
+            self._heap = [(deadline, link_id) for link_id, deadline in deadlines.items()]
+            heapq.heapify(self._heap)
+            self._loaded_until = horizon
+            self._next_reload = now + self.RELOAD_INTERVAL
+
+    def schedule(self, link_id, expires_epoch):
+        """Добавляет или переносит срок действия хранилища"""
+        with self._condition:
+            if expires_epoch > self._loaded_until:
+                # Дальний срок попадет в кучу при одной из следующих загрузок
+                self._deadlines.pop(link_id, None)
+                return
+            self._deadlines[link_id] = expires_epoch
+            heapq.heappush(self._heap, (expires_epoch, link_id))
+            self._condition.notify()
+
+    def cancel(self, link_id):
+        """Снимает хранилище с учета (удалено досрочно)"""
+        with self._condition:
+            self._deadlines.pop(link_id, None)
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, link_id = heapq.heappop(self._heap)
+            if self._deadlines.get(link_id) == deadline:
+                del self._deadlines[link_id]
+                due.append(link_id)
+        return due
+
+    def _reschedule(self, link_ids):
+        """Возвращает в кучу хранилища, которые на момент удаления еще не истекли"""
+        placeholders = ', '.join('?' * len(link_ids))
+        rows = db_fetchall(f'SELECT link_id, expires_at FROM temp_links WHERE link_id IN ({placeholders})', list(link_ids))
+        for link_id, expires_at in rows:
+            self.schedule(link_id, expires_at)
+
+    def run_pending(self, now=None):
+        """Удаляет хранилища, срок которых наступил; возвращает время следующего пробуждения"""
+        now = time.time() if now is None else now
+        if self._marker_changed() or now >= self._next_reload:
+            self._load(now)
+        with self._condition:
+            due = self._pop_due(now)
+        if due:
+            deleted = delete_expired_storages(due)
+            remaining = set(due) - set(deleted)
+            if remaining:
+                self._reschedule(remaining)
+        with self._condition:
+            return min(self._heap[0][0], self._next_reload) if self._heap else self._next_reload
+
+    def run(self):
+        logger.info("Запущен планировщик удаления истекших хранилищ")
+        while True:
+            try:
+                wake_at = self.run_pending()
+                with self._condition:
+                    # schedule() будит поток, если новый срок раньше текущего ожидания
+                    next_deadline = min(self._heap[0][0], wake_at) if self._heap else wake_at
+                    # Не спим дольше MARKER_CHECK_INTERVAL, чтобы вовремя заметить изменения из бота
+                    timeout = min(next_deadline - time.time(), self.MARKER_CHECK_INTERVAL)
+                    if timeout > 0:
+                        self._condition.wait(timeout)
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике удаления истекших хранилищ: {str(e)}")
+                time.sleep(60)
+
+expiry_scheduler = ExpiryScheduler(storage_validity_cache.marker_path)
 
 def cleanup_expired_sessions():
     """Очистка старых файлов сессий"""
@@ -892,11 +1349,20 @@ def periodic_cleanup():
         try:
             logger.info("Начало периодической очистки...")
             
-            # Очистка истекших хранилищ (асинхронно)
-            run_async(cleanup_expired_storages_async)()
+            # Сверка учета занятого места с фактическим содержимым диска
+            reconcile_storage_usage()
+
+            # Сверка ссылок на блобы дедупликации и удаление блобов без ссылок
+            reconcile_blob_store()
+
+            # Удаление миниатюр хранилищ, которых больше нет
+            cleanup_thumbnail_cache()
             
             # Очистка старых сессий (синхронно)
             cleanup_expired_sessions()
+
+            # Очистка брошенных незавершенных загрузок
+            cleanup_stale_uploads()
             
             logger.info("Периодическая очистка завершена.")
         except Exception as e:
@@ -908,7 +1374,762 @@ def periodic_cleanup():
 # --- Конец добавленных функций ---
 
 # Уникальные идентификаторы сессий загрузки для обработки конкурентной загрузки
+# (link_id, upload_session_id) -> состояние сборки файла из чанков.
+# Это горячая копия таблицы upload_sessions: каждое изменение сразу записывается в БД,
+# поэтому после перезагрузки вкладки или перезапуска сервера загрузку можно продолжить
 upload_sessions = {}
+upload_sessions_lock = threading.Lock()
+
+def add_received_range(ranges, start, end):
+    """Добавляет диапазон [start, end) к списку полученных диапазонов, объединяя пересекающиеся и смежные"""
+    merged = []
+    for range_start, range_end in sorted(ranges + [(start, end)]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+        else:
+            merged.append((range_start, range_end))
+    return merged
+
+def is_upload_complete(ranges, total_size):
+    """Проверяет, покрывают ли полученные диапазоны весь файл"""
+    return total_size == 0 or ranges == [(0, total_size)]
+
+def get_missing_ranges(ranges, total_size):
+    """Возвращает диапазоны [start, end), которые еще не получены"""
+    missing = []
+    position = 0
+    for range_start, range_end in ranges:
+        if range_start > position:
+            missing.append((position, range_start))
+        position = max(position, range_end)
+    if position < total_size:
+        missing.append((position, total_size))
+    return missing
+
+def get_upload_part_path(link_id, upload_session_id):
+    """Путь к временному файлу, в котором собирается загрузка"""
+    return os.path.join(get_temp_storage_path(link_id), f"upload_{upload_session_id}.part")
+
+def load_upload_session(link_id, upload_session_id):
+    """Загружает сохраненную сессию загрузки из БД (None, если её нет или .part-файл потерян)"""
+    result = db_fetchone(
+        'SELECT filename, total_size, received_ranges, last_activity FROM upload_sessions WHERE link_id = ? AND upload_session_id = ?',
+        (link_id, upload_session_id)
+    )
+    if not result:
+        return None
+    filename, total_size, received_ranges, last_activity = result
+    try:
+        if os.path.getsize(get_upload_part_path(link_id, upload_session_id)) != total_size:
+            return None
+    except OSError:
+        return None
+    return {
+        'filename': filename,
+        'total_size': total_size,
+        'ranges': [tuple(received_range) for received_range in json.loads(received_ranges)],
+        'last_activity': last_activity,
+        'finalizing': False,
+    }
+
+def get_upload_session(link_id, upload_session_id):
+    """Возвращает состояние сессии загрузки из памяти или из БД"""
+    key = (link_id, upload_session_id)
+    with upload_sessions_lock:
+        upload_session = upload_sessions.get(key)
+        if upload_session is None:
+            upload_session = load_upload_session(link_id, upload_session_id)
+            if upload_session is not None:
+                upload_sessions[key] = upload_session
+        return upload_session
+
+def open_upload_session(link_id, upload_session_id, filename, total_size, temp_file_path):
+    """Возвращает состояние сессии загрузки, создавая его при первом чанке.
+
+    При создании .part-файл сразу выделяется на полный размер, чтобы чанки
+    можно было записывать по смещению в любом порядке. Сохраненная в БД сессия
+    с тем же идентификатором продолжается с уже полученных диапазонов.
+    """
+    key = (link_id, upload_session_id)
+    with upload_sessions_lock:
+        upload_session = upload_sessions.get(key) or load_upload_session(link_id, upload_session_id)
+        if upload_session is None:
+            try:
+                previous_size = os.path.getsize(temp_file_path)
+            except OSError:
+                previous_size = 0
+            with open(temp_file_path, 'wb') as f:
+                f.truncate(total_size)
+            update_storage_usage(link_id, bytes_delta=total_size - previous_size)
+            upload_session = {
+                'filename': filename,
+                'total_size': total_size,
+                'ranges': [],
+                'last_activity': int(time.time()),
+                'finalizing': False,
+            }
+            db_execute(
+                '''INSERT OR REPLACE INTO upload_sessions
+                   (link_id, upload_session_id, filename, total_size, received_ranges, last_activity)
+                   VALUES (?, ?, ?, ?, '[]', ?)''',
+                (link_id, upload_session_id, filename, total_size, upload_session['last_activity'])
+            )
+        upload_sessions[key] = upload_session
+        return upload_session
+
+def mark_chunk_received(link_id, upload_session_id, upload_session, start, end):
+    """Отмечает диапазон чанка как полученный и сохраняет его в БД.
+
+    Возвращает True ровно одному потоку — тому, чей чанк завершил файл.
+    """
+    with upload_sessions_lock:
+        upload_session['ranges'] = add_received_range(upload_session['ranges'], start, end)
+        upload_session['last_activity'] = int(time.time())
+        db_execute(
+            'UPDATE upload_sessions SET received_ranges = ?, last_activity = ? WHERE link_id = ? AND upload_session_id = ?',
+            (json.dumps(upload_session['ranges']), upload_session['last_activity'], link_id, upload_session_id)
+        )
+        if upload_session['finalizing'] or not is_upload_complete(upload_session['ranges'], upload_session['total_size']):
+            return False
+        upload_session['finalizing'] = True
+        return True
+
+def close_upload_session(link_id, upload_session_id):
+    """Удаляет состояние сессии загрузки из памяти и из БД"""
+    with upload_sessions_lock:
+        upload_sessions.pop((link_id, upload_session_id), None)
+        try:
+            db_execute('DELETE FROM upload_sessions WHERE link_id = ? AND upload_session_id = ?', (link_id, upload_session_id))
+        except Exception as e:
+            logger.error(f"Ошибка при удалении сессии загрузки {upload_session_id} хранилища {link_id}: {str(e)}")
+
+def drop_storage_upload_sessions(link_id):
+    """Удаляет все сессии загрузки хранилища (при удалении самого хранилища)"""
+    with upload_sessions_lock:
+        for key in [key for key in upload_sessions if key[0] == link_id]:
+            del upload_sessions[key]
+        try:
+            db_execute('DELETE FROM upload_sessions WHERE link_id = ?', (link_id,))
+        except Exception as e:
+            logger.error(f"Ошибка при удалении сессий загрузки хранилища {link_id}: {str(e)}")
+
+def cleanup_stale_uploads():
+    """Удаление брошенных незавершенных загрузок и их .part-файлов"""
+    try:
+        cutoff = int(time.time()) - app.config['UPLOAD_SESSION_TTL_HOURS'] * 3600
+        stale_sessions = db_fetchall('SELECT link_id, upload_session_id FROM upload_sessions WHERE last_activity < ?', (cutoff,))
+
+        deleted_count = 0
+        for link_id, upload_session_id in stale_sessions:
+            close_upload_session(link_id, upload_session_id)
+            temp_file_path = get_upload_part_path(link_id, upload_session_id)
+            if os.path.exists(temp_file_path):
+                try:
+                    discard_upload_part(link_id, temp_file_path)
+                    deleted_count += 1
+                except OSError as e:
+                    logger.error(f"Не удалось удалить брошенный временный файл {temp_file_path}: {str(e)}")
+
+        # .part-файлы без сессии (например, от старых версий) удаляем по времени последней записи
+        active_sessions = {tuple(row) for row in db_fetchall('SELECT link_id, upload_session_id FROM upload_sessions')}
+        with upload_sessions_lock:
+            active_sessions.update(upload_sessions.keys())
+        if os.path.exists(TEMP_STORAGE_DIR):
+            for link_id in os.listdir(TEMP_STORAGE_DIR):
+                storage_path = get_temp_storage_path(link_id)
+                if not os.path.isdir(storage_path):
+                    continue
+                for filename in os.listdir(storage_path):
+                    if not is_upload_part_file(filename):
+                        continue
+                    upload_session_id = filename[len('upload_'):-len('.part')]
+                    if (link_id, upload_session_id) in active_sessions:
+                        continue
+                    temp_file_path = os.path.join(storage_path, filename)
+                    try:
+                        if os.path.getmtime(temp_file_path) < cutoff:
+                            discard_upload_part(link_id, temp_file_path)
+                            deleted_count += 1
+                    except OSError as e:
+                        logger.error(f"Не удалось удалить брошенный временный файл {temp_file_path}: {str(e)}")
+
+        if deleted_count > 0:
+            logger.info(f"Удалено {deleted_count} брошенных незавершенных загрузок.")
+        else:
+            logger.info("Нет брошенных незавершенных загрузок для удаления.")
+
+    except Exception as e:
+        logger.error(f"Ошибка во время очистки незавершенных загрузок: {str(e)}")
+
+# Буфер для копирования чанков: один на поток, чтобы не выделять память на каждый запрос
+chunk_copy_buffers = threading.local()
+
+def get_chunk_copy_buffer():
+    """Буфер копирования текущего потока (создается при первом обращении)"""
+    buffer = getattr(chunk_copy_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = memoryview(bytearray(app.config['UPLOAD_CHUNK_SIZE']))
+        chunk_copy_buffers.buffer = buffer
+    return buffer
+
+def write_chunk_to_part(stream, temp_file_path, offset, max_length):
+    """Копирует тело чанка в .part-файл по смещению через буфер фиксированного размера.
+
+    Возвращает количество записанных байт или None, если в потоке больше max_length байт.
+    Пиковая память на запрос ограничена размером буфера и не зависит от размера чанка.
+    """
+    buffer = get_chunk_copy_buffer()
+    # SpooledTemporaryFile, в который werkzeug складывает multipart-файлы, до Python 3.11 не имеет readinto
+    readinto = getattr(stream, 'readinto', None)
+
+    written = 0
+    # Каждый запрос пишет через собственный дескриптор, поэтому чанки можно принимать параллельно
+    with open(temp_file_path, 'r+b') as f:
+        f.seek(offset)
+        while True:
+            # На байт больше остатка, чтобы заметить превышение max_length
+            read_limit = min(len(buffer), max_length - written + 1)
+            if readinto is not None:
+                data = buffer[:readinto(buffer[:read_limit])]
+            else:
+                data = memoryview(stream.read(read_limit))
+            if not data:
+                break
+            if written + len(data) > max_length:
+                return None
+            f.write(data)
+            written += len(data)
+    return written
+
+# --- Дедупликация файлов хранилищ ---
+# Блоб — файл BLOB_STORAGE_DIR/<первые 2 символа хэша>/<sha256>. Файл хранилища с тем же
+# содержимым становится жесткой ссылкой на блоб, storage_blob_refs связывает его с хэшем,
+# а refcount в storage_blobs считает такие ссылки. Блоб удаляется, когда ссылок не остается.
+blob_store_lock = threading.Lock()
+
+def get_blob_path(sha256):
+    """Путь к блобу по его SHA-256"""
+    return os.path.join(BLOB_STORAGE_DIR, sha256[:2], sha256)
+
+def advance_upload_hash(upload_session, temp_file_path):
+    """Досчитывает SHA-256 загрузки по непрерывно полученному началу .part-файла.
+
+    Вызывается после каждого чанка: при последовательной загрузке хэш готов
+    к моменту сборки файла, а чанки, пришедшие не по порядку, хэшируются,
+    когда заполнится разрыв перед ними. Возвращает hexdigest, если хэширован весь файл.
+    """
+    with upload_sessions_lock:
+        hash_state = upload_session.setdefault('hash', {
+            'lock': threading.Lock(),
+            'sha256': hashlib.sha256(),
+            'hashed_bytes': 0,
+        })
+    with hash_state['lock']:
+        with upload_sessions_lock:
+            ranges = upload_session['ranges']
+            prefix_end = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+        if prefix_end > hash_state['hashed_bytes']:
+            buffer = get_chunk_copy_buffer()
+            with open(temp_file_path, 'rb') as f:
+                f.seek(hash_state['hashed_bytes'])
+                while hash_state['hashed_bytes'] < prefix_end:
+                    read_size = f.readinto(buffer[:min(len(buffer), prefix_end - hash_state['hashed_bytes'])])
+                    if not read_size:
+                        break
+                    hash_state['sha256'].update(buffer[:read_size])
+                    hash_state['hashed_bytes'] += read_size
+        if hash_state['hashed_bytes'] == upload_session['total_size']:
+            return hash_state['sha256'].hexdigest()
+        return None
+
+def link_file_to_blob(link_id, filename, file_path, sha256):
+    """Связывает собранный файл хранилища с блобом того же содержимого.
+
+    Если блоб уже есть, копия заменяется жесткой ссылкой на него, иначе сам файл
+    становится блобом. Ошибки не критичны: файл остается отдельной копией.
+    """
+    blob_path = get_blob_path(sha256)
+    try:
+        file_size = os.path.getsize(file_path)
+        with blob_store_lock:
+            if os.path.exists(blob_path):
+                if os.path.getsize(blob_path) != file_size:
+                    logger.warning(f"Размер блоба {sha256} не совпадает с файлом {filename} хранилища {link_id}, дедупликация пропущена")
+                    return
+                # Такое содержимое уже хранится: заменяем копию ссылкой на блоб
+                link_path = f"{file_path}.blob"
+                os.link(blob_path, link_path)
+                os.replace(link_path, file_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.link(file_path, blob_path)
+            with db_pool.connection() as conn:
+                conn.execute(
+                    '''INSERT INTO storage_blobs (sha256, size, refcount) VALUES (?, ?, 1)
+                       ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1''',
+                    (sha256, file_size)
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO storage_blob_refs (link_id, filename, sha256) VALUES (?, ?, ?)',
+                    (link_id, filename, sha256)
+                )
+                conn.commit()
+    except Exception as e:
+        logger.error(f"Ошибка при дедупликации файла {filename} хранилища {link_id}: {str(e)}")
+
+def remove_blob_files(hashes):
+    """Удаляет с диска блобы, на которые больше нет ссылок"""
+    for sha256 in hashes:
+        try:
+            os.remove(get_blob_path(sha256))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Не удалось удалить блоб {sha256}: {str(e)}")
+
+def remove_link_files(file_paths):
+    """Удаляет с диска файлы временных ссылок бота (пути из temp_link_files)"""
+    for file_path in file_paths:
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        except OSError as e:
+            logger.error(f"Ошибка при удалении файла {file_path}: {str(e)}")
+
+def purge_storage_records(link_id):
+    """Удаляет записи хранилища во всех связанных таблицах, файлы временных ссылок,
+    блобы без ссылок и миниатюры (директорию хранилища удаляет вызывающий код)"""
+    with blob_store_lock:
+        with db_pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            files, orphaned = delete_storage_records(conn, [link_id])
+            conn.commit()
+        remove_blob_files(orphaned)
+    remove_link_files(files)
+    invalidate_thumbnails(link_id)
+
+def release_file_blob(link_id, filename=None):
+    """Удаляет ссылку файла (или всех файлов хранилища, если filename не задан) на блоб.
+
+    Вызывается после удаления файлов с диска: уменьшает refcount и удаляет блобы без ссылок.
+    """
+    try:
+        with blob_store_lock:
+            with db_pool.connection() as conn:
+                if filename is None:
+                    refs = conn.execute('SELECT sha256 FROM storage_blob_refs WHERE link_id = ?', (link_id,)).fetchall()
+                    conn.execute('DELETE FROM storage_blob_refs WHERE link_id = ?', (link_id,))
+                else:
+                    refs = conn.execute(
+                        'SELECT sha256 FROM storage_blob_refs WHERE link_id = ? AND filename = ?', (link_id, filename)
+                    ).fetchall()
+                    conn.execute('DELETE FROM storage_blob_refs WHERE link_id = ? AND filename = ?', (link_id, filename))
+                orphaned = []
+                for (sha256,) in refs:
+                    conn.execute('UPDATE storage_blobs SET refcount = refcount - 1 WHERE sha256 = ?', (sha256,))
+                    if conn.execute('SELECT refcount FROM storage_blobs WHERE sha256 = ?', (sha256,)).fetchone()[0] <= 0:
+                        conn.execute('DELETE FROM storage_blobs WHERE sha256 = ?', (sha256,))
+                        orphaned.append(sha256)
+                conn.commit()
+            remove_blob_files(orphaned)
+    except Exception as e:
+        logger.error(f"Ошибка при освобождении блобов хранилища {link_id}: {str(e)}")
+
+def get_storage_usage_totals():
+    """Итоги учета места: (логический объем всех хранилищ, физический объем с учетом дедупликации)"""
+    logical_bytes = db_fetchone('SELECT COALESCE(SUM(used_bytes), 0) FROM storage_usage')[0]
+    shared_bytes = db_fetchone('SELECT COALESCE(SUM(size * (refcount - 1)), 0) FROM storage_blobs WHERE refcount > 1')[0]
+    return logical_bytes, logical_bytes - shared_bytes
+
+def reconcile_blob_store():
+    """Сверяет ссылки на блобы с диском, пересчитывает refcount и удаляет блобы без ссылок.
+
+    Ссылки расходятся с диском, например, когда хранилище удаляет бот:
+    файлов уже нет, а записи в storage_blob_refs остались.
+    Возвращает итоги сверки с логическим и физическим объемом хранилищ или None при ошибке.
+    """
+    try:
+        with blob_store_lock:
+            stale_refs = []
+            for link_id, filename, sha256 in db_fetchall('SELECT link_id, filename, sha256 FROM storage_blob_refs'):
+                try:
+                    if os.path.samefile(os.path.join(get_temp_storage_path(link_id), filename), get_blob_path(sha256)):
+                        continue
+                except OSError:
+                    pass
+                stale_refs.append((link_id, filename))
+
+            with db_pool.connection() as conn:
+                conn.executemany('DELETE FROM storage_blob_refs WHERE link_id = ? AND filename = ?', stale_refs)
+                conn.execute('''UPDATE storage_blobs SET refcount =
+                                (SELECT COUNT(*) FROM storage_blob_refs WHERE storage_blob_refs.sha256 = storage_blobs.sha256)''')
+                orphaned = [row[0] for row in conn.execute('SELECT sha256 FROM storage_blobs WHERE refcount = 0').fetchall()]
+                conn.execute('DELETE FROM storage_blobs WHERE refcount = 0')
+                conn.commit()
+
+            # Блобы на диске без записи в БД (например, после сбоя между link и commit)
+            known_blobs = {row[0] for row in db_fetchall('SELECT sha256 FROM storage_blobs')}
+            if os.path.isdir(BLOB_STORAGE_DIR):
+                for prefix in os.listdir(BLOB_STORAGE_DIR):
+                    prefix_path = os.path.join(BLOB_STORAGE_DIR, prefix)
+                    if os.path.isdir(prefix_path):
+                        orphaned.extend(sha256 for sha256 in os.listdir(prefix_path) if sha256 not in known_blobs)
+            remove_blob_files(orphaned)
+
+        logical_bytes, physical_bytes = get_storage_usage_totals()
+        logger.info(f"Сверка блобов: удалено ссылок {len(stale_refs)}, блобов {len(orphaned)}; "
+                    f"занято логически {logical_bytes} байт, физически {physical_bytes} байт")
+        return {
+            'removed_refs': len(stale_refs),
+            'removed_blobs': len(orphaned),
+            'logical_bytes': logical_bytes,
+            'physical_bytes': physical_bytes,
+        }
+    except Exception as e:
+        logger.error(f"Ошибка при сверке хранилища блобов: {str(e)}")
+        return None
+
+# Расширения уже сжатых форматов: повторное сжатие DEFLATE только тратит CPU, поэтому такие файлы кладем в архив как есть
+ZIP_STORED_EXTENSIONS = {'zip', 'rar', '7z', 'gz', 'mp4', 'mkv', 'mov', 'avi', 'mp3', 'jpg', 'jpeg', 'png', 'gif', 'docx', 'xlsx', 'pptx'}
+ZIP_STREAM_READ_SIZE = 1024 * 1024  # По сколько байт читаем файл при потоковой упаковке
+
+class ZipStreamBuffer:
+    """Файлоподобный приемник для zipfile без поддержки seek.
+
+    zipfile пишет в него локальные заголовки, данные и центральный каталог,
+    а генератор ответа забирает накопленные байты и сразу отдает их клиенту.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Возвращает и очищает накопленные байты"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def generate_zip_stream(files_to_zip, link_id):
+    """Генератор ZIP-архива: отдает архив по частям, не собирая его в памяти"""
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for file_info in files_to_zip:
+            try:
+                zip_info = zipfile.ZipInfo.from_file(file_info['path'], arcname=file_info['name'])
+                extension = file_info['name'].rsplit('.', 1)[-1].lower() if '.' in file_info['name'] else ''
+                zip_info.compress_type = zipfile.ZIP_STORED if extension in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                with open(file_info['path'], 'rb') as source, zf.open(zip_info, 'w') as target:
+                    while True:
+                        data = source.read(ZIP_STREAM_READ_SIZE)
+                        if not data:
+                            break
+                        target.write(data)
+                        yield buffer.pop()
+                logger.debug(f"Добавлен файл {file_info['name']} в архив для {link_id}")
+            except Exception as e:
+                # Заголовки ответа уже отправлены, поэтому можем только прервать архив
+                logger.error(f"Ошибка добавления файла {file_info['name']} в архив для {link_id}: {str(e)}")
+                raise
+            yield buffer.pop()
+    # Центральный каталог записывается при закрытии архива
+    yield buffer.pop()
+
+def make_offload_response(link_id, filename, file_path, mime_type, as_attachment):
+    """Ответ без тела: файл отдает фронтенд-прокси по X-Accel-Redirect или X-Sendfile.
+
+    Диапазоны, ETag и условные запросы в этом режиме обрабатывает сам прокси.
+    """
+    response = Response(mimetype=mime_type)
+    if app.config['DOWNLOAD_OFFLOAD_MODE'] == 'nginx':
+        prefix = app.config['DOWNLOAD_OFFLOAD_PREFIX'].rstrip('/')
+        response.headers['X-Accel-Redirect'] = f"{prefix}/{quote(link_id)}/{quote(filename)}"
+    else:
+        # Путь в заголовке должен быть ASCII; mod_xsendfile и lighttpd декодируют его обратно
+        response.headers['X-Sendfile'] = quote(os.path.abspath(file_path))
+    if as_attachment:
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    return response
+
+MAX_BYTE_RANGES = 16  # Больше диапазонов в одном Range-запросе не обслуживаем, отдаем файл целиком
+
+def make_file_etag(file_stat):
+    """Сильный ETag файла по inode, размеру и времени изменения"""
+    return f"{file_stat.st_ino:x}-{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"
+
+def get_requested_byte_ranges(file_size):
+    """Возвращает список диапазонов [start, end) из заголовка Range.
+
+    None — заголовка нет или его нужно проигнорировать (файл отдается целиком),
+    пустой список — ни один диапазон не попадает в файл (416).
+    """
+    parsed_range = parse_range_header(request.headers.get('Range'))
+    if parsed_range is None or len(parsed_range.ranges) > MAX_BYTE_RANGES:
+        return None
+    byte_ranges = []
+    for start, stop in parsed_range.ranges:
+        if start < 0:
+            # Суффиксный диапазон: последние -start байт файла
+            start, stop = max(0, file_size + start), file_size
+        else:
+            stop = file_size if stop is None else min(stop, file_size)
+        if start < stop:
+            byte_ranges.append((start, stop))
+    return byte_ranges
+
+def send_multirange_file(file_path, byte_ranges, file_size, mime_type, etag, last_modified):
+    """Ответ 206 multipart/byteranges для запроса нескольких диапазонов файла"""
+    boundary = secrets.token_hex(16)
+    part_headers = [
+        (f"--{boundary}\r\nContent-Type: {mime_type}\r\n"
+         f"Content-Range: bytes {start}-{stop - 1}/{file_size}\r\n\r\n").encode('latin-1')
+        for start, stop in byte_ranges
+    ]
+    closing = f"--{boundary}--\r\n".encode('latin-1')
+    content_length = sum(len(header) + (stop - start) + 2 for header, (start, stop) in zip(part_headers, byte_ranges)) + len(closing)
+
+    def generate():
+        with open(file_path, 'rb') as f:
+            for header, (start, stop) in zip(part_headers, byte_ranges):
+                yield header
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    data = f.read(min(ZIP_STREAM_READ_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+                yield b"\r\n"
+        yield closing
+
+    response = Response(generate(), status=206, mimetype=f'multipart/byteranges; boundary={boundary}')
+    response.headers['Content-Length'] = str(content_length)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    response.headers['Last-Modified'] = http_date(last_modified)
+    return response
+
+# --- Миниатюры изображений ---
+# Миниатюры кэшируются на диске в THUMBNAIL_CACHE_DIR/<link_id>/. Имя файла кэша включает
+# хэш имени исходного файла (чтобы удалять миниатюры вместе с ним), его ETag (inode, размер, mtime)
+# и ширину, поэтому измененный файл никогда не отдается по старой миниатюре.
+THUMBNAIL_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff', 'tif'}
+THUMBNAIL_WIDTHS = (128, 256, 512, 1024)  # Запрошенная ширина округляется вверх до одной из этих
+THUMBNAIL_TIMEOUT = 30  # Сколько секунд запрос ждет генерации миниатюры
+THUMBNAIL_WEBP_SUPPORTED = features.check('webp')
+
+thumbnail_executor = ThreadPoolExecutor(max_workers=max(1, app.config['THUMBNAIL_WORKERS']),
+                                        thread_name_prefix='thumbnail')
+# Миниатюры, которые генерируются прямо сейчас: одинаковые запросы ждут одну задачу
+thumbnail_jobs = {}
+thumbnail_jobs_lock = threading.Lock()
+
+def get_thumbnail_width(requested_width):
+    """Ближайшая поддерживаемая ширина миниатюры не меньше запрошенной"""
+    for width in THUMBNAIL_WIDTHS:
+        if requested_width <= width:
+            return width
+    return THUMBNAIL_WIDTHS[-1]
+
+def get_thumbnail_name_prefix(filename):
+    """Общее начало имен всех миниатюр файла в кэше"""
+    return hashlib.sha1(filename.encode('utf-8')).hexdigest()[:16] + '-'
+
+def render_thumbnail(file_path, thumbnail_path, width, image_format):
+    """Уменьшает изображение до width x width и атомарно записывает миниатюру в кэш"""
+    temp_path = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+    try:
+        with Image.open(file_path) as image:
+            # JPEG можно сразу декодировать в уменьшенном масштабе, не разворачивая оригинал целиком
+            image.draft('RGB', (width, width))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width, width), Image.LANCZOS)
+            if image_format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+                has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+                image = image.convert('RGBA' if image_format == 'WEBP' and has_alpha else 'RGB')
+            image.save(temp_path, image_format, quality=80)
+        os.replace(temp_path, thumbnail_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def get_thumbnail(link_id, filename, file_path, width, image_format):
+    """Возвращает путь к миниатюре из кэша, генерируя её в пуле потоков при промахе"""
+    file_stat = os.stat(file_path)
+    thumbnail_dir = os.path.join(THUMBNAIL_CACHE_DIR, link_id)
+    extension = 'webp' if image_format == 'WEBP' else 'jpg'
+    thumbnail_path = os.path.join(
+        thumbnail_dir, f"{get_thumbnail_name_prefix(filename)}{make_file_etag(file_stat)}-{width}.{extension}"
+    )
+    if os.path.exists(thumbnail_path):
+        return thumbnail_path
+
+    with thumbnail_jobs_lock:
+        job = thumbnail_jobs.get(thumbnail_path)
+        if job is None:
+            os.makedirs(thumbnail_dir, exist_ok=True)
+            job = thumbnail_executor.submit(render_thumbnail, file_path, thumbnail_path, width, image_format)
+            thumbnail_jobs[thumbnail_path] = job
+            job.add_done_callback(lambda _: remove_thumbnail_job(thumbnail_path))
+    job.result(timeout=THUMBNAIL_TIMEOUT)
+    return thumbnail_path
+
+def remove_thumbnail_job(thumbnail_path):
+    """Убирает завершенную задачу генерации из списка текущих"""
+    with thumbnail_jobs_lock:
+        thumbnail_jobs.pop(thumbnail_path, None)
+
+def invalidate_thumbnails(link_id, filename=None):
+    """Удаляет из кэша миниатюры файла (или всего хранилища, если filename не задан)"""
+    thumbnail_dir = os.path.join(THUMBNAIL_CACHE_DIR, link_id)
+    try:
+        if filename is None:
+            shutil.rmtree(thumbnail_dir, ignore_errors=True)
+            return
+        prefix = get_thumbnail_name_prefix(filename)
+        with os.scandir(thumbnail_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix):
+                    os.remove(entry.path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Ошибка при удалении миниатюр {filename or ''} хранилища {link_id}: {str(e)}")
+
+def cleanup_thumbnail_cache():
+    """Удаление кэша миниатюр хранилищ, которых больше нет (например, удаленных ботом)"""
+    try:
+        deleted_count = 0
+        for link_id in os.listdir(THUMBNAIL_CACHE_DIR):
+            if not os.path.isdir(get_temp_storage_path(link_id)):
+                invalidate_thumbnails(link_id)
+                deleted_count += 1
+        if deleted_count > 0:
+            logger.info(f"Удален кэш миниатюр {deleted_count} несуществующих хранилищ.")
+    except Exception as e:
+        logger.error(f"Ошибка во время очистки кэша миниатюр: {str(e)}")
+
+# --- Предпросмотр текстовых файлов ---
+# Предпросмотр читает только запрошенное окно строк: по смещению в байтах (постраничная прокрутка)
+# или по номеру строки. Для перехода к строке хранятся опорные смещения каждой
+# TEXT_PREVIEW_INDEX_STEP-й строки, поэтому повторные переходы не перечитывают файл с начала.
+TEXT_PREVIEW_EXTENSIONS = {
+    'txt', 'md', 'csv', 'tsv', 'json', 'xml', 'html', 'htm', 'css', 'js',
+    'py', 'java', 'c', 'cpp', 'h', 'hpp', 'cs', 'php', 'rb', 'go', 'rs', 'ts',
+    'jsx', 'tsx', 'sql', 'yml', 'yaml', 'ini', 'conf', 'config', 'sh', 'bat', 'ps1',
+    'tex', 'bib', 'log', 'diff', 'patch',
+}
+TEXT_PREVIEW_DEFAULT_LINES = 200
+TEXT_PREVIEW_MAX_LINES = 2000
+TEXT_PREVIEW_MAX_LINE_BYTES = 8192  # Более длинные строки обрезаются
+TEXT_PREVIEW_MAX_BYTES = 1024 * 1024  # Предельный объем одного окна
+TEXT_PREVIEW_INDEX_STEP = 1000
+TEXT_PREVIEW_INDEX_CACHE_SIZE = 64
+
+# (путь, ETag) -> {'checkpoints': [смещение строки 0, строки STEP, строки 2*STEP, ...]}
+text_preview_indexes = OrderedDict()
+text_preview_indexes_lock = threading.Lock()
+
+def detect_text_encoding(raw_lines):
+    """Кодировка окна строк: UTF-8, иначе Windows-1251 (как при обработке файлов в боте).
+
+    Определяется по самому окну, а не по началу файла: символы вне ASCII могут впервые
+    встретиться сколь угодно далеко от начала.
+    """
+    try:
+        for data, cut in raw_lines:
+            # Обрезанная строка может обрываться посреди многобайтового символа, это не ошибка
+            codecs.getincrementaldecoder('utf-8')().decode(data, final=not cut)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'windows-1251'
+
+def get_text_preview_index(file_path, etag):
+    """Опорные смещения строк файла из кэша (создаются при первом обращении)"""
+    key = (file_path, etag)
+    with text_preview_indexes_lock:
+        index = text_preview_indexes.get(key)
+        if index is not None:
+            text_preview_indexes.move_to_end(key)
+            return index
+    index = {'checkpoints': [0]}
+    with text_preview_indexes_lock:
+        index = text_preview_indexes.setdefault(key, index)
+        while len(text_preview_indexes) > TEXT_PREVIEW_INDEX_CACHE_SIZE:
+            text_preview_indexes.popitem(last=False)
+    return index
+
+def skip_text_line(f):
+    """Пропускает остаток текущей строки, читая её кусками. False — достигнут конец файла"""
+    while True:
+        data = f.readline(TEXT_PREVIEW_MAX_LINE_BYTES)
+        if not data:
+            return False
+        if data.endswith(b'\n'):
+            return True
+
+def seek_text_line(f, index, line_number):
+    """Переходит к началу строки line_number. False — в файле меньше строк"""
+    with text_preview_indexes_lock:
+        checkpoints = list(index['checkpoints'])
+    slot = min(line_number // TEXT_PREVIEW_INDEX_STEP, len(checkpoints) - 1)
+    f.seek(checkpoints[slot])
+    current = slot * TEXT_PREVIEW_INDEX_STEP
+    new_checkpoints = []
+    while current < line_number:
+        if not skip_text_line(f):
+            return False
+        current += 1
+        if current % TEXT_PREVIEW_INDEX_STEP == 0:
+            new_checkpoints.append(f.tell())
+    if new_checkpoints:
+        with text_preview_indexes_lock:
+            # Другой запрос мог уже продлить список, добавляем только недостающие смещения
+            known = len(index['checkpoints'])
+            first_new = len(checkpoints)
+            index['checkpoints'].extend(new_checkpoints[max(0, known - first_new):])
+    return True
+
+def read_text_window(f, max_lines):
+    """Читает до max_lines строк с текущей позиции.
+
+    Возвращает (строки, кодировка окна, были ли обрезаны длинные строки,
+    смещение следующего окна или None в конце файла).
+    """
+    raw_lines = []
+    total_bytes = 0
+    while len(raw_lines) < max_lines and total_bytes < TEXT_PREVIEW_MAX_BYTES:
+        data = f.readline(TEXT_PREVIEW_MAX_LINE_BYTES)
+        if not data:
+            break
+        total_bytes += len(data)
+        cut = len(data) == TEXT_PREVIEW_MAX_LINE_BYTES and not data.endswith(b'\n')
+        if cut:
+            skip_text_line(f)
+        raw_lines.append((data, cut))
+    next_offset = f.tell() if f.peek(1) else None
+    encoding = detect_text_encoding(raw_lines)
+    lines = []
+    for data, cut in raw_lines:
+        if cut and encoding == 'utf-8':
+            # Недочитанный хвост символа отбрасывается, а не заменяется знаком ошибки
+            lines.append(codecs.getincrementaldecoder('utf-8')(errors='replace').decode(data))
+        else:
+            lines.append(data.decode(encoding, errors='replace').rstrip('\r\n'))
+    truncated = any(cut for _, cut in raw_lines)
+    return lines, encoding, truncated, next_offset
 
 # Безопасная обработка ошибок 
 def handle_error(e, default_message="Внутренняя ошибка сервера", log_message=None):
@@ -958,34 +2179,19 @@ def temp_storage(link_id):
                 except Exception as e:
                     logger.error(f"Ошибка при удалении директории недействительного хранилища {link_id}: {str(e)}")
             
-            # Используем асинхронную функцию через декоратор
-            @run_async
-            async def delete_expired_storage():
-                try:
-                    async with aiosqlite.connect(DB_PATH) as conn:
-                        await conn.execute('DELETE FROM temp_links WHERE link_id = ?', (link_id,))
-                        await conn.commit()
-                        logger.info(f"Удалена запись о недействительном хранилище: {link_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении записи о хранилище {link_id}: {str(e)}")
-            
             try:
-                delete_expired_storage()
+                purge_storage_records(link_id)
+                storage_validity_cache.invalidate(link_id)
+                expiry_scheduler.cancel(link_id)
+                logger.info(f"Удалена запись о недействительном хранилище: {link_id}")
             except Exception as e:
                 logger.error(f"Ошибка при удалении записи о хранилище {link_id}: {str(e)}")
                 
             return "Временное хранилище не найдено или срок его действия истек", 404
 
-        # Получаем user_id из базы асинхронно
+        # Получаем user_id из базы
         try:
-            @run_async
-            async def get_user_id_and_expires_at():
-                async with aiosqlite.connect(DB_PATH) as conn:
-                    cursor = await conn.execute('SELECT user_id, expires_at FROM temp_links WHERE link_id = ?', (link_id,))
-                    result = await cursor.fetchone()
-                    return result if result else (None, None)
-            
-            user_data = get_user_id_and_expires_at()
+            user_data = db_fetchone('SELECT user_id, expires_at FROM temp_links WHERE link_id = ?', (link_id,))
             user_id, expires_at = user_data if user_data else (None, None)
             theme = get_user_theme(user_id) if user_id else 'dark'
         except Exception as e:
@@ -997,18 +2203,8 @@ def temp_storage(link_id):
         remaining_time = None
         if expires_at:
             try:
-                # Форматируем дату истечения без микросекунд
-                if '.' in expires_at:
-                    expires_at = expires_at.split('.')[0]
-                
-                # Получаем текущее московское время
-                moscow_tz = pytz.timezone('Europe/Moscow')
-                now = datetime.now(moscow_tz)
-                expires_datetime = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S')
-                expires_datetime = moscow_tz.localize(expires_datetime)
-                
                 # Рассчитываем оставшееся время
-                time_delta = expires_datetime - now
+                time_delta = timedelta(seconds=expires_at - time.time())
                 days = time_delta.days
                 hours, remainder = divmod(time_delta.seconds, 3600)
                 minutes, _ = divmod(remainder, 60)
@@ -1022,33 +2218,31 @@ def temp_storage(link_id):
         storage_path = get_temp_storage_path(link_id)
         if not os.path.exists(storage_path):
             os.makedirs(storage_path)
+            # Директория создана заново — старый учет занятого места больше не актуален
+            delete_storage_usage(link_id)
         
+        # Параметры страницы и сортировки списка файлов
+        sort = request.args.get('sort', 'modified')
+        if sort not in STORAGE_FILES_SORT_COLUMNS:
+            sort = 'modified'
+        order = 'asc' if request.args.get('order') == 'asc' else 'desc'
+        per_page = min(max(request.args.get('per_page', app.config['STORAGE_PAGE_SIZE'], type=int), 1), 500)
+        page = max(request.args.get('page', 1, type=int), 1)
+
         files = []
         total_size = 0
+        total_files = 0
+        files_version = 0
         
         try:
-            for filename in os.listdir(storage_path):
-                file_path = os.path.join(storage_path, filename)
-                if os.path.isfile(file_path):
-                    try:
-                        file_size = max(0, os.path.getsize(file_path))
-                        total_size += file_size
-                        
-                        # Экранируем имя файла для предотвращения XSS
-                        safe_filename = html.escape(filename)
-                        
-                        files.append({
-                            'name': safe_filename,
-                            'raw_name': filename,  # Оригинальное имя для операций с файлами
-                            'size': file_size,
-                            'modified': datetime.fromtimestamp(os.path.getmtime(file_path))
-                        })
-                    except (OSError, IOError) as e:
-                        logger.error(f"Ошибка при получении информации о файле {filename}: {str(e)}")
+            # Версию читаем до списка: изменения, попавшие между ними, клиент получит повторно
+            files_version = get_storage_version(link_id)[0]
+            # Список файлов берем из индекса, размер хранилища — из учета занятого места
+            files, total_files = get_storage_files(link_id, sort, order, per_page, (page - 1) * per_page)
+            total_size = get_storage_usage(link_id)[0]
         except Exception as e:
-            logger.error(f"Ошибка при чтении содержимого директории {storage_path}: {str(e)}")
-        
-        files.sort(key=lambda x: x['modified'], reverse=True)
+            logger.error(f"Ошибка при получении списка файлов хранилища {link_id}: {str(e)}")
+        pages = max(1, math.ceil(total_files / per_page))
         
         # Обеспечиваем безопасные значения
         total_size = max(0, total_size)
@@ -1064,6 +2258,13 @@ def temp_storage(link_id):
                                 used_percent=used_percent,
                                 theme=theme,
                                 expires_at=expires_at,
+                                page=page,
+                                pages=pages,
+                                per_page=per_page,
+                                sort=sort,
+                                order=order,
+                                total_files=total_files,
+                                files_version=files_version,
                                 # Передаем список расширений как есть
                                 allowed_extensions=app.config['ALLOWED_EXTENSIONS'])
         except Exception as e:
@@ -1074,7 +2275,67 @@ def temp_storage(link_id):
         logger.error(f"Ошибка при загрузке страницы: {str(e)}")
         return "Произошла ошибка при загрузке страницы. Пожалуйста, попробуйте позже.", 500
 
+@app.route('/<link_id>/files')
+def list_files(link_id):
+    """Список файлов хранилища в JSON с версией для обновления страницы без перезагрузки.
+
+    С параметром since возвращает только изменения после этой версии:
+    добавленные/измененные файлы (upserted) и имена удаленных (removed).
+    Если разница недоступна (версия устарела или список не помещается на
+    одну страницу), возвращается текущая страница целиком (full=True).
+    """
+    try:
+        # Проверка на безопасность link_id (только буквенно-цифровые символы)
+        if not re.match(r'^[a-zA-Z0-9_-]+$', link_id):
+            logger.warning(f"Запрос списка файлов с некорректным link_id: {link_id}")
+            return jsonify({'error': 'Недействительный идентификатор'}), 400
+
+        if not is_temp_storage_valid(link_id):
+            logger.warning(f"Запрос списка файлов недействительного хранилища: {link_id}")
+            return jsonify({'error': 'Хранилище недействительно или срок его действия истек'}), 404
+
+        sort = request.args.get('sort', 'modified')
+        if sort not in STORAGE_FILES_SORT_COLUMNS:
+            sort = 'modified'
+        order = 'asc' if request.args.get('order') == 'asc' else 'desc'
+        per_page = min(max(request.args.get('per_page', app.config['STORAGE_PAGE_SIZE'], type=int), 1), 500)
+        page = max(request.args.get('page', 1, type=int), 1)
+        since = request.args.get('since', type=int)
+
+        version, base_version = get_storage_version(link_id)
+        used_bytes, total_files = get_storage_usage(link_id)
+        result = {
+            'version': version,
+            'total_files': total_files,
+            'pages': max(1, math.ceil(total_files / per_page)),
+            'used_bytes': used_bytes,
+            'used_percent': min(100, max(0, (used_bytes / app.config['MAX_STORAGE_SIZE']) * 100)),
+        }
+
+        def serialize(file):
+            return {
+                'name': file.get('raw_name', file['name']),
+                'size': file['size'],
+                'modified': file['modified'].strftime('%Y-%m-%d %H:%M:%S'),
+                'ext': file['ext'],
+                'icon_class': file['icon_class'],
+            }
+
+        # Разницу можно применить только к полному списку на одной странице
+        if since is not None and base_version <= since <= version and page == 1 and total_files <= per_page:
+            upserted, removed = get_storage_files_changes(link_id, since, version)
+            result.update(full=False, upserted=[serialize(file) for file in upserted], removed=removed)
+        else:
+            files, _ = get_storage_files(link_id, sort, order, per_page, (page - 1) * per_page)
+            result.update(full=True, files=[serialize(file) for file in files])
+        return jsonify(result)
+
+    except Exception as e:
+        error_message = handle_error(e, log_message=f"Критическая ошибка при получении списка файлов {link_id}")
+        return jsonify({'error': error_message}), 500
+
 @app.route('/<link_id>/download/<path:filename>')  # Изменяем <filename> на <path:filename> для обработки слешей
+@cache_policy(lambda: f"private, max-age={app.config['DOWNLOAD_CACHE_MAX_AGE']}, must-revalidate")
 def download_file(link_id, filename):
     """Скачивание файла из временного хранилища"""
     try:
@@ -1186,14 +2447,51 @@ def download_file(link_id, filename):
 
             logger.info(f"Отправка файла: {decoded_filename}, MIME: {mime_type}, as_attachment: {is_download_request}")
 
+            # Все проверки выше уже пройдены, саму передачу байтов отдаем прокси
+            if app.config['DOWNLOAD_OFFLOAD_MODE']:
+                return make_offload_response(link_id, decoded_filename, file_path, mime_type, is_download_request)
+
+            file_stat = os.stat(file_path)
+            etag = make_file_etag(file_stat)
+            last_modified = datetime.fromtimestamp(file_stat.st_mtime, tz=timezone.utc)
+
+            # Несколько диапазонов werkzeug не поддерживает — собираем multipart/byteranges сами.
+            # Сначала проверяем If-None-Match/If-Modified-Since (304), затем If-Range:
+            # при устаревшем If-Range диапазоны игнорируются и send_file отдает файл целиком
+            if ',' in request.headers.get('Range', ''):
+                if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    return response
+                if ('If-Range' not in request.headers
+                        or not is_resource_modified(request.environ, etag=etag, last_modified=last_modified, ignore_if_range=False)):
+                    byte_ranges = get_requested_byte_ranges(file_stat.st_size)
+                    if byte_ranges == []:
+                        return Response(status=416, headers={'Content-Range': f"bytes */{file_stat.st_size}"})
+                    if byte_ranges:
+                        response = send_multirange_file(file_path, byte_ranges, file_stat.st_size, mime_type, etag, last_modified)
+                        if is_download_request:
+                            response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(decoded_filename)}"
+                        return response
+
+            # Один диапазон, ETag/If-None-Match и If-Modified-Since (304) обрабатывает send_file
             # Используем is_download_request для определения, скачивать файл или показывать inline
             # Используем decoded_filename для download_name
-            return send_file(
+            response = send_file(
                 file_path,
                 mimetype=mime_type,
                 as_attachment=is_download_request,  # True если download=true, иначе False (inline)
-                download_name=decoded_filename if is_download_request else None  # Имя файла только при скачивании
+                download_name=decoded_filename if is_download_request else None,  # Имя файла только при скачивании
+                etag=etag,
+                last_modified=last_modified,
+                conditional=True
             )
+            # Сообщаем плееру, что по файлу можно перематывать диапазонными запросами
+            response.headers['Accept-Ranges'] = 'bytes'
+            return response
+        except RequestedRangeNotSatisfiable as e:
+            # Диапазон за пределами файла — это ошибка клиента (416), а не сервера
+            return e
         except Exception as e:
             logger.error(f"Ошибка при отправке файла {decoded_filename}: {str(e)}")
             return "Ошибка при отправке файла", 500
@@ -1202,6 +2500,124 @@ def download_file(link_id, filename):
         logger.error(f"Ошибка при скачивании файла: {str(e)}")
         return "Произошла ошибка при скачивании файла", 500
 
+@app.route('/<link_id>/thumb/<path:filename>')
+@cache_policy(lambda: f"private, max-age={app.config['DOWNLOAD_CACHE_MAX_AGE']}, must-revalidate")
+def thumbnail(link_id, filename):
+    """Уменьшенная копия изображения для предпросмотра (WebP или JPEG) из дискового кэша"""
+    try:
+        # Проверка на безопасность link_id (только буквенно-цифровые символы)
+        if not re.match(r'^[a-zA-Z0-9_-]+$', link_id):
+            logger.warning(f"Запрос миниатюры с некорректным link_id: {link_id}")
+            return jsonify({'error': 'Недействительный идентификатор хранилища'}), 400
+
+        if not is_temp_storage_valid(link_id):
+            logger.warning(f"Запрос миниатюры из недействительного хранилища: {link_id}")
+            return jsonify({'error': 'Хранилище недействительно или срок его действия истек'}), 404
+
+        decoded_filename = unquote(filename)
+        if '..' in decoded_filename or decoded_filename.startswith('/') or len(decoded_filename) > 255:
+            logger.warning(f"Недопустимое имя файла при запросе миниатюры: {decoded_filename}")
+            return "Недопустимое имя файла", 400
+        if get_file_extension(decoded_filename) not in THUMBNAIL_EXTENSIONS:
+            return "Миниатюра для этого типа файла недоступна", 400
+
+        storage_path = get_temp_storage_path(link_id)
+        file_path = os.path.join(storage_path, decoded_filename)
+        if not os.path.abspath(file_path).startswith(os.path.abspath(storage_path)):
+            logger.error(f"Попытка доступа к файлу вне хранилища: {file_path}")
+            return "Доступ запрещен", 403
+        if not os.path.isfile(file_path):
+            return "Файл не найден", 404
+
+        width = get_thumbnail_width(request.args.get('w', THUMBNAIL_WIDTHS[1], type=int))
+        use_webp = THUMBNAIL_WEBP_SUPPORTED and 'image/webp' in request.headers.get('Accept', '')
+        try:
+            thumbnail_path = get_thumbnail(link_id, decoded_filename, file_path, width, 'WEBP' if use_webp else 'JPEG')
+        except Exception as e:
+            logger.error(f"Ошибка при создании миниатюры {decoded_filename} в {link_id}: {str(e)}")
+            return "Не удалось создать миниатюру", 415
+
+        response = send_file(thumbnail_path, mimetype='image/webp' if use_webp else 'image/jpeg',
+                             etag=os.path.basename(thumbnail_path), conditional=True)
+        response.vary.add('Accept')
+        return response
+
+    except Exception as e:
+        error_message = handle_error(e, log_message=f"Критическая ошибка при получении миниатюры в {link_id}")
+        return jsonify({'error': error_message}), 500
+
+@app.route('/<link_id>/preview/<path:filename>')
+def text_preview(link_id, filename):
+    """Окно строк текстового файла для предпросмотра без скачивания файла целиком.
+
+    Параметры: lines — сколько строк вернуть; offset — смещение в байтах (окно начинается
+    со следующей целой строки) или line — номер первой строки (с нуля).
+    """
+    try:
+        # Проверка на безопасность link_id (только буквенно-цифровые символы)
+        if not re.match(r'^[a-zA-Z0-9_-]+$', link_id):
+            logger.warning(f"Запрос предпросмотра с некорректным link_id: {link_id}")
+            return jsonify({'error': 'Недействительный идентификатор хранилища'}), 400
+
+        if not is_temp_storage_valid(link_id):
+            logger.warning(f"Запрос предпросмотра из недействительного хранилища: {link_id}")
+            return jsonify({'error': 'Хранилище недействительно или срок его действия истек'}), 404
+
+        decoded_filename = unquote(filename)
+        if '..' in decoded_filename or decoded_filename.startswith('/') or len(decoded_filename) > 255:
+            logger.warning(f"Недопустимое имя файла при запросе предпросмотра: {decoded_filename}")
+            return jsonify({'error': 'Недопустимое имя файла'}), 400
+        if get_file_extension(decoded_filename) not in TEXT_PREVIEW_EXTENSIONS:
+            return jsonify({'error': 'Предпросмотр для этого типа файла недоступен'}), 400
+
+        storage_path = get_temp_storage_path(link_id)
+        file_path = os.path.join(storage_path, decoded_filename)
+        if not os.path.abspath(file_path).startswith(os.path.abspath(storage_path)):
+            logger.error(f"Попытка доступа к файлу вне хранилища: {file_path}")
+            return jsonify({'error': 'Доступ запрещен'}), 403
+        if not os.path.isfile(file_path):
+            return jsonify({'error': 'Файл не найден'}), 404
+
+        max_lines = min(max(request.args.get('lines', TEXT_PREVIEW_DEFAULT_LINES, type=int), 1), TEXT_PREVIEW_MAX_LINES)
+        offset = request.args.get('offset', type=int)
+        line_number = request.args.get('line', type=int)
+        if (offset is not None and offset < 0) or (line_number is not None and line_number < 0):
+            return jsonify({'error': 'Некорректное начало окна'}), 400
+
+        file_stat = os.stat(file_path)
+        with open(file_path, 'rb') as f:
+            index = get_text_preview_index(file_path, make_file_etag(file_stat))
+            if line_number is not None:
+                if not seek_text_line(f, index, line_number):
+                    return jsonify({'error': 'Строка за пределами файла'}), 416
+            else:
+                offset = min(offset or 0, file_stat.st_size)
+                f.seek(max(0, offset - 1))
+                # Окно всегда начинается с целой строки
+                if offset > 0 and f.read(1) != b'\n':
+                    skip_text_line(f)
+            start_offset = f.tell()
+            lines, encoding, truncated, next_offset = read_text_window(f, max_lines)
+
+        # Метка порядка байтов UTF-8 не часть текста
+        if start_offset == 0 and lines and encoding == 'utf-8':
+            lines[0] = lines[0].lstrip('\ufeff')
+
+        return jsonify({
+            'lines': lines,
+            'encoding': encoding,
+            'offset': start_offset,
+            'next_offset': next_offset,
+            'line': line_number,
+            'next_line': line_number + len(lines) if line_number is not None and next_offset is not None else None,
+            'truncated': truncated,
+            'size': file_stat.st_size,
+        })
+
+    except Exception as e:
+        error_message = handle_error(e, log_message=f"Критическая ошибка при предпросмотре файла в {link_id}")
+        return jsonify({'error': error_message}), 500
+
 @app.route('/health')
 def health_check():
     """Проверка работоспособности сервера"""
@@ -1222,10 +2638,16 @@ def upload_file(link_id):
             logger.warning(f"Попытка загрузки в недействительное хранилище: {link_id}")
             return jsonify({'error': 'Хранилище недействительно или срок его действия истек'}), 404
 
-        # Проверка лимита хранилища
+        # Проверка лимита хранилища (по учету занятого места, без обхода диска)
         storage_path = get_temp_storage_path(link_id)
         os.makedirs(storage_path, exist_ok=True)
-        current_size = get_temp_storage_size(link_id)
+        current_size, current_files_count = get_storage_usage(link_id)
+
+        # Слишком большой чанк отклоняем до разбора формы (клиент уменьшит размер чанка при 413).
+        # Запас на служебные поля multipart-формы
+        if request.content_length and request.content_length > app.config['MAX_CHUNK_SIZE'] + 64 * 1024:
+            logger.warning(f"Слишком большой чанк при загрузке в {link_id}: {request.content_length} байт")
+            return jsonify({'error': 'Слишком большой чанк'}), 413
 
         # Получаем данные из формы
         file = request.files.get('file')
@@ -1233,12 +2655,19 @@ def upload_file(link_id):
         total_chunks = request.form.get('chunks', type=int)
         total_size = request.form.get('total_size', type=int)
         upload_session_id = request.form.get('upload_session_id')
+        # Смещение чанка в файле; старые клиенты его не передают и шлют чанки по порядку
+        chunk_offset = request.form.get('offset', type=int)
 
         # Проверяем наличие необходимых данных
         if not file or chunk_number is None or total_chunks is None or total_size is None or not upload_session_id:
             logger.warning(f"Неполные данные при загрузке в {link_id}")
             return jsonify({'error': 'Неполные данные запроса'}), 400
 
+        # Идентификатор сессии входит в имя временного файла, поэтому допускаем только безопасные символы
+        if total_size < 0 or not re.match(r'^[a-zA-Z0-9_-]{1,64}$', upload_session_id):
+            logger.warning(f"Некорректные параметры сессии загрузки в {link_id}: {upload_session_id}")
+            return jsonify({'error': 'Некорректные параметры загрузки'}), 400
+
         # Сохраняем оригинальное имя файла
         original_filename = file.filename
         # Базовая проверка безопасности оригинального имени файла
@@ -1258,21 +2687,27 @@ def upload_file(link_id):
             allowed_ext_str = ', '.join(app.config['ALLOWED_EXTENSIONS'])
             return jsonify({'error': f'Тип файла не разрешен. Разрешены только: {allowed_ext_str}'}), 400
 
+        # Чанки могут приходить в любом порядке, поэтому новый файл определяем по сессии, а не по номеру чанка
+        is_new_upload = get_upload_session(link_id, upload_session_id) is None
+
         # Проверка лимита количества файлов
         if app.config['MAX_FILES_PER_STORAGE'] > 0:
-            try:
-                current_files_count = len([name for name in os.listdir(storage_path) if os.path.isfile(os.path.join(storage_path, name))])
-                # Если это первый чанк нового файла, проверяем лимит
-                if chunk_number == 0 and current_files_count >= app.config['MAX_FILES_PER_STORAGE']:
-                    logger.warning(f"Превышен лимит количества файлов в хранилище {link_id}")
-                    return jsonify({'error': f'Превышен лимит количества файлов ({app.config["MAX_FILES_PER_STORAGE"]})'}), 400
-            except Exception as e:
-                logger.error(f"Ошибка при подсчете файлов в {link_id}: {str(e)}")
-                # Не блокируем загрузку, если не удалось посчитать файлы
+            # Если это первый чанк нового файла, проверяем лимит
+            if is_new_upload and current_files_count >= app.config['MAX_FILES_PER_STORAGE']:
+                logger.warning(f"Превышен лимит количества файлов в хранилище {link_id}")
+                return jsonify({'error': f'Превышен лимит количества файлов ({app.config["MAX_FILES_PER_STORAGE"]})'}), 400
+
+        # Путь к временному файлу для сборки чанков
+        temp_file_path = get_upload_part_path(link_id, upload_session_id)
+        final_file_path = os.path.join(storage_path, original_filename)
 
         # Проверка общего лимита хранилища
-        chunk_size = file.content_length
-        if current_size + total_size > app.config['MAX_STORAGE_SIZE']:
+        # Уже выделенный .part-файл этой загрузки учтен в current_size, поэтому не считаем его дважды
+        try:
+            received_size = os.path.getsize(temp_file_path)
+        except OSError:
+            received_size = 0
+        if current_size - received_size + total_size > app.config['MAX_STORAGE_SIZE']:
             logger.warning(f"Превышен лимит хранилища {link_id} при загрузке файла {original_filename}")
             return jsonify({'error': f'Превышен лимит хранилища ({MAX_STORAGE_SIZE_MB} MB)'}), 400
 
@@ -1281,28 +2716,48 @@ def upload_file(link_id):
             logger.warning(f"Попытка загрузки слишком большого файла в {link_id}: {original_filename} ({total_size} байт)")
             return jsonify({'error': f'Файл слишком большой (макс. {MAX_FILE_SIZE_MB} MB)'}), 413
 
-        # Путь к временному файлу для сборки чанков
-        temp_file_path = os.path.join(storage_path, f"upload_{upload_session_id}.part")
-        final_file_path = os.path.join(storage_path, original_filename)
-
-        # Записываем чанк во временный файл
+        upload_session = open_upload_session(link_id, upload_session_id, original_filename, total_size, temp_file_path)
+        if upload_session['filename'] != original_filename or upload_session['total_size'] != total_size:
+            logger.warning(f"Параметры чанка не совпадают с сессией загрузки {upload_session_id} в {link_id}")
+            return jsonify({'error': 'Параметры чанка не совпадают с сессией загрузки'}), 400
+
+        if chunk_offset is None:
+            # Последовательная загрузка: дописываем чанк сразу за непрерывно полученной частью
+            ranges = upload_session['ranges']
+            chunk_offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+        if chunk_offset < 0 or chunk_offset > total_size:
+            logger.warning(f"Чанк {chunk_number} файла {original_filename} в {link_id} выходит за границы файла (смещение {chunk_offset})")
+            return jsonify({'error': 'Некорректное смещение чанка'}), 400
+
+        # Записываем чанк во временный файл по его смещению, не читая его целиком в память
+        max_chunk_length = min(app.config['MAX_CHUNK_SIZE'], total_size - chunk_offset)
         try:
-            # Используем 'ab' для добавления данных в конец файла
-            with open(temp_file_path, 'ab') as f:
-                chunk_data = file.read()
-                f.write(chunk_data)
-        except IOError as e:
+            chunk_length = write_chunk_to_part(file.stream, temp_file_path, chunk_offset, max_chunk_length)
+        except Exception as e:
             logger.error(f"Ошибка записи чанка {chunk_number} для файла {original_filename} в {link_id}: {str(e)}")
+            close_upload_session(link_id, upload_session_id)
             # Попытка удалить временный файл при ошибке записи
             if os.path.exists(temp_file_path):
                 try:
-                    os.remove(temp_file_path)
+                    discard_upload_part(link_id, temp_file_path)
                 except OSError as remove_err:
                     logger.error(f"Не удалось удалить временный файл {temp_file_path} после ошибки записи: {str(remove_err)}")
             return jsonify({'error': 'Ошибка записи файла на сервере'}), 500
 
-        # Проверяем, все ли чанки загружены
-        if chunk_number == total_chunks - 1:
+        if chunk_length is None:
+            # Записанная часть чанка не отмечается как полученная и будет перезаписана повторной отправкой
+            if max_chunk_length == app.config['MAX_CHUNK_SIZE']:
+                logger.warning(f"Чанк {chunk_number} файла {original_filename} в {link_id} превышает MAX_CHUNK_SIZE")
+                return jsonify({'error': 'Слишком большой чанк'}), 413
+            logger.warning(f"Чанк {chunk_number} файла {original_filename} в {link_id} выходит за границы файла (смещение {chunk_offset})")
+            return jsonify({'error': 'Некорректное смещение чанка'}), 400
+
+        # Проверяем, все ли диапазоны файла получены
+        upload_complete = mark_chunk_received(link_id, upload_session_id, upload_session, chunk_offset, chunk_offset + chunk_length)
+        # Хэш для дедупликации считаем по мере поступления чанков, а не одним проходом в конце
+        upload_digest = advance_upload_hash(upload_session, temp_file_path) if app.config['STORAGE_DEDUP_ENABLED'] else None
+        if upload_complete:
+            close_upload_session(link_id, upload_session_id)
             # Проверяем размер собранного файла
             try:
                 actual_size = os.path.getsize(temp_file_path)
@@ -1310,18 +2765,25 @@ def upload_file(link_id):
                     logger.error(f"Несоответствие размера файла {original_filename} в {link_id}. Ожидалось: {total_size}, получено: {actual_size}")
                     # Удаляем временный файл
                     try:
-                        os.remove(temp_file_path)
+                        discard_upload_part(link_id, temp_file_path)
                     except OSError as e:
                         logger.error(f"Не удалось удалить некорректный временный файл {temp_file_path}: {str(e)}")
                     return jsonify({'error': 'Ошибка сборки файла: несоответствие размера'}), 500
 
                 # Переименовываем временный файл в окончательное имя
                 try:
+                    # При перезаписи количество файлов в хранилище не меняется
+                    files_delta = 0 if os.path.exists(final_file_path) else 1
+
                     # Удаляем старый файл, если он существует (перезапись)
                     if os.path.exists(final_file_path):
                          # Добавим проверку, не является ли это тем же файлом (маловероятно, но на всякий случай)
                          if not os.path.samefile(temp_file_path, final_file_path):
+                             replaced_size = os.path.getsize(final_file_path)
                              os.remove(final_file_path)
+                             update_storage_usage(link_id, bytes_delta=-replaced_size)
+                             release_file_blob(link_id, original_filename)
+                             invalidate_thumbnails(link_id, original_filename)
                          else:
                              # Если временный и конечный файл - это одно и то же (очень маловероятно),
                              # просто логируем и считаем успешным
@@ -1330,6 +2792,10 @@ def upload_file(link_id):
                     # Если файлы разные или конечного не существует, переименовываем
                     if not os.path.exists(final_file_path) or not os.path.samefile(temp_file_path, final_file_path):
                         os.rename(temp_file_path, final_file_path)
+                        if upload_digest:
+                            link_file_to_blob(link_id, original_filename, final_file_path, upload_digest)
+                        update_storage_usage(link_id, files_delta=files_delta)
+                        index_storage_file(link_id, original_filename, final_file_path)
 
                     logger.info(f"Файл {original_filename} успешно собран и сохранен в {link_id}")
                 except OSError as e:
@@ -1337,7 +2803,7 @@ def upload_file(link_id):
                     # Пытаемся удалить временный файл в случае ошибки
                     if os.path.exists(temp_file_path):
                         try:
-                            os.remove(temp_file_path)
+                            discard_upload_part(link_id, temp_file_path)
                         except OSError as remove_err:
                             logger.error(f"Не удалось удалить временный файл {temp_file_path} после ошибки переименования: {str(remove_err)}")
                     return jsonify({'error': 'Ошибка сохранения файла на сервере'}), 500
@@ -1347,12 +2813,13 @@ def upload_file(link_id):
                 # Попытка удалить временный файл
                 if os.path.exists(temp_file_path):
                      try:
-                          os.remove(temp_file_path)
+                          discard_upload_part(link_id, temp_file_path)
                      except OSError as remove_err:
                           logger.error(f"Не удалось удалить временный файл {temp_file_path} после ошибки проверки: {str(remove_err)}")
                 return jsonify({'error': 'Ошибка обработки файла на сервере'}), 500
 
-        return jsonify({'success': True, 'message': f'Chunk {chunk_number + 1}/{total_chunks} uploaded successfully'}), 200
+        return jsonify({'success': True, 'complete': upload_complete,
+                        'message': f'Chunk {chunk_number + 1}/{total_chunks} uploaded successfully'}), 200
 
     except Exception as e:
         # Используем handle_error для логирования и безопасного ответа
@@ -1360,13 +2827,72 @@ def upload_file(link_id):
         # Попытка удалить временный файл при любой критической ошибке
         # temp_file_path может быть не определен, если ошибка произошла раньше
         try:
+            if 'temp_file_path' in locals():
+                close_upload_session(link_id, upload_session_id)
             if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
-                 os.remove(temp_file_path)
+                 discard_upload_part(link_id, temp_file_path)
         except Exception as remove_err:
              logger.error(f"Не удалось удалить временный файл {locals().get('temp_file_path')} после критической ошибки: {remove_err}")
         return jsonify({'error': error_message}), 500
 
 
+@app.route('/<link_id>/upload-status/<upload_session_id>')
+def upload_status(link_id, upload_session_id):
+    """Состояние незавершенной загрузки: какие диапазоны файла еще не получены"""
+    try:
+        # Проверка на безопасность link_id и идентификатора сессии
+        if not re.match(r'^[a-zA-Z0-9_-]+$', link_id) or not re.match(r'^[a-zA-Z0-9_-]{1,64}$', upload_session_id):
+            logger.warning(f"Запрос состояния загрузки с некорректными параметрами: {link_id}/{upload_session_id}")
+            return jsonify({'error': 'Недействительный идентификатор'}), 400
+
+        if not is_temp_storage_valid(link_id):
+            logger.warning(f"Запрос состояния загрузки в недействительном хранилище: {link_id}")
+            return jsonify({'error': 'Хранилище недействительно или срок его действия истек'}), 404
+
+        upload_session = get_upload_session(link_id, upload_session_id)
+        if upload_session is None:
+            return jsonify({'exists': False})
+
+        with upload_sessions_lock:
+            ranges = list(upload_session['ranges'])
+        missing_ranges = get_missing_ranges(ranges, upload_session['total_size'])
+        return jsonify({
+            'exists': True,
+            'filename': upload_session['filename'],
+            'total_size': upload_session['total_size'],
+            'received_bytes': upload_session['total_size'] - sum(end - start for start, end in missing_ranges),
+            'missing_ranges': missing_ranges,
+        })
+
+    except Exception as e:
+        error_message = handle_error(e, log_message=f"Критическая ошибка при получении состояния загрузки в {link_id}")
+        return jsonify({'error': error_message}), 500
+
+@app.route('/<link_id>/upload-abort/<upload_session_id>', methods=['POST'])
+@csrf_protected
+def upload_abort(link_id, upload_session_id):
+    """Отмена незавершенной загрузки с удалением её временного файла"""
+    try:
+        # Проверка на безопасность link_id и идентификатора сессии
+        if not re.match(r'^[a-zA-Z0-9_-]+$', link_id) or not re.match(r'^[a-zA-Z0-9_-]{1,64}$', upload_session_id):
+            logger.warning(f"Отмена загрузки с некорректными параметрами: {link_id}/{upload_session_id}")
+            return jsonify({'error': 'Недействительный идентификатор'}), 400
+
+        if not is_temp_storage_valid(link_id):
+            logger.warning(f"Отмена загрузки в недействительном хранилище: {link_id}")
+            return jsonify({'error': 'Хранилище недействительно или срок его действия истек'}), 404
+
+        close_upload_session(link_id, upload_session_id)
+        temp_file_path = get_upload_part_path(link_id, upload_session_id)
+        if os.path.exists(temp_file_path):
+            discard_upload_part(link_id, temp_file_path)
+            logger.info(f"Незавершенная загрузка {upload_session_id} в хранилище {link_id} отменена")
+        return jsonify({'success': True})
+
+    except Exception as e:
+        error_message = handle_error(e, log_message=f"Критическая ошибка при отмене загрузки в {link_id}")
+        return jsonify({'error': error_message}), 500
+
 @app.route('/<link_id>/set-theme', methods=['POST'])
 @csrf_protected
 def set_theme_route(link_id):
@@ -1443,22 +2969,16 @@ def delete_all_files(link_id):
                 logger.error(f"Ошибка при удалении хранилища {link_id}: {str(e)}")
                 return jsonify({'error': 'Ошибка при удалении хранилища на сервере'}), 500
 
-        # Удаляем запись из базы данных асинхронно
-        @run_async
-        async def remove_link_from_db():
-            try:
-                async with aiosqlite.connect(DB_PATH) as conn:
-                    await conn.execute('DELETE FROM temp_links WHERE link_id = ?', (link_id,))
-                    await conn.commit()
-                    logger.info(f"Запись о хранилище {link_id} удалена из БД")
-            except Exception as e:
-                logger.error(f"Ошибка при удалении записи о хранилище {link_id} из БД: {str(e)}")
-
+        # Удаляем запись из базы данных
         try:
-            remove_link_from_db()
+            purge_storage_records(link_id)
+            drop_storage_upload_sessions(link_id)
+            storage_validity_cache.invalidate(link_id)
+            expiry_scheduler.cancel(link_id)
+            logger.info(f"Запись о хранилище {link_id} удалена из БД")
         except Exception as e:
             # Логируем ошибку, но не прерываем основной ответ
-             logger.error(f"Ошибка при запуске асинхронного удаления записи из БД для {link_id}: {str(e)}")
+            logger.error(f"Ошибка при удалении записи о хранилище {link_id} из БД: {str(e)}")
 
         return jsonify({'success': True})
 
@@ -1521,26 +3041,14 @@ def download_multiple_files(link_id):
 
             files_to_zip.append({'path': file_path, 'name': decoded_filename})
 
-        # Создаем ZIP-архив в памяти
-        memory_file = BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for file_info in files_to_zip:
-                try:
-                    zf.write(file_info['path'], arcname=file_info['name'])
-                    logger.debug(f"Добавлен файл {file_info['name']} в архив для {link_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка добавления файла {file_info['name']} в архив для {link_id}: {str(e)}")
-                    return jsonify({'error': f'Ошибка при добавлении файла в архив: {file_info["name"]}'}), 500
-
-        memory_file.seek(0)
+        # Отдаем ZIP-архив потоком по мере упаковки файлов
         zip_filename = f"storage_{link_id}_files.zip"
         logger.info(f"Отправка ZIP-архива {zip_filename} для хранилища {link_id}")
 
-        return send_file(
-            memory_file,
+        return Response(
+            stream_with_context(generate_zip_stream(files_to_zip, link_id)),
             mimetype='application/zip',
-            as_attachment=True,
-            download_name=zip_filename
+            headers={'Content-Disposition': f'attachment; filename={zip_filename}'}
         )
 
     except Exception as e:
@@ -1595,7 +3103,13 @@ def delete_file(link_id, filename):
             try:
                 if os.path.isfile(file_path):
                     logger.info(f"Попытка удаления файла: {file_path}")
+                    file_size = os.path.getsize(file_path)
                     os.remove(file_path)
+                    update_storage_usage(link_id, bytes_delta=-file_size,
+                                         files_delta=0 if is_upload_part_file(decoded_filename) else -1)
+                    unindex_storage_file(link_id, decoded_filename)
+                    release_file_blob(link_id, decoded_filename)
+                    invalidate_thumbnails(link_id, decoded_filename)
                     # Проверяем, удалился ли файл
                     if not os.path.exists(file_path):
                         logger.info(f"Файл {decoded_filename} успешно удален из хранилища {link_id}")
@@ -1626,11 +3140,10 @@ def delete_file(link_id, filename):
 
 if __name__ == '__main__':
     # Проверяем подключение к базе данных
-    @run_async
-    async def check_db_connection():
+    def check_db_connection():
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
-                logger.info("Подключение к базе данных успешно")
+            db_fetchone('SELECT 1')
+            logger.info("Подключение к базе данных успешно")
         except Exception as e:
             logger.error(f"Ошибка подключения к базе данных: {str(e)}")
             raise
@@ -1648,11 +3161,19 @@ if __name__ == '__main__':
         # Запускаем поток очистки
         cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
         cleanup_thread.start()
-        logger.info("Запущен поток периодической очистки истекших хранилищ и сессий")
+        logger.info("Запущен поток периодической очистки сессий и сверки учета хранилищ")
+
+        # Запускаем планировщик удаления истекших хранилищ
+        expiry_thread = threading.Thread(target=expiry_scheduler.run, daemon=True)
+        expiry_thread.start()
         
         # Запускаем сервер
         logger.info("Запуск веб-сервера на 127.0.0.1:5000")
         app.run(host='127.0.0.1', port=5000, threaded=True, debug=False)
     except Exception as e:
         logger.critical(f"Критическая ошибка при запуске сервера: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+    finally:
+        # Дописываем накопленные записи access_log и закрываем соединения пула
+        access_log_writer.stop()
+        db_pool.close_all()